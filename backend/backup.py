@@ -4,6 +4,7 @@ Ensures data persistence even if MySQL has issues
 """
 import mysql.connector
 from config import DB_CONFIG
+from change_feed import record_change, CASES_RESTORED
 import json
 import os
 import logging
@@ -30,20 +31,24 @@ def backup_database():
         cursor.execute("SELECT * FROM findthem_db.cases")
         cases = cursor.fetchall()
         
+        # Additional photos of multi-image cases
+        cursor.execute("SELECT * FROM findthem_db.case_images")
+        case_images = cursor.fetchall()
+        
         # Convert datetime objects to strings
-        for case in cases:
-            for key, value in case.items():
+        for row in cases + case_images:
+            for key, value in row.items():
                 if isinstance(value, datetime):
-                    case[key] = value.isoformat()
+                    row[key] = value.isoformat()
         
         # Create backup file
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         backup_file = os.path.join(BACKUP_DIR, f"backup_{timestamp}.json")
         
         with open(backup_file, 'w') as f:
-            json.dump({'cases': cases, 'timestamp': timestamp}, f, indent=2)
+            json.dump({'cases': cases, 'case_images': case_images, 'timestamp': timestamp}, f, indent=2)
         
-        logger.info(f"Database backup created: {backup_file} ({len(cases)} cases)")
+        logger.info(f"Database backup created: {backup_file} ({len(cases)} cases, {len(case_images)} extra images)")
         
         cursor.close()
         conn.close()
@@ -65,6 +70,7 @@ def restore_database(backup_file):
             data = json.load(f)
         
         cases = data.get('cases', [])
+        case_images = data.get('case_images', [])
         
         conn = mysql.connector.connect(**DB_CONFIG)
         cursor = conn.cursor()
@@ -75,9 +81,10 @@ def restore_database(backup_file):
         # Restore cases
         for case in cases:
             query = """INSERT INTO findthem_db.cases 
-                       (id, name, status, description, contact, image_path, embedding, 
-                        is_resolved, resolved_at, notes, created_at, updated_at)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+                       (id, name, status, description, contact, image_path, embedding, embedding_version,
+                        embedding_fingerprint, is_resolved, resolved_at, notes, phash, duplicate_of,
+                        created_at, updated_at)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
             
             values = (
                 case.get('id'),
@@ -87,15 +94,32 @@ def restore_database(backup_file):
                 case.get('contact'),
                 case.get('image_path'),
                 case.get('embedding'),
+                # Backups from before embeddings were versioned hold version 1
+                case.get('embedding_version', 1),
+                case.get('embedding_fingerprint'),
                 case.get('is_resolved'),
                 case.get('resolved_at'),
                 case.get('notes'),
+                case.get('phash'),
+                case.get('duplicate_of'),
                 case.get('created_at'),
                 case.get('updated_at')
             )
             
             cursor.execute(query, values)
         
+        # Restore additional photos (removed with their cases by the cascade above)
+        for image in case_images:
+            cursor.execute(
+                """INSERT INTO findthem_db.case_images
+                   (id, case_id, image_path, embedding, embedding_version, embedding_fingerprint, created_at)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                (image.get('id'), image.get('case_id'), image.get('image_path'), image.get('embedding'),
+                 image.get('embedding_version', 1), image.get('embedding_fingerprint'), image.get('created_at'))
+            )
+        
+        # Search replicas cannot tell restored rows from old ones; the feed tells them to reload
+        record_change(CASES_RESTORED, cursor=cursor, cases=len(cases), backup=os.path.basename(backup_file))
         conn.commit()
         logger.info(f"Database restored from {backup_file} ({len(cases)} cases)")
         
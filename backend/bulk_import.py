@@ -0,0 +1,248 @@
+"""
+Bulk case import from a directory or zip archive of images plus a CSV of metadata
+CSV columns: filename, name, status, description, contact
+
+Usage: python bulk_import.py <directory|archive.zip> [--csv cases.csv] [--workers N]
+                             [--batch-size N] [--report report.json]
+"""
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mysql.connector
+from fastapi import HTTPException
+from config import DB_CONFIG, ALLOWED_EXTENSIONS, BULK_IMPORT_BATCH_SIZE, BULK_IMPORT_WORKERS, MAX_FILE_SIZE
+from cases import insert_cases_batch, VALID_STATUSES
+from face_recognition_engine import analyze_image
+from storage import image_storage
+from upload_reader import read_image_file
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_COLUMNS = ('filename', 'name', 'status', 'contact')
+
+
+class ImportSource:
+    """Uniform access to images and the CSV inside a directory or a zip archive"""
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+        if self.archive is None and not os.path.isdir(path):
+            raise ValueError(f"Import source must be a directory or zip archive: {path}")
+        if self.archive:
+            # Archives are often zipped from a parent folder; match entries by their base name too
+            self.entries = {}
+            for entry in self.archive.namelist():
+                if not entry.endswith('/'):
+                    self.entries.setdefault(entry, entry)
+                    self.entries.setdefault(os.path.basename(entry), entry)
+
+    def find_csv(self):
+        names = self.archive.namelist() if self.archive else os.listdir(self.path)
+        csvs = [n for n in names if n.lower().endswith('.csv')]
+        if len(csvs) != 1:
+            raise ValueError(f"Expected exactly one CSV in {self.path}, found {len(csvs)}; pass --csv")
+        return csvs[0]
+
+    def read_csv(self, csv_path=None):
+        if csv_path and os.path.exists(csv_path):
+            with open(csv_path, 'r', encoding='utf-8-sig', newline='') as f:
+                return list(csv.DictReader(f))
+        name = csv_path or self.find_csv()
+        text = self.read(name).decode('utf-8-sig')
+        return list(csv.DictReader(io.StringIO(text)))
+
+    def read(self, name):
+        if self.archive:
+            return self.archive.read(self._entry(name))
+        with open(self._local_path(name), 'rb') as f:
+            return f.read()
+
+    def read_image(self, name):
+        """An image checked like an upload: the size recorded in the archive or on disk first,
+        then the header and the real size while it is streamed. Raises ValueError if rejected"""
+        if self.archive:
+            info = self.archive.getinfo(self._entry(name))
+            size, opener = info.file_size, lambda: self.archive.open(info)
+        else:
+            full_path = self._local_path(name)
+            size, opener = os.path.getsize(full_path), lambda: open(full_path, 'rb')
+        if size > MAX_FILE_SIZE:
+            raise ValueError("File size exceeds maximum limit")
+        try:
+            with opener() as f:
+                return read_image_file(f, name)
+        except HTTPException as e:
+            raise ValueError(e.detail)
+
+    def _entry(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            raise FileNotFoundError(name)
+        return entry
+
+    def _local_path(self, name):
+        full_path = os.path.join(self.path, name)
+        if os.path.commonpath([os.path.abspath(full_path), os.path.abspath(self.path)]) != os.path.abspath(self.path):
+            raise FileNotFoundError(name)
+        return full_path
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+
+
+def _validate_row(row):
+    """Normalized row fields, or raise ValueError describing what is wrong"""
+    row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k}
+    missing = [c for c in REQUIRED_COLUMNS if not row.get(c)]
+    if missing:
+        raise ValueError(f"Missing required field(s): {', '.join(missing)}")
+    status = row['status'].lower()
+    if status not in VALID_STATUSES:
+        raise ValueError(f"Invalid status '{row['status']}'")
+    filename = row['filename']
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in ALLOWED_EXTENSIONS:
+        raise ValueError(f"Invalid file format: {filename}")
+    return {
+        'filename': filename,
+        'name': row['name'],
+        'status': status,
+        'description': row.get('description', ''),
+        'contact': row['contact']
+    }
+
+
+def import_cases(source_path, csv_path=None, workers=BULK_IMPORT_WORKERS, batch_size=BULK_IMPORT_BATCH_SIZE):
+    """Import every CSV row as a case; returns a report with per-row failures and throughput"""
+    started = time.perf_counter()
+    source = ImportSource(source_path)
+    failures = []
+    rows = []
+    staged = []  # rows with their image stored on disk, awaiting analysis
+
+    try:
+        rows = source.read_csv(csv_path)
+        logger.info(f"Importing {len(rows)} rows from {source_path}")
+
+        # 1. Validate rows and write images into content-addressed storage
+        for line, raw in enumerate(rows, start=2):  # Line 1 is the CSV header
+            try:
+                row = _validate_row(raw)
+                # Oversized entries and non-images are rejected before anything is decoded
+                upload = source.read_image(row['filename'])
+                try:
+                    row['content_hash'] = upload.digest
+                    row['size'] = upload.size
+                    row['image_path'] = image_storage.relative_path(upload.digest, upload.kind)
+                    target = image_storage.absolute_path(row['image_path'])
+                    row['written'] = not os.path.exists(target)
+                    if row['written']:
+                        image_storage.write_atomic(target, upload)
+                finally:
+                    upload.close()
+                row['line'] = line
+                staged.append(row)
+            except FileNotFoundError as e:
+                failures.append({'line': line, 'filename': raw.get('filename'), 'error': f"Image not found: {e}"})
+            except Exception as e:
+                failures.append({'line': line, 'filename': raw.get('filename'), 'error': str(e)})
+    finally:
+        source.close()
+
+    # 2. Detection and embedding in parallel across cores, 3. batched inserts
+    imported = []
+    connection = mysql.connector.connect(**DB_CONFIG)
+    try:
+        batch = []
+        paths = [image_storage.absolute_path(row['image_path']) for row in staged]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(analyze_image, paths, chunksize=max(1, len(paths) // (workers * 4)))
+            for row, result in zip(staged, results):
+                if not result['has_face']:
+                    failures.append({'line': row['line'], 'filename': row['filename'], 'error': "No face detected in the image"})
+                    continue
+                row['embedding'] = result['embedding']
+                row['phash'] = result['phash']
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    imported += _flush(connection, batch, failures)
+                    batch = []
+        if batch:
+            imported += _flush(connection, batch, failures)
+    finally:
+        connection.close()
+
+    # Images this import wrote for rows that did not make it in are not referenced by anything
+    referenced = {row['content_hash'] for row in imported}
+    for row in staged:
+        if row['written'] and row['content_hash'] not in referenced:
+            image_storage.remove_file(row['image_path'])
+            referenced.add(row['content_hash'])
+
+    elapsed = time.perf_counter() - started
+    failures.sort(key=lambda f: f['line'])
+    report = {
+        'total_rows': len(rows),
+        'imported': len(imported),
+        'failed': len(failures),
+        'failures': failures,
+        'elapsed_seconds': round(elapsed, 2),
+        'rows_per_second': round(len(imported) / elapsed, 2) if elapsed > 0 else 0.0
+    }
+    logger.info(
+        f"Bulk import finished: {len(imported)} imported, {len(failures)} failed "
+        f"in {report['elapsed_seconds']}s ({report['rows_per_second']} rows/s)"
+    )
+    return report
+
+
+def _flush(connection, batch, failures):
+    """Insert a batch in one transaction; on failure retry rows one by one to isolate bad rows.
+    Returns the rows that were inserted"""
+    try:
+        insert_cases_batch(connection, batch)
+        return list(batch)
+    except Exception as e:
+        logger.warning(f"Batch insert of {len(batch)} rows failed ({e}), retrying row by row")
+
+    inserted = []
+    for row in batch:
+        try:
+            insert_cases_batch(connection, [row])
+            inserted.append(row)
+        except Exception as e:
+            failures.append({'line': row['line'], 'filename': row['filename'], 'error': f"Database error: {e}"})
+    return inserted
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Bulk import cases from a directory or zip archive")
+    parser.add_argument('source', help="Directory or zip archive with images and a CSV")
+    parser.add_argument('--csv', help="CSV file (defaults to the single .csv inside the source)")
+    parser.add_argument('--workers', type=int, default=BULK_IMPORT_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=BULK_IMPORT_BATCH_SIZE)
+    parser.add_argument('--report', help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    result = import_cases(args.source, args.csv, args.workers, args.batch_size)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
+    print(f"Imported {result['imported']} cases, {result['failed']} failed, "
+          f"{result['rows_per_second']} rows/s")
+    for failure in result['failures']:
+        print(f"  line {failure['line']} ({failure['filename']}): {failure['error']}")
@@ -0,0 +1,195 @@
+"""
+In-process response cache
+Bounded LRU with per-entry TTL. Writes invalidate the affected namespaces
+precisely; the TTL only bounds staleness across separate worker processes.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from config import (RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES,
+                    SEARCH_SESSION_TTL, SEARCH_SESSION_MAX_ENTRIES, SEARCH_SESSION_FOLDER)
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, name, maxsize=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value); keys are (namespace, ...) tuples
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Cached value or MISSING"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop one entry"""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_namespace(self, *namespaces):
+        """Drop every entry whose key starts with one of the namespaces"""
+        with self.lock:
+            stale = [key for key in self.entries if key[0] in namespaces]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """Hit-rate metric and occupancy"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self.entries),
+                'max_entries': self.maxsize,
+                'ttl_seconds': self.ttl,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+class GenerationCounter:
+    """Monotonic version of the searchable corpus; bumped by every case mutation"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+            return self.value
+
+
+class SearchSessionStore:
+    """Short-lived server-side query embeddings, addressed by an opaque search id.
+    Each session is also written to a folder shared by the workers, so a re-query that a
+    load balancer sends to another worker finds it there"""
+
+    def __init__(self, maxsize=SEARCH_SESSION_MAX_ENTRIES, ttl=SEARCH_SESSION_TTL, folder=SEARCH_SESSION_FOLDER):
+        self.cache = TTLCache('search_sessions', maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.folder = folder
+        self.last_prune = time.monotonic()
+        self.pruning = False
+        self.shared_hits = 0
+        self.write_errors = 0
+
+    def _path(self, search_id):
+        return os.path.join(self.folder, search_id[:2], f"{search_id}.npy")
+
+    def create(self, embedding):
+        search_id = uuid.uuid4().hex
+        self.cache.set(('session', search_id), embedding)
+        path = self._path(search_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.asarray(embedding, dtype=np.float32))
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            # The session still works on this worker
+            self.write_errors += 1
+            logger.warning(f"Could not save search session {search_id}: {e}")
+        if not self.pruning and time.monotonic() - self.last_prune >= min(60, self.ttl):
+            self.pruning = True
+            threading.Thread(target=self._prune, name='session-prune', daemon=True).start()
+        return search_id
+
+    def get(self, search_id):
+        """Query embedding of a live session (None once expired or evicted)"""
+        embedding = self.cache.get(('session', search_id))
+        if embedding is not MISSING:
+            return embedding
+        if not all(c in '0123456789abcdef' for c in search_id) or len(search_id) != 32:
+            return None
+        path = self._path(search_id)
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl:
+                return None
+            embedding = np.load(path).tolist()
+        except (OSError, ValueError):
+            return None
+        self.shared_hits += 1
+        self.cache.set(('session', search_id), embedding)
+        return embedding
+
+    def _prune(self):
+        """Delete session files older than the TTL; runs on a background thread"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        try:
+            for shard in os.listdir(self.folder):
+                directory = os.path.join(self.folder, shard)
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass  # pruned by another worker
+        except Exception as e:
+            logger.warning(f"Search session pruning failed: {e}")
+        finally:
+            self.last_prune = time.monotonic()
+            self.pruning = False
+        if removed:
+            logger.info(f"Pruned {removed} expired search sessions")
+
+    def stats(self):
+        return {**self.cache.stats(), 'shared_hits': self.shared_hits, 'write_errors': self.write_errors}
+
+
+# Global cache for /api/cases, /api/cases/{case_id} and /api/stats responses
+response_cache = TTLCache('responses')
+
+# Search results keyed by (index version, image hash, threshold, top_k, filters). Keys embed the
+# version read before the scan, so a result is not served once this process's index has changed.
+# Writes made elsewhere reach the index (and so the key) at its next sync, within INDEX_SYNC_INTERVAL
+search_cache = TTLCache('search', maxsize=SEARCH_CACHE_MAX_ENTRIES, ttl=SEARCH_CACHE_TTL)
+index_generation = GenerationCounter()
+
+# Query embeddings of recent searches, for re-querying without image processing
+search_sessions = SearchSessionStore()
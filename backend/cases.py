@@ -0,0 +1,244 @@
+"""
+Case persistence shared by the upload endpoint, the ingest queue and bulk import
+"""
+import json
+import logging
+import os
+from datetime import datetime
+
+from cache import response_cache, search_cache, index_generation
+from change_feed import (record_change, CASE_CREATED, CASES_IMPORTED, CASE_IMAGE_ADDED, CASE_RESOLVED,
+                         CASE_DELETED)
+from crossmatch import cross_matcher
+from database import db
+from embedding_index import case_index
+from face_recognition_engine import face_engine
+from perceptual_hash import phash_index
+from storage import image_storage
+
+logger = logging.getLogger(__name__)
+
+VALID_STATUSES = ('missing', 'found')
+
+
+def insert_case(name, status, description, contact, image_path, embedding, created_at=None,
+                phash=None, duplicate_of=None):
+    """Insert a case with its embedding and return the new case id (None on failure)"""
+    query = """
+    INSERT INTO cases (name, status, description, contact, image_path, embedding, embedding_version,
+                       embedding_fingerprint, created_at, phash, duplicate_of)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    embedding_json = json.dumps(embedding)
+    logger.info(f"Embedding JSON created, length: {len(embedding_json)}")
+
+    created_at = created_at or datetime.now()
+    case_id = db.execute_insert(
+        query,
+        (name, status, description, contact, image_path, embedding_json, face_engine.embedding_version,
+         face_engine.fingerprint, created_at, phash, duplicate_of)
+    )
+    logger.info(f"Insert result: case_id={case_id}")
+    if case_id is not None:
+        record_change(CASE_CREATED, [case_id], status=status)
+        notify_case_created(case_id, embedding, status, created_at, phash)
+    return case_id
+
+
+def delete_case(case_id):
+    """Delete a case row and its additional photos. Returns the image paths it referenced,
+    primary first (None if the case does not exist). Raises if the database fails, before any
+    derived state changes"""
+    result = db.execute_query("SELECT image_path FROM cases WHERE id = %s", (case_id,))
+    if result is None:
+        raise RuntimeError(f"Could not read case {case_id}")
+    if not result:
+        return None
+    images = db.execute_query("SELECT image_path FROM case_images WHERE case_id = %s ORDER BY id", (case_id,))
+    if images is None:
+        raise RuntimeError(f"Could not read images of case {case_id}")
+
+    # case_images rows go with the case (ON DELETE CASCADE)
+    deleted = db.execute_query("DELETE FROM cases WHERE id = %s", (case_id,), commit=True)
+    if deleted is None:
+        raise RuntimeError(f"Could not delete case {case_id}")
+    if deleted == 0:
+        return None  # deleted by another request in the meantime
+    logger.info(f"Case {case_id} deleted from database")
+    record_change(CASE_DELETED, [case_id])
+    notify_case_deleted(case_id)
+    return [result[0]['image_path']] + [image['image_path'] for image in images]
+
+
+def add_case_image(case_id, image_path, embedding):
+    """Attach an additional photo to a case. Returns the new image id (None on failure)"""
+    image_id = db.execute_insert(
+        """
+        INSERT INTO case_images (case_id, image_path, embedding, embedding_version, embedding_fingerprint)
+        VALUES (%s, %s, %s, %s, %s)
+        """,
+        (case_id, image_path, json.dumps(embedding), face_engine.embedding_version, face_engine.fingerprint)
+    )
+    if image_id is not None:
+        logger.info(f"Case {case_id}: added image {image_id}")
+        record_change(CASE_IMAGE_ADDED, [case_id], image_id=image_id)
+        notify_case_image_added(case_id, embedding)
+    return image_id
+
+
+def list_case_images(case_id):
+    """Additional photos of a case, oldest first"""
+    return db.execute_query(
+        "SELECT id, image_path, created_at FROM case_images WHERE case_id = %s ORDER BY id", (case_id,)
+    ) or []
+
+
+def set_case_resolved(case_id, is_resolved):
+    """Mark a case resolved or reopen it. Returns False if the case does not exist"""
+    result = db.execute_query("SELECT id FROM cases WHERE id = %s", (case_id,))
+    if not result:
+        return False
+
+    db.execute_query("UPDATE cases SET is_resolved = %s WHERE id = %s", (is_resolved, case_id), commit=True)
+    logger.info(f"Case {case_id} marked {'resolved' if is_resolved else 'unresolved'}")
+    record_change(CASE_RESOLVED, [case_id], is_resolved=bool(is_resolved))
+    notify_case_resolved(case_id, is_resolved)
+    return True
+
+
+# ============ WRITE NOTIFICATIONS ============
+# Every mutation of the cases table goes through one of these so derived state stays exact
+
+def _searchable_set_changed():
+    # Cached search results embed the generation they were computed at; bumping it makes
+    # them unreachable, clearing just frees the memory early
+    index_generation.bump()
+    search_cache.clear()
+
+
+def notify_case_created(case_id, embedding, status, created_at, phash=None):
+    """A case was inserted"""
+    case_index.add(case_id, embedding, status, False, created_at)
+    phash_index.add(case_id, phash)
+    cross_matcher.enqueue(case_id)
+    response_cache.invalidate_namespace('cases', 'stats')
+    _searchable_set_changed()
+
+
+def notify_cases_created(count):
+    """A batch of cases was inserted"""
+    # Batches run on their own connection and thread; the index catches up before its next search
+    case_index.mark_stale()
+    phash_index.mark_stale()
+    response_cache.invalidate_namespace('cases', 'stats')
+    _searchable_set_changed()
+
+
+def notify_case_image_added(case_id, embedding):
+    """An additional photo was attached to a case"""
+    case_index.add_image(case_id, embedding)
+    response_cache.invalidate_namespace('cases')
+    response_cache.invalidate(('case', case_id))
+    _searchable_set_changed()
+
+
+def notify_case_deleted(case_id):
+    """A case was deleted"""
+    case_index.remove(case_id)
+    phash_index.remove(case_id)
+    response_cache.invalidate_namespace('cases', 'stats')
+    response_cache.invalidate(('case', case_id))
+    _searchable_set_changed()
+
+
+def notify_case_resolved(case_id, is_resolved):
+    """A case was resolved or reopened"""
+    case_index.set_resolved(case_id, is_resolved)
+    response_cache.invalidate_namespace('cases', 'stats')
+    response_cache.invalidate(('case', case_id))
+    _searchable_set_changed()
+
+
+def notify_cases_replaced():
+    """The whole table was replaced (restore from backup)"""
+    case_index.invalidate()
+    phash_index.invalidate()
+    response_cache.clear()
+    _searchable_set_changed()
+
+
+def find_duplicates(phash):
+    """Existing cases whose photo is a near-duplicate, as [(case_id, distance)] closest first"""
+    if phash is None:
+        return []
+    phash_index.ensure_current()
+    matches = phash_index.find(phash)
+    if matches:
+        # Deletions leave no trace for the sync to find; drop cases deleted by another process
+        placeholders = ', '.join(['%s'] * len(matches))
+        rows = db.execute_query(
+            f"SELECT id FROM cases WHERE id IN ({placeholders})", tuple(case_id for case_id, _ in matches)
+        )
+        if rows is None:
+            raise RuntimeError("Could not check duplicate candidates")
+        existing = {row['id'] for row in rows}
+        for case_id, _ in matches:
+            if case_id not in existing:
+                phash_index.remove(case_id)
+        matches = [match for match in matches if match[0] in existing]
+    return matches
+
+
+def find_case_by_image(image_path, name, contact, since):
+    """Id of a case already created for this image and submitter (used to make retries idempotent)"""
+    query = """
+    SELECT id FROM cases
+    WHERE image_path = %s AND name = %s AND contact = %s AND created_at >= %s
+    ORDER BY id LIMIT 1
+    """
+    result = db.execute_query(query, (image_path, name, contact, since))
+    return result[0]['id'] if result else None
+
+
+def insert_cases_batch(connection, rows):
+    """Insert many cases and their image blob references in one transaction on a dedicated connection.
+
+    rows: dicts with name, status, description, contact, image_path, content_hash, size, embedding
+    and optionally phash
+    """
+    now = datetime.now()
+    cursor = connection.cursor()
+    try:
+        cursor.executemany(
+            """
+            INSERT INTO cases (name, status, description, contact, image_path, embedding, embedding_version,
+                               embedding_fingerprint, created_at, phash)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """,
+            [
+                (r['name'], r['status'], r['description'], r['contact'], r['image_path'],
+                 json.dumps(r['embedding']), face_engine.embedding_version, face_engine.fingerprint, now, r.get('phash'))
+                for r in rows
+            ]
+        )
+        cursor.executemany(
+            """
+            INSERT INTO image_blobs (content_hash, path, size_bytes, ref_count)
+            VALUES (%s, %s, %s, 1)
+            ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+            """,
+            [(r['content_hash'], r['image_path'], r['size']) for r in rows]
+        )
+        # The upserts hold the blob rows: a file checked now stays until the commit
+        removed = [r['image_path'] for r in rows if not os.path.exists(image_storage.absolute_path(r['image_path']))]
+        if removed:
+            raise RuntimeError(f"Image {removed[0]} was removed during the import")
+        record_change(CASES_IMPORTED, cursor=cursor, count=len(rows))
+        connection.commit()
+        notify_cases_created(len(rows))
+        return len(rows)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
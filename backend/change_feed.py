@@ -0,0 +1,220 @@
+"""
+Ordered feed of case mutations for read-only search replicas
+Every write to the cases table appends an entry to activity_log. The ids of the
+cases it touched also go in the JSON details, because the foreign key sets
+case_id to NULL once a case is deleted. A search replica (SEARCH_REPLICA) tails
+the log by id and re-reads only the cases each entry names, instead of
+rescanning the table.
+
+Entry ids are assigned at insert but become visible at commit, so a lower id can
+show up after a higher one. Ids a poll skipped over are re-checked until
+CHANGE_FEED_GAP_TIMEOUT has passed (an insert that rolled back never fills its gap).
+"""
+import asyncio
+import json
+import logging
+import time
+
+from cache import response_cache, search_cache, index_generation
+from config import SEARCH_REPLICA, CHANGE_FEED_INTERVAL, CHANGE_FEED_BATCH, CHANGE_FEED_GAP_TIMEOUT
+from database import db
+from embedding_index import case_index
+
+logger = logging.getLogger(__name__)
+
+CASE_CREATED = 'case_created'
+CASES_IMPORTED = 'cases_imported'  # a bulk import batch; replicas pick the new ids up by watermark
+CASE_IMAGE_ADDED = 'case_image_added'
+CASE_RESOLVED = 'case_resolved'
+CASE_DELETED = 'case_deleted'
+CASE_REEMBEDDED = 'case_reembedded'
+CASES_RESTORED = 'cases_restored'  # the whole table was replaced; replicas reload
+EMBEDDINGS_CUTOVER = 'embeddings_cutover'  # staged embeddings became the stored ones; vectors unchanged
+
+INSERT_ENTRY = "INSERT INTO activity_log (action, case_id, details) VALUES (%s, %s, %s)"
+
+
+def record_change(action, case_ids=(), cursor=None, **details):
+    """Append an entry to the feed. With a cursor the entry joins the caller's transaction;
+    otherwise it is committed on the shared connection. Returns False if it could not be written"""
+    case_ids = [int(case_id) for case_id in case_ids]
+    # The foreign key can only point at a case that still exists
+    case_id = case_ids[0] if len(case_ids) == 1 and action != CASE_DELETED else None
+    params = (action, case_id, json.dumps({'case_ids': case_ids, **details}))
+    if cursor is not None:
+        cursor.execute(INSERT_ENTRY, params)
+        return True
+    if db.execute_query(INSERT_ENTRY, params, commit=True) is None:
+        # The index watermarks still catch the change, just not as promptly
+        logger.error(f"Change feed: could not record {action} for cases {case_ids}")
+        return False
+    return True
+
+
+class ChangeFeedFollower:
+    def __init__(self, index, enabled=SEARCH_REPLICA, interval=CHANGE_FEED_INTERVAL, batch=CHANGE_FEED_BATCH,
+                 gap_timeout=CHANGE_FEED_GAP_TIMEOUT):
+        self.index = index
+        self.enabled = enabled
+        self.interval = interval
+        self.batch = batch
+        self.gap_timeout = gap_timeout
+        self.task = None
+        self.last_id = None  # highest entry applied; None until positioned
+        self.gaps = {}  # entry id skipped by a poll -> monotonic time it was first missed
+        self.entries_applied = 0
+        self.cases_refreshed = 0
+        self.reloads = 0
+        self.gaps_expired = 0
+        self.entries_behind = None
+        self.lag_seconds = None  # age of the newest entry when it was applied
+        self.last_poll_at = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self.task = asyncio.create_task(self._loop())
+        logger.info(f"Search replica: following the change feed every {self.interval}s")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Change feed poll failed: {e}", exc_info=True)
+
+    @staticmethod
+    def _head():
+        result = db.execute_query("SELECT COALESCE(MAX(id), 0) AS head FROM activity_log")
+        if not result:
+            raise RuntimeError("Could not read the change feed head")
+        return int(result[0]['head'])
+
+    def _position(self, head):
+        """Start from the head; the load below already reflects every earlier entry"""
+        self.last_id = head
+        self.gaps = {}
+        self.index.ensure_current()
+
+    def poll(self):
+        """Apply the entries committed since the last poll. Returns the number applied"""
+        # On a shared index the writer worker follows the feed and replicas map its generations
+        if self.index.change_sink is not None:
+            return 0
+        if self.last_id is None or not self.index.loaded:
+            # Entries committed during the load are replayed; applying one twice is harmless
+            self._position(self._head())
+            return 0
+
+        query = """
+        SELECT id, action, details, TIMESTAMPDIFF(MICROSECOND, created_at, NOW(6)) / 1e6 AS age
+        FROM activity_log WHERE id > %s
+        """
+        params = [self.last_id]
+        if self.gaps:
+            query += f" OR id IN ({', '.join(['%s'] * len(self.gaps))})"
+            params.extend(self.gaps)
+        query += " ORDER BY id LIMIT %s"
+        params.append(self.batch)
+        entries = db.execute_query(query, tuple(params))
+        if entries is None:
+            raise RuntimeError("Could not read the change feed")
+        head = self._head()
+        self.last_poll_at = time.time()
+
+        if head < self.last_id:
+            # The log was truncated: its ids mean nothing to us any more
+            logger.warning("Change feed went backwards; reloading the index")
+            self.index.load()
+            self.reloads += 1
+            self._invalidate_caches(None)
+            self._position(head)
+            return 0
+
+        now = time.monotonic()
+        expected = self.last_id + 1
+        for entry in entries:
+            self.gaps.pop(entry['id'], None)
+            if entry['id'] >= expected:
+                # A jump wider than a batch is the auto-increment skipping ahead, not open transactions
+                if entry['id'] - expected <= self.batch:
+                    for missing in range(expected, entry['id']):
+                        self.gaps[missing] = now
+                expected = entry['id'] + 1
+        self.last_id = expected - 1
+        for entry_id, missed_at in list(self.gaps.items()):
+            if now - missed_at >= self.gap_timeout:
+                del self.gaps[entry_id]
+                self.gaps_expired += 1
+
+        if entries:
+            self._apply(entries)
+            self.lag_seconds = round(max(0.0, float(entries[-1]['age'])), 3)
+        else:
+            self.lag_seconds = 0.0
+        self.entries_behind = max(0, head - self.last_id)
+        return len(entries)
+
+    def _apply(self, entries):
+        actions = {entry['action'] for entry in entries}
+        if CASES_RESTORED in actions:
+            self.index.load()
+            self.reloads += 1
+            self._invalidate_caches(None)
+        else:
+            case_ids = []
+            unknown = False
+            for entry in entries:
+                try:
+                    case_ids.extend(json.loads(entry['details'] or '{}').get('case_ids', []))
+                except (ValueError, AttributeError):
+                    unknown = True
+            if unknown or CASES_IMPORTED in actions:
+                # Catch up by watermark before the next search
+                self.index.mark_stale()
+            if case_ids:
+                self.index.refresh(case_ids)
+                self.cases_refreshed += len(set(case_ids))
+            self.index.ensure_current()
+            self._invalidate_caches(case_ids)
+        self.entries_applied += len(entries)
+
+    @staticmethod
+    def _invalidate_caches(case_ids):
+        """Drop what this process derived from the cases that changed (None: everything)"""
+        if case_ids is None:
+            response_cache.clear()
+        else:
+            response_cache.invalidate_namespace('cases', 'stats')
+            for case_id in set(case_ids):
+                response_cache.invalidate(('case', case_id))
+        index_generation.bump()
+        search_cache.clear()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'following': self.task is not None and self.index.change_sink is None,
+            'last_entry_id': self.last_id,
+            'entries_behind': self.entries_behind,
+            'lag_seconds': self.lag_seconds,
+            'seconds_since_poll': round(time.time() - self.last_poll_at, 3) if self.last_poll_at else None,
+            'pending_gaps': len(self.gaps),
+            'gaps_expired': self.gaps_expired,
+            'entries_applied': self.entries_applied,
+            'cases_refreshed': self.cases_refreshed,
+            'reloads': self.reloads
+        }
+
+
+# Global follower for case_index (idle unless SEARCH_REPLICA)
+change_feed = ChangeFeedFollower(case_index)
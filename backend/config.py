@@ -16,10 +16,127 @@ DB_CONFIG = {
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'bmp'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Uploads are read and hashed in 64KB chunks
+UPLOAD_SPOOL_MEMORY = 1024 * 1024  # Spool to disk above 1MB per upload
+MULTIPART_OVERHEAD = 64 * 1024  # Allowance for form fields on top of MAX_FILE_SIZE
+
+# Content-addressed storage: files are named by SHA-256 and sharded as ab/cd/<hash>.<ext>
+STORAGE_SHARD_DEPTH = int(os.getenv('STORAGE_SHARD_DEPTH', 2))
+STORAGE_SHARD_WIDTH = int(os.getenv('STORAGE_SHARD_WIDTH', 2))
+
+# Derivative images (thumbnails and face crops), rendered on demand and cached on disk
+DERIVATIVE_FOLDER = os.getenv('DERIVATIVE_FOLDER', os.path.join(os.path.dirname(__file__), 'derivatives'))
+DERIVATIVE_SIZES = (64, 128, 256, 512)
+DERIVATIVE_DEFAULT_SIZE = 256
+DERIVATIVE_JPEG_QUALITY = 85
+DERIVATIVE_CACHE_MAX_AGE = 365 * 24 * 3600  # Content-addressed derivatives never change
+
+# Asynchronous ingestion (jobs are journaled as JSON files and processed by worker processes)
+INGEST_FOLDER = os.getenv('INGEST_FOLDER', os.path.join(os.path.dirname(__file__), 'ingest_jobs'))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', min(4, os.cpu_count() or 1)))
+INGEST_MAX_QUEUE = int(os.getenv('INGEST_MAX_QUEUE', 1000))
+INGEST_MAX_ATTEMPTS = 3
+INGEST_RETRY_DELAY = 2  # Seconds, doubled after each failed attempt
+INGEST_JOB_RETENTION_DAYS = 7
+
+# Bulk import
+BULK_IMPORT_WORKERS = int(os.getenv('BULK_IMPORT_WORKERS', os.cpu_count() or 1))
+BULK_IMPORT_BATCH_SIZE = int(os.getenv('BULK_IMPORT_BATCH_SIZE', 200))
+BULK_IMPORT_MAX_ARCHIVE_SIZE = int(os.getenv('BULK_IMPORT_MAX_ARCHIVE_SIZE', 1024 * 1024 * 1024))  # 1GB
+
+# Case listing
+CASES_MAX_PAGE_SIZE = int(os.getenv('CASES_MAX_PAGE_SIZE', 200))
+
+# Response cache for case listings, case detail and stats
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 30))  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 512))
+
+# Search result cache (keys carry the embedding index version)
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 600))  # Seconds
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', 1024))
+
+# Cross-matching: missing <-> found candidate pairs for admin review
+CROSSMATCH_THRESHOLD = float(os.getenv('CROSSMATCH_THRESHOLD', 0.9))
+CROSSMATCH_MAX_CANDIDATES = int(os.getenv('CROSSMATCH_MAX_CANDIDATES', 10))  # Per case
+CROSSMATCH_INTERVAL = int(os.getenv('CROSSMATCH_INTERVAL', 6 * 3600))  # Seconds between full sweeps, 0 disables
+CROSSMATCH_TILE = int(os.getenv('CROSSMATCH_TILE', 4096))  # Rows/columns per tile of the similarity matrix
+CROSSMATCH_WORKERS = int(os.getenv('CROSSMATCH_WORKERS', os.cpu_count() or 1))
+CROSSMATCH_FOLDER = os.getenv('CROSSMATCH_FOLDER', os.path.join(os.path.dirname(__file__), 'crossmatch_work'))
+
+# Near-duplicate detection: 64-bit perceptual hashes within this many bits count as the same photo
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', 6))
+PHASH_CHUNKS = 4  # Multi-index hashing tables (16-bit chunks)
+PHASH_DUPLICATE_ACTION = os.getenv('PHASH_DUPLICATE_ACTION', 'link')  # 'link' or 'reject'
+PHASH_SYNC_INTERVAL = float(os.getenv('PHASH_SYNC_INTERVAL', 5))  # Seconds between checks for hashes written by other processes
+
+# Embedding index: seconds between row-count checks that pick up writes made by other processes
+INDEX_SYNC_INTERVAL = int(os.getenv('INDEX_SYNC_INTERVAL', 30))
+# How scores of a case's photos combine into one case score: 'max' or 'top2_mean'
+MULTI_VECTOR_REDUCTION = os.getenv('MULTI_VECTOR_REDUCTION', 'max')
+MAX_IMAGES_PER_CASE = int(os.getenv('MAX_IMAGES_PER_CASE', 10))
+
+# PCA first-stage scan (fit with: python projection.py fit). 'latest' uses the newest artifact, '' disables
+PCA_PROJECTION = os.getenv('PCA_PROJECTION', 'latest')
+PCA_FOLDER = os.getenv('PCA_FOLDER', os.path.join(os.path.dirname(__file__), 'projections'))
+PCA_DIMS = int(os.getenv('PCA_DIMS', 48))
+PCA_MIN_ROWS = int(os.getenv('PCA_MIN_ROWS', 20000))  # Smaller scans run in full
+PCA_SHORTLIST = int(os.getenv('PCA_SHORTLIST', 1000))  # Rows re-ranked in full for a top-k search (at least)
+PCA_SHORTLIST_FACTOR = int(os.getenv('PCA_SHORTLIST_FACTOR', 20))  # ... or this many per requested result
+
+# Shared index: uvicorn workers on one node map one published copy of the embedding index
+INDEX_SHARED = os.getenv('INDEX_SHARED', 'false').lower() in ('1', 'true', 'yes')
+INDEX_FOLDER = os.getenv('INDEX_FOLDER', os.path.join(os.path.dirname(__file__), 'index_data'))
+INDEX_PUBLISH_INTERVAL = float(os.getenv('INDEX_PUBLISH_INTERVAL', 2))  # Seconds between writer publishes / replica checks
+INDEX_DELTA_RATIO = float(os.getenv('INDEX_DELTA_RATIO', 0.05))  # Rows appended since the last full generation, as a share of it, before republishing in full
+# Snapshots: published generations let a restarting worker map the index and apply only later changes
+INDEX_SNAPSHOTS = os.getenv('INDEX_SNAPSHOTS', 'true').lower() in ('1', 'true', 'yes')
+INDEX_SNAPSHOT_INTERVAL = int(os.getenv('INDEX_SNAPSHOT_INTERVAL', 300))  # Seconds between snapshots when not shared
+
+# Index maintenance: deletes leave tombstones that a background pass compacts away
+INDEX_COMPACT_RATIO = float(os.getenv('INDEX_COMPACT_RATIO', 0.2))  # Share of rows tombstoned before compacting
+INDEX_SPARE_CAPACITY = float(os.getenv('INDEX_SPARE_CAPACITY', 0.25))  # Free rows kept for appends, as a share of rows
+
+# Change feed: case mutations are appended to activity_log; a search replica tails it to stay current
+SEARCH_REPLICA = os.getenv('SEARCH_REPLICA', 'false').lower() in ('1', 'true', 'yes')
+CHANGE_FEED_INTERVAL = float(os.getenv('CHANGE_FEED_INTERVAL', 1))  # Seconds between polls
+CHANGE_FEED_BATCH = int(os.getenv('CHANGE_FEED_BATCH', 1000))  # Entries applied per poll
+CHANGE_FEED_GAP_TIMEOUT = int(os.getenv('CHANGE_FEED_GAP_TIMEOUT', 60))  # Seconds an id skipped by a poll is re-checked
+
+# Sharded search: row shards of the embedding index scored on parallel threads (1 disables)
+SEARCH_SHARDS = int(os.getenv('SEARCH_SHARDS', 1))
+SEARCH_SHARD_MIN_ROWS = int(os.getenv('SEARCH_SHARD_MIN_ROWS', 50000))  # Smaller indexes use fewer shards
+
+# Search sessions: query embeddings kept server-side so a search can be re-run with new parameters
+SEARCH_SESSION_TTL = int(os.getenv('SEARCH_SESSION_TTL', 900))  # Seconds
+SEARCH_SESSION_MAX_ENTRIES = int(os.getenv('SEARCH_SESSION_MAX_ENTRIES', 5000))
+# Sessions are also saved here so any worker can serve a re-query; must be shared by all workers
+SEARCH_SESSION_FOLDER = os.getenv('SEARCH_SESSION_FOLDER', os.path.join(os.path.dirname(__file__), 'search_sessions'))
+
+# Search history: searches are queued in memory and written to search_history in batches
+SEARCH_HISTORY_ENABLED = os.getenv('SEARCH_HISTORY_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SEARCH_HISTORY_MAX_QUEUE = int(os.getenv('SEARCH_HISTORY_MAX_QUEUE', 10000))  # Records held before new ones are dropped
+SEARCH_HISTORY_BATCH = int(os.getenv('SEARCH_HISTORY_BATCH', 500))  # Rows per multi-row insert; a full batch flushes early
+SEARCH_HISTORY_INTERVAL = float(os.getenv('SEARCH_HISTORY_INTERVAL', 2))  # Seconds between flushes otherwise
+
+# Request timing: per-stage durations in a Server-Timing header and one JSON access log line per request
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes')
+ACCESS_LOG = os.getenv('ACCESS_LOG', 'true').lower() in ('1', 'true', 'yes')
+ACCESS_LOG_SLOW_MS = float(os.getenv('ACCESS_LOG_SLOW_MS', 2000))  # Slower requests are logged as warnings
+
+# Sampling profiler, started from the admin API for a time window; idle (no thread, no hooks) otherwise
+PROFILE_FOLDER = os.getenv('PROFILE_FOLDER', os.path.join(os.path.dirname(__file__), 'profiles'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 5))  # Between stack samples
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 600))  # Longest window an admin can request
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 20))  # Saved profiles kept on disk
 
 # Face Recognition Configuration
 SIMILARITY_THRESHOLD = 0.85 # Threshold for face matching (0-1), 60% for moderate-quality matches
 MODEL_NAME = 'VGGFace2'  # Changed from facenet to VGGFace2 for better compatibility
+# Bump whenever get_face_embedding changes its output: embeddings of other versions are never
+# compared with this one, and regenerate_embeddings.py re-embeds them
+EMBEDDING_VERSION = 1
+REEMBED_BATCH = int(os.getenv('REEMBED_BATCH', 200))  # Rows staged and committed per checkpoint
+REEMBED_WORKERS = int(os.getenv('REEMBED_WORKERS', os.cpu_count() or 1))
 
 # API Configuration
 API_HOST = os.getenv('API_HOST', '0.0.0.0')
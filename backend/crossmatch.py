@@ -0,0 +1,363 @@
+"""
+Continuous missing <-> found cross-matching
+Every new case is scored against the opposite-status partition of the embedding
+index as soon as it is created. A periodic sweep scores the whole missing x found
+similarity matrix in tiles spread over worker processes. Pairs above the threshold
+are stored in match_candidates for admin review.
+
+Usage: python crossmatch.py [--threshold 0.9] [--workers N] [--tile N]
+"""
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mysql.connector
+from config import (DB_CONFIG, CROSSMATCH_THRESHOLD, CROSSMATCH_MAX_CANDIDATES, CROSSMATCH_INTERVAL,
+                    CROSSMATCH_TILE, CROSSMATCH_WORKERS, CROSSMATCH_FOLDER)
+from database import db
+from embedding_index import case_index, EmbeddingIndex, min_cosine
+
+logger = logging.getLogger(__name__)
+
+OPPOSITE_STATUS = {'missing': 'found', 'found': 'missing'}
+REVIEW_DECISIONS = ('confirmed', 'rejected')
+
+
+def score_row_block(missing_path, found_path, found_ids_path, row_start, row_end, cosine_floor, max_candidates,
+                    tile):
+    """Score rows [row_start, row_end) of the missing partition against every found case,
+    one column tile at a time. Runs in a worker process; operands are memory-mapped.
+    Returns (missing rows, found columns, scores) of the best found cases per missing row"""
+    missing = np.load(missing_path, mmap_mode='r')[row_start:row_end]
+    found = np.load(found_path, mmap_mode='r')
+    found_ids = np.load(found_ids_path, mmap_mode='r')
+    rows, cols, cosines = [], [], []
+
+    for col_start in range(0, len(found), tile):
+        block = missing @ found[col_start:col_start + tile].T
+        r, c = np.nonzero(block >= cosine_floor)
+        if r.size:
+            rows.append(r + row_start)
+            cols.append(c + col_start)
+            cosines.append(block[r, c])
+
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    scores = EmbeddingIndex.score(np.concatenate(cosines))
+
+    # One column per found case (its best photo), then the best max_candidates found cases per
+    # row. A pair in a missing case's top max_candidates is in the top of the row it scored on
+    cases = np.asarray(found_ids)[cols]
+    order = np.lexsort((-scores, cases, rows))
+    rows, cols, cases, scores = rows[order], cols[order], cases[order], scores[order]
+    first = np.r_[True, (np.diff(rows) != 0) | (np.diff(cases) != 0)]
+    rows, cols, scores = rows[first], cols[first], scores[first]
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+    rank = np.arange(rows.size) - np.repeat(starts, np.diff(np.r_[starts, rows.size]))
+    keep = rank < max_candidates
+    return rows[keep], cols[keep], scores[keep]
+
+
+def save_candidates(connection, pairs, source):
+    """Upsert (missing_case_id, found_case_id, score) pairs; review decisions are kept"""
+    if not pairs:
+        return 0
+    cursor = connection.cursor()
+    try:
+        cursor.executemany(
+            """
+            INSERT INTO match_candidates (missing_case_id, found_case_id, score, source)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE score = VALUES(score)
+            """,
+            [(int(m), int(f), float(s), source) for m, f, s in pairs]
+        )
+        connection.commit()
+        return len(pairs)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class CrossMatcher:
+    def __init__(self, threshold=CROSSMATCH_THRESHOLD, max_candidates=CROSSMATCH_MAX_CANDIDATES,
+                 interval=CROSSMATCH_INTERVAL, tile=CROSSMATCH_TILE, workers=CROSSMATCH_WORKERS,
+                 folder=CROSSMATCH_FOLDER):
+        self.threshold = threshold
+        self.max_candidates = max_candidates
+        self.interval = interval
+        self.tile = tile
+        self.workers = workers
+        self.folder = folder
+        self.queue = None
+        self.tasks = []
+        self.sweeping = False
+        self.sweep_task = None
+        self.connection = None  # used only by the incremental matching thread
+        self.last_sweep = None  # report of the most recent sweep
+        self.incremental_matched = 0
+        self.incremental_candidates = 0
+
+    async def start(self):
+        """Start incremental matching and, if an interval is set, periodic sweeps"""
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._incremental_worker())]
+        if self.interval > 0:
+            self.tasks.append(asyncio.create_task(self._sweep_loop()))
+        logger.info(f"Cross-matcher started (threshold {self.threshold}, sweep every {self.interval}s)")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.queue = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def enqueue(self, case_id):
+        """Score a newly created case once the event loop is free (no-op when not running)"""
+        # Replicas of a shared index leave matching to the writer, which sees the case first
+        if self.queue is not None and case_index.change_sink is None:
+            self.queue.put_nowait(case_id)
+
+    # ============ INCREMENTAL ============
+
+    async def _incremental_worker(self):
+        while True:
+            case_id = await self.queue.get()
+            try:
+                # The index catches up on the event loop, which owns the shared connection
+                case_index.ensure_current()
+                await asyncio.to_thread(self.match_case, case_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cross-matching case {case_id} failed: {e}")
+
+    def match_case(self, case_id):
+        """Score one case's primary photo against the open cases of the opposite status.
+        Runs in a thread, on a connection of its own. Returns candidates saved"""
+        attributes = case_index.attributes(case_id)
+        vector = case_index.get_vector(case_id)
+        if attributes is None or vector is None or attributes['status'] not in OPPOSITE_STATUS:
+            return 0
+
+        hits, _ = case_index.search(
+            vector, self.threshold, self.max_candidates,
+            status=OPPOSITE_STATUS[attributes['status']], is_resolved=False
+        )
+        if attributes['status'] == 'missing':
+            pairs = [(case_id, other, score) for other, score in hits]
+        else:
+            pairs = [(other, case_id, score) for other, score in hits]
+
+        saved = save_candidates(self._connect(), pairs, 'incremental')
+        self.incremental_matched += 1
+        self.incremental_candidates += saved
+        if saved:
+            logger.info(f"Cross-matching case {case_id}: {saved} candidate(s)")
+        return saved
+
+    def _connect(self):
+        if self.connection is None or not self.connection.is_connected():
+            self.connection = mysql.connector.connect(**DB_CONFIG)
+        return self.connection
+
+    # ============ SWEEP ============
+
+    async def _sweep_loop(self):
+        from shared_index import shared_index  # imports this module
+        while True:
+            await asyncio.sleep(self.interval)
+            # One worker per node sweeps: the elected index writer, or this one if no election ran
+            if shared_index.role in ('writer', None):
+                await self.run_sweep()
+
+    def trigger_sweep(self):
+        """Start a sweep now without waiting for it. Returns False if one is already running"""
+        if self.sweeping or (self.sweep_task is not None and not self.sweep_task.done()):
+            return False
+        # Claimed on the event loop before the task exists, so a second trigger sees it
+        self.sweeping = True
+        self.sweep_task = asyncio.create_task(self._run_claimed_sweep())
+        return True
+
+    async def run_sweep(self):
+        """Bring the index up to date on the event loop, then sweep in a thread"""
+        if self.sweeping:
+            return None
+        self.sweeping = True
+        return await self._run_claimed_sweep()
+
+    async def _run_claimed_sweep(self):
+        """Sweep with self.sweeping already set by the caller; clears it when done"""
+        try:
+            case_index.ensure_current()
+            return await asyncio.to_thread(self._sweep)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cross-matching sweep failed: {e}", exc_info=True)
+            return None
+        finally:
+            self.sweeping = False
+
+    def sweep(self):
+        """Score every open missing case against every open found case. Returns a report"""
+        if self.sweeping:
+            return None
+        self.sweeping = True
+        try:
+            return self._sweep()
+        finally:
+            self.sweeping = False
+
+    def _sweep(self):
+        started = time.perf_counter()
+        os.makedirs(self.folder, exist_ok=True)
+        workdir = tempfile.mkdtemp(dir=self.folder, prefix='sweep_')
+        try:
+            missing_ids, missing = case_index.partition('missing', is_resolved=False)
+            found_ids, found = case_index.partition('found', is_resolved=False)
+            report = {
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'missing_cases': len(missing_ids),
+                'found_cases': len(found_ids),
+                'pairs_scored': len(missing_ids) * len(found_ids),
+                'candidates': 0
+            }
+
+            if len(missing_ids) and len(found_ids):
+                # Workers memory-map the partitions instead of receiving copies
+                missing_path = os.path.join(workdir, 'missing.npy')
+                found_path = os.path.join(workdir, 'found.npy')
+                found_ids_path = os.path.join(workdir, 'found_ids.npy')
+                np.save(missing_path, missing)
+                np.save(found_path, found)
+                np.save(found_ids_path, found_ids)
+                del missing, found
+
+                # The score is monotonic in the cosine, so tiles are filtered on the raw matrix product
+                floor = min_cosine(self.threshold)
+                blocks = [(start, min(start + self.tile, len(missing_ids)))
+                          for start in range(0, len(missing_ids), self.tile)]
+                # Cases with several photos have several rows; keep the best score per case pair
+                best = {}
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    futures = [
+                        pool.submit(score_row_block, missing_path, found_path, found_ids_path, start, end,
+                                    floor, self.max_candidates, self.tile)
+                        for start, end in blocks
+                    ]
+                    for future in futures:
+                        rows, cols, scores = future.result()
+                        for pair, score in zip(zip(missing_ids[rows].tolist(), found_ids[cols].tolist()), scores.tolist()):
+                            if score > best.get(pair, -1.0):
+                                best[pair] = score
+
+                # Blocks cap rows, not cases: keep the best max_candidates per missing case
+                ranked = {}
+                for (m, f), score in best.items():
+                    ranked.setdefault(m, []).append((score, f))
+                pairs = [(m, f, score) for m, candidates in ranked.items()
+                         for score, f in sorted(candidates, reverse=True)[:self.max_candidates]]
+                connection = mysql.connector.connect(**DB_CONFIG)
+                try:
+                    for start in range(0, len(pairs), 1000):
+                        report['candidates'] += save_candidates(connection, pairs[start:start + 1000], 'sweep')
+                finally:
+                    connection.close()
+                report['tiles'] = len(blocks) * -(-len(found_ids) // self.tile)
+
+            report['elapsed_seconds'] = round(time.perf_counter() - started, 2)
+            self.last_sweep = report
+            logger.info(
+                f"Cross-matching sweep: {report['missing_cases']} x {report['found_cases']} cases, "
+                f"{report['candidates']} candidates in {report['elapsed_seconds']}s"
+            )
+            return report
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def stats(self):
+        return {
+            'running': bool(self.tasks),
+            'threshold': self.threshold,
+            'sweep_interval_seconds': self.interval,
+            'sweeping': self.sweeping,
+            'last_sweep': self.last_sweep,
+            'incremental_matched': self.incremental_matched,
+            'incremental_candidates': self.incremental_candidates
+        }
+
+
+def list_candidates(review_status='pending', min_score=None, limit=50):
+    """Candidate pairs with both cases, best first"""
+    query = """
+    SELECT mc.id, mc.score, mc.source, mc.review_status, mc.created_at, mc.reviewed_at,
+           m.id AS missing_id, m.name AS missing_name, m.contact AS missing_contact, m.image_path AS missing_image,
+           f.id AS found_id, f.name AS found_name, f.contact AS found_contact, f.image_path AS found_image
+    FROM match_candidates mc
+    JOIN cases m ON m.id = mc.missing_case_id
+    JOIN cases f ON f.id = mc.found_case_id
+    WHERE mc.review_status = %s
+    """
+    params = [review_status]
+    if min_score is not None:
+        query += " AND mc.score >= %s"
+        params.append(min_score)
+    query += " ORDER BY mc.score DESC LIMIT %s"
+    params.append(limit)
+    return db.execute_query(query, tuple(params))
+
+
+def review_candidate(candidate_id, decision):
+    """Record an admin decision. Returns False if the candidate does not exist"""
+    result = db.execute_query("SELECT id FROM match_candidates WHERE id = %s", (candidate_id,))
+    if not result:
+        return False
+    db.execute_query(
+        "UPDATE match_candidates SET review_status = %s, reviewed_at = NOW() WHERE id = %s",
+        (decision, candidate_id), commit=True
+    )
+    logger.info(f"Match candidate {candidate_id} {decision}")
+    return True
+
+
+# Global cross-matcher
+cross_matcher = CrossMatcher()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Score all open missing cases against all open found cases")
+    parser.add_argument('--threshold', type=float, default=CROSSMATCH_THRESHOLD)
+    parser.add_argument('--workers', type=int, default=CROSSMATCH_WORKERS)
+    parser.add_argument('--tile', type=int, default=CROSSMATCH_TILE)
+    args = parser.parse_args()
+
+    if not db.connect():
+        sys.exit("Could not connect to the database")
+    case_index.load()
+    matcher = CrossMatcher(threshold=args.threshold, workers=args.workers, tile=args.tile)
+    print(json.dumps(matcher.sweep(), indent=2))
@@ -1,7 +1,10 @@
 import mysql.connector
 from mysql.connector import Error
 from config import DB_CONFIG
+from metrics import DB_QUERY_SECONDS, DB_ERRORS
+from request_timing import add_timing
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -26,8 +29,21 @@ class Database:
             self.connection.close()
             logger.info("MySQL connection closed")
     
+    def ping(self):
+        """True if the server answers on the connection (does not reconnect)"""
+        if not self.connection:
+            return False
+        try:
+            self.connection.ping(reconnect=False)
+            return True
+        except Error as e:
+            logger.error(f"Database ping failed: {e}")
+            return False
+    
     def execute_query(self, query, params=None, commit=False):
         """Execute a query"""
+        kind = 'write' if commit else 'read'
+        started = time.perf_counter()
         try:
             cursor = self.connection.cursor(dictionary=True)
             if params:
@@ -45,12 +61,18 @@ class Database:
                 return result
         except Error as e:
             logger.error(f"Query execution error: {e}")
+            DB_ERRORS.inc(kind)
             if commit:
                 self.connection.rollback()
             return None
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, kind)
+            add_timing('db', elapsed)
     
     def execute_insert(self, query, params=None):
         """Insert a record and return the last inserted ID"""
+        started = time.perf_counter()
         try:
             cursor = self.connection.cursor()
             if params:
@@ -65,8 +87,13 @@ class Database:
             return last_id if last_id > 0 else 1  # Return at least 1 if insert succeeded
         except Error as e:
             logger.error(f"Insert error: {e}")
+            DB_ERRORS.inc('insert')
             self.connection.rollback()
             return None
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed, 'insert')
+            add_timing('db', elapsed)
     
     def close(self):
         """Close the connection"""
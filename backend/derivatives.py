@@ -0,0 +1,126 @@
+"""
+Derivative image service
+Produces resized thumbnails and face crops of uploaded images on demand and
+caches them on disk next to the originals' sharded layout
+"""
+import logging
+import os
+from urllib.parse import quote
+
+import cv2
+
+from config import (UPLOAD_FOLDER, DERIVATIVE_FOLDER, DERIVATIVE_SIZES, DERIVATIVE_DEFAULT_SIZE,
+                    DERIVATIVE_JPEG_QUALITY)
+from face_recognition_engine import face_engine
+from storage import image_storage
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_KINDS = ('thumb', 'face')
+
+
+class DerivativeStore:
+    def __init__(self, root=DERIVATIVE_FOLDER, source_root=UPLOAD_FOLDER):
+        self.root = root
+        self.source_root = source_root
+
+    @staticmethod
+    def is_safe_path(image_path):
+        """Reject absolute paths and parent-directory segments"""
+        parts = (image_path or '').replace('\\', '/').split('/')
+        return bool(image_path) and not image_path.startswith('/') and '..' not in parts
+
+    def source_path(self, image_path):
+        """Filesystem path of the original upload"""
+        return os.path.join(self.source_root, *image_path.split('/'))
+
+    def derivative_path(self, image_path, kind, size):
+        """Cache path of a derivative, e.g. derivatives/thumb/256/ab/cd/<hash>.png.jpg"""
+        return os.path.join(self.root, kind, str(size), *image_path.split('/')) + '.jpg'
+
+    def get(self, image_path, kind, size):
+        """Return the path of a cached derivative, rendering it first if needed (None if no source)"""
+        source = self.source_path(image_path)
+        if not os.path.exists(source):
+            return None
+
+        target = self.derivative_path(image_path, kind, size)
+        # Legacy uploads can be overwritten in place; re-render when the original is newer
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+            return target
+
+        img = cv2.imread(source)
+        if img is None:
+            logger.error(f"Could not read image for derivative: {image_path}")
+            return None
+
+        rendered = self._render(img, kind, size)
+        ok, encoded = cv2.imencode('.jpg', rendered, [cv2.IMWRITE_JPEG_QUALITY, DERIVATIVE_JPEG_QUALITY])
+        if not ok:
+            logger.error(f"Could not encode {kind} derivative for {image_path}")
+            return None
+
+        image_storage.write_atomic(target, encoded.tobytes())
+        logger.info(f"Rendered {kind}/{size} derivative for {image_path}")
+        return target
+
+    def _render(self, img, kind, size):
+        if kind == 'face':
+            h, w = img.shape[:2]
+            faces = face_engine.detect_faces(img)
+            if faces:
+                face = max(faces, key=lambda f: f['w'] * f['h'])
+                center_x, center_y = face['x'] + face['w'] / 2, face['y'] + face['h'] / 2
+                side = int(max(face['w'], face['h']) * 1.4)  # 20% margin on each side
+            else:
+                center_x, center_y, side = w / 2, h / 2, min(h, w)
+            # Square box around the face, shifted (and if need be shrunk) to stay inside the
+            # image, so the resize below never stretches it
+            side = max(1, min(side, h, w))
+            x = int(min(max(0, center_x - side / 2), w - side))
+            y = int(min(max(0, center_y - side / 2), h - side))
+            return cv2.resize(img[y:y + side, x:x + side], (size, size), interpolation=cv2.INTER_AREA)
+
+        # Thumbnails keep the aspect ratio and are never upscaled
+        h, w = img.shape[:2]
+        scale = min(1.0, size / max(h, w))
+        if scale >= 1.0:
+            return img
+        return cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+    def purge(self, image_path):
+        """Remove every cached derivative of an image"""
+        for kind in DERIVATIVE_KINDS:
+            for size in DERIVATIVE_SIZES:
+                target = self.derivative_path(image_path, kind, size)
+                if os.path.exists(target):
+                    try:
+                        os.remove(target)
+                    except Exception as e:
+                        logger.warning(f"Could not delete derivative {target}: {e}")
+
+    @staticmethod
+    def is_immutable(image_path):
+        """Content-addressed paths never change; legacy paths can be overwritten in place"""
+        return image_storage.digest_from_path(image_path) is not None
+
+    @staticmethod
+    def etag(image_path, kind, size, derivative):
+        """Strong validator: content hash when available, else the derivative's mtime and size"""
+        digest = image_storage.digest_from_path(image_path)
+        if digest:
+            return f'"{kind}-{size}-{digest[:32]}"'
+        stat = os.stat(derivative)
+        return f'"{kind}-{size}-{int(stat.st_mtime)}-{stat.st_size}"'
+
+
+def derivative_url(image_path, kind='thumb', size=DERIVATIVE_DEFAULT_SIZE):
+    """Public URL of a derivative for API responses"""
+    if not image_path:
+        return None
+    encoded = '/'.join(quote(part) for part in image_path.replace('\\', '/').split('/'))
+    return f"/api/images/{kind}/{size}/{encoded}"
+
+
+# Global derivative store
+derivative_store = DerivativeStore()
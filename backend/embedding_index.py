@@ -0,0 +1,917 @@
+"""
+In-memory embedding index
+Holds every case embedding as one normalized float32 matrix plus precomputed
+attribute masks (status, resolution) and created_at timestamps, so a search
+scores only the rows that pass its filters in a single vectorized pass.
+A case with several photos has one row per photo; scores are reduced per case
+(max or top-2 mean) so results stay one entry per case. With a PCA projection
+(see projection.py), large scans score reduced vectors first and re-rank only
+the shortlist in full. Big indexes are scored in row shards on a thread pool
+(NumPy releases the GIL), and the per-shard top-k lists are merged.
+
+Deletes only tombstone their rows and inserts append into spare capacity, so
+writes are O(1). Once tombstones pass INDEX_COMPACT_RATIO, or spare capacity runs
+low, a background thread rewrites the live rows into fresh arrays without the
+lock and swaps them in if no write happened meanwhile; searches keep running on
+the old arrays until then.
+
+Only embeddings of this process's EMBEDDING_VERSION are scored. During a re-embed
+(regenerate_embeddings.py) rows staged for our version in case_embeddings take the
+place of the stored ones; rows of other versions stay indexed but never match.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+from config import (EMBEDDING_VERSION, INDEX_SYNC_INTERVAL, INDEX_COMPACT_RATIO, INDEX_SPARE_CAPACITY, MULTI_VECTOR_REDUCTION,
+                    PCA_MIN_ROWS, PCA_SHORTLIST, PCA_SHORTLIST_FACTOR, SEARCH_SHARDS, SEARCH_SHARD_MIN_ROWS)
+from database import db
+from projection import load_projection, Projection
+
+logger = logging.getLogger(__name__)
+
+SQRT2 = np.float32(np.sqrt(2))
+REDUCTIONS = ('max', 'top2_mean')
+SAVED_ARRAYS = ('ids', 'vectors', 'valid', 'resolved', 'created_at', 'primary', 'reduced', 'residual', 'mean_dot')
+# Rows of these are written once, on append: a delta against a saved base carries only the appended rows
+APPEND_ONLY_ARRAYS = ('vectors', 'created_at', 'reduced', 'residual', 'mean_dot')
+TOMBSTONE = -1  # case id of a deleted row
+COMPACT_ATTEMPTS = 3  # rebuilds discarded because of concurrent writes before waiting for the next trigger
+SAVE_ATTEMPTS = 3  # snapshots written without the lock before one is copied under it
+
+# Embeddings staged for our version by a re-embed run replace the stored ones
+CASES_QUERY = """
+SELECT c.id, c.status, c.is_resolved, c.created_at,
+       COALESCE(s.embedding, c.embedding) AS embedding,
+       COALESCE(s.embedding_version, c.embedding_version) AS embedding_version
+FROM cases c
+LEFT JOIN case_embeddings s ON s.case_id = c.id AND s.image_id = 0 AND s.embedding_version = %s
+"""
+IMAGES_QUERY = """
+SELECT i.id, i.case_id,
+       COALESCE(s.embedding, i.embedding) AS embedding,
+       COALESCE(s.embedding_version, i.embedding_version) AS embedding_version
+FROM case_images i
+LEFT JOIN case_embeddings s ON s.case_id = i.case_id AND s.image_id = i.id AND s.embedding_version = %s
+"""
+
+
+@lru_cache(maxsize=256)
+def min_cosine(threshold):
+    """Smallest cosine similarity whose combined score reaches the threshold"""
+    low, high = -1.0, 1.0
+    for _ in range(50):
+        mid = (low + high) / 2
+        if EmbeddingIndex.score(np.float64(mid)) >= threshold:
+            high = mid
+        else:
+            low = mid
+    return high
+
+
+class EmbeddingIndex:
+    def __init__(self, sync_interval=INDEX_SYNC_INTERVAL, reduction=MULTI_VECTOR_REDUCTION,
+                 shards=SEARCH_SHARDS, shard_min_rows=SEARCH_SHARD_MIN_ROWS,
+                 compact_ratio=INDEX_COMPACT_RATIO, spare_capacity=INDEX_SPARE_CAPACITY,
+                 embedding_version=EMBEDDING_VERSION):
+        self.sync_interval = sync_interval
+        self.embedding_version = embedding_version
+        self.reduction = reduction if reduction in REDUCTIONS else 'max'
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.stale = False  # rows were inserted out of band (bulk import); catch up before searching
+        self.last_sync = 0.0
+        # Watermarks: highest case and photo ids seen, and the database time of the last sync
+        self.synced_through = 0
+        self.images_through = 0
+        self.updated_through = None
+        self.projection = None
+        self.projection_min_rows = PCA_MIN_ROWS
+        self.shards = max(1, shards)
+        self.shard_min_rows = shard_min_rows
+        self.executor = None  # created on the first sharded search
+        self.version = 0  # bumped by every change, so a publisher knows when there is something new
+        # Set on read-only replicas (shared_index.py): changes go to the writer instead of being applied
+        self.change_sink = None
+        self.compact_ratio = compact_ratio
+        self.spare_capacity = spare_capacity
+        self.compacting = False
+        self.compactions = 0
+        self.last_compaction_seconds = None
+        self._reset(0, 0)
+
+    def _reset(self, capacity, dim):
+        self.version += 1
+        self.dim = dim
+        self.size = 0  # rows (vectors, tombstones included), not cases
+        self.tombstones = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)  # case id of each row
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.valid = np.zeros(capacity, dtype=bool)  # False for empty or zero-norm embeddings
+        self.status_masks = {}  # status -> bool mask
+        self.resolved = np.zeros(capacity, dtype=bool)
+        self.created_at = np.zeros(capacity, dtype=np.int64)  # epoch seconds
+        self.primary = np.zeros(capacity, dtype=bool)  # True for each case's primary image row
+        self.rows = {}  # case_id -> row numbers, primary image first
+        self.other_versions = set()  # cases with a row embedded by another extractor version
+        self._reset_projection(capacity)
+
+    def _reset_projection(self, capacity):
+        dims = self.projection.dims if self.projection is not None else 0
+        self.reduced = np.zeros((capacity, dims), dtype=np.float32)
+        self.residual = np.zeros(capacity, dtype=np.float32)  # norm of the part the projection drops
+        self.mean_dot = np.zeros(capacity, dtype=np.float32)
+
+    def _capacity_for(self, rows):
+        return max(1024, int(rows * (1 + self.spare_capacity)) + 1)
+
+    def __len__(self):
+        """Number of indexed cases"""
+        return len(self.rows)
+
+    # ============ LOADING ============
+
+    def load(self):
+        """(Re)build the whole index from the cases and case_images tables"""
+        started = time.perf_counter()
+        watermark = self._database_time()
+        cases = db.execute_query(CASES_QUERY + " ORDER BY c.id", (self.embedding_version,))
+        if cases is None:
+            raise RuntimeError("Could not load case embeddings from database")
+        images = db.execute_query(IMAGES_QUERY + " ORDER BY i.id", (self.embedding_version,)) or []
+
+        with self.lock:
+            self.projection = None
+            self._reset(self._capacity_for(len(cases) + len(images)), self.dim)
+            for case in cases:
+                self._add_row(case)
+            for image in images:
+                self._add_image_row(image['case_id'], image['embedding'], image['embedding_version'])
+            self._apply_projection(load_projection())
+            self.synced_through = max((case['id'] for case in cases), default=0)
+            self.images_through = max((image['id'] for image in images), default=0)
+            self.updated_through = watermark
+            self.loaded = True
+            self.stale = False
+            self.last_sync = time.monotonic()
+        logger.info(
+            f"Embedding index loaded: {len(self.rows)} cases, {self.size} vectors, dim {self.dim} "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+
+    def warm_start(self, folder):
+        """Map a saved index copy-on-write and apply only what changed since its watermarks.
+        Returns the number of cases changed"""
+        started = time.perf_counter()
+        state = self.read_saved(folder, mmap_mode='c')
+        if state['meta'].get('updated_through') is None:
+            raise ValueError(f"{folder} has no watermark")
+        if state['meta'].get('embedding_version') != self.embedding_version:
+            raise ValueError(f"{folder} holds embeddings of version {state['meta'].get('embedding_version')}")
+        self.adopt(state)
+        changed = self.sync()
+        logger.info(
+            f"Embedding index warm start from {os.path.basename(folder)}: {len(self.rows)} cases, "
+            f"{changed} changed since the snapshot, in {time.perf_counter() - started:.2f}s"
+        )
+        return changed
+
+    def ensure_current(self):
+        """Load on first use, pick up out-of-band inserts, and periodically apply writes made
+        by other processes"""
+        if not self.loaded:
+            self.load()
+            return
+        if self.change_sink is not None:
+            return  # replicas are kept current by the writer's published generations
+        if self.stale or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    @staticmethod
+    def _database_time():
+        """Watermark from the database clock, so it compares exactly with updated_at"""
+        result = db.execute_query("SELECT NOW() AS now")
+        if not result:
+            raise RuntimeError("Could not read database time")
+        return result[0]['now']
+
+    def sync(self):
+        """Apply every change committed since the watermarks: new and updated cases, new photos
+        and deleted cases. Returns the number of cases refreshed or removed"""
+        watermark = self._database_time()
+        changed = db.execute_query(
+            "SELECT id FROM cases WHERE id > %s OR updated_at >= %s",
+            (self.synced_through, self.updated_through)
+        )
+        images = db.execute_query(
+            "SELECT id, case_id FROM case_images WHERE id > %s", (self.images_through,)
+        )
+        staged = db.execute_query(
+            "SELECT case_id FROM case_embeddings WHERE embedding_version = %s AND staged_at >= %s",
+            (self.embedding_version, self.updated_through)
+        )
+        totals = db.execute_query("SELECT COUNT(*) AS total FROM cases")
+        if changed is None or images is None or staged is None or not totals:
+            raise RuntimeError("Could not read changes from database")
+
+        case_ids = [row['id'] for row in changed] + [row['case_id'] for row in images + staged]
+        if case_ids:
+            self.refresh(case_ids)
+
+        # Deletions leave no trace in the tables: compare counts, then id sets
+        removed = []
+        if totals[0]['total'] != len(self.rows):
+            existing = {row['id'] for row in db.execute_query("SELECT id FROM cases") or []}
+            with self.lock:
+                removed = [case_id for case_id in self.rows if case_id not in existing]
+                for case_id in removed:
+                    self._remove_case(case_id)
+            self._maybe_compact()
+
+        with self.lock:
+            self.images_through = max([self.images_through] + [row['id'] for row in images])
+            self.updated_through = watermark
+            self.stale = False
+            self.last_sync = time.monotonic()
+        changes = len(set(case_ids)) + len(removed)
+        if changes:
+            logger.info(f"Embedding index synced: {len(set(case_ids))} cases refreshed, {len(removed)} removed")
+        return changes
+
+    def mark_stale(self):
+        """Cases were inserted without passing through add(); catch up before the next search"""
+        if self.change_sink is not None:
+            self.change_sink('stale')
+            return
+        self.stale = True
+
+    def refresh(self, case_ids):
+        """Re-read cases from the database after another process changed them.
+        Returns the ids that were not indexed before"""
+        added = []
+        case_ids = list(dict.fromkeys(case_ids))
+        for start in range(0, len(case_ids), 500):
+            chunk = case_ids[start:start + 500]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cases = db.execute_query(
+                CASES_QUERY + f" WHERE c.id IN ({placeholders})", (self.embedding_version, *chunk)
+            )
+            images = db.execute_query(
+                IMAGES_QUERY + f" WHERE i.case_id IN ({placeholders}) ORDER BY i.id", (self.embedding_version, *chunk)
+            )
+            if cases is None or images is None:
+                raise RuntimeError("Could not refresh cases from database")
+            with self.lock:
+                added.extend(case['id'] for case in cases if case['id'] not in self.rows)
+                for case_id in chunk:
+                    self._remove_case(case_id)
+                for case in cases:
+                    self._add_row(case)
+                    self.synced_through = max(self.synced_through, case['id'])
+                for image in images:
+                    self._add_image_row(image['case_id'], image['embedding'], image['embedding_version'])
+        self._maybe_compact()
+        return added
+
+    def set_projection(self, projection):
+        """Use a fitted projection for the first stage (None scans in full)"""
+        with self.lock:
+            self._apply_projection(projection)
+
+    def _apply_projection(self, projection):
+        if projection is not None and projection.input_dim != self.dim:
+            logger.warning(
+                f"Projection {projection.version} expects {projection.input_dim}-dim embeddings, "
+                f"index holds {self.dim}; scanning in full"
+            )
+            projection = None
+        self.projection = projection
+        self.version += 1
+        self._reset_projection(len(self.ids))
+        if projection is not None:
+            for start in range(0, self.size, 65536):
+                end = min(start + 65536, self.size)
+                self.reduced[start:end], self.residual[start:end], self.mean_dot[start:end] = \
+                    projection.project(self.vectors[start:end])
+            logger.info(f"Embedding index using projection {projection.version} ({projection.dims} dims)")
+
+    def invalidate(self):
+        """Drop everything; the next search reloads from the database"""
+        if self.change_sink is not None:
+            self.change_sink('reload')
+            return
+        with self.lock:
+            self.loaded = False
+            self._reset(0, self.dim)
+
+    # ============ MAINTENANCE ============
+
+    def add(self, case_id, embedding, status, is_resolved=False, created_at=None):
+        """Insert or replace one case with its primary image embedding"""
+        if self.change_sink is not None:
+            self.change_sink('case', case_id)
+            return
+        if not self.loaded:
+            return  # picked up by the first load
+        with self.lock:
+            self._remove_case(case_id)
+            self._add_row({
+                'id': case_id,
+                'status': status,
+                'is_resolved': is_resolved,
+                'created_at': created_at,
+                'embedding': embedding
+            })
+        self._maybe_compact()
+
+    def add_image(self, case_id, embedding):
+        """Add the embedding of an additional photo of an indexed case"""
+        if self.change_sink is not None:
+            self.change_sink('case', case_id)
+            return
+        if not self.loaded:
+            return
+        with self.lock:
+            self._add_image_row(case_id, embedding)
+        self._maybe_compact()
+
+    def remove(self, case_id):
+        """Drop a case and all its image rows"""
+        if self.change_sink is not None:
+            self.change_sink('case', case_id)
+            return
+        with self.lock:
+            self._remove_case(case_id)
+        self._maybe_compact()
+
+    def _remove_case(self, case_id):
+        rows = self.rows.pop(case_id, None)
+        if rows is None:
+            return
+        self.other_versions.discard(case_id)
+        for row in rows:
+            self._tombstone(row)
+
+    def _tombstone(self, row):
+        """Clear a row out of every mask; compaction reclaims the slot later"""
+        self.version += 1
+        self.ids[row] = TOMBSTONE
+        self.valid[row] = False
+        self.resolved[row] = False
+        self.primary[row] = False
+        for mask in self.status_masks.values():
+            mask[row] = False
+        self.tombstones += 1
+
+    # ============ COMPACTION ============
+
+    def _maybe_compact(self):
+        """Start a background compaction when tombstones pile up or spare capacity runs low"""
+        if self.compacting or self.change_sink is not None or not self.loaded:
+            return
+        free = len(self.ids) - self.size
+        crowded = self.size and self.tombstones >= self.compact_ratio * self.size
+        if crowded or free < self.spare_capacity * self.size / 4:
+            self.compacting = True
+            threading.Thread(target=self._compact_in_background, name='index-compaction', daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Embedding index compaction failed: {e}", exc_info=True)
+        finally:
+            self.compacting = False
+
+    def compact(self):
+        """Rewrite the live rows densely into new arrays with spare capacity. The copy is made
+        without the lock and swapped in only if no write happened meanwhile. Returns whether it
+        was swapped in"""
+        started = time.perf_counter()
+        for _ in range(COMPACT_ATTEMPTS):
+            with self.lock:
+                version, size, tombstones = self.version, self.size, self.tombstones
+                arrays = {name: getattr(self, name) for name in SAVED_ARRAYS}
+                status_masks = dict(self.status_masks)
+            live = np.flatnonzero(arrays['ids'][:size] != TOMBSTONE)
+            capacity = self._capacity_for(live.size)
+
+            def compacted(array):
+                packed = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+                packed[:live.size] = array[live]
+                return packed
+
+            packed = {name: compacted(array) for name, array in arrays.items()}
+            packed_masks = {status: compacted(mask) for status, mask in status_masks.items()}
+            rows = self.row_map(packed['ids'], packed['primary'], live.size)
+
+            with self.lock:
+                if self.version != version:
+                    continue
+                for name, array in packed.items():
+                    setattr(self, name, array)
+                self.status_masks = packed_masks
+                self.rows = rows
+                self.size = int(live.size)
+                self.tombstones = 0
+                self.version += 1
+            self.compactions += 1
+            self.last_compaction_seconds = round(time.perf_counter() - started, 3)
+            logger.info(
+                f"Embedding index compacted: {tombstones} tombstones reclaimed, {live.size} rows, "
+                f"capacity {capacity}, in {self.last_compaction_seconds}s"
+            )
+            return True
+        logger.info("Embedding index compaction deferred: writes kept arriving during the copy")
+        return False
+
+    def set_resolved(self, case_id, is_resolved):
+        if self.change_sink is not None:
+            self.change_sink('case', case_id)
+            return
+        with self.lock:
+            self.version += 1
+            for row in self.rows.get(case_id, ()):
+                self.resolved[row] = bool(is_resolved)
+
+    def attributes(self, case_id):
+        """Indexed status and resolution of a case, or None if it is not indexed"""
+        with self.lock:
+            rows = self.rows.get(case_id)
+            if not rows:
+                return None
+            row = rows[0]
+            status = next((value for value, mask in self.status_masks.items() if mask[row]), None)
+            return {'status': status, 'is_resolved': bool(self.resolved[row])}
+
+    def partition(self, status, is_resolved=None):
+        """Copy of (case id per vector, vectors) for every scorable row with a status"""
+        with self.lock:
+            mask = self.filter_mask(status=status, is_resolved=is_resolved)
+            rows = np.flatnonzero(mask)
+            return self.ids[rows], self.vectors[rows]
+
+    def get_vector(self, case_id):
+        """Stored (normalized) embedding of a case's primary image, or None if it is not indexed"""
+        with self.lock:
+            rows = self.rows.get(case_id)
+            if not rows or not self.valid[rows[0]]:
+                return None
+            return self.vectors[rows[0]].copy()
+
+    def _parse(self, case_id, embedding):
+        if isinstance(embedding, str):
+            try:
+                embedding = json.loads(embedding)
+            except Exception as e:
+                logger.warning(f"Error processing case {case_id}: {e}")
+                embedding = []
+        return np.asarray(embedding if embedding is not None else [], dtype=np.float32).ravel()
+
+    def _append(self, case_id, vector, embedding_version=None):
+        """Append a row for a case and return its number. Embeddings of another version are
+        kept but never scored"""
+        self.version += 1
+        if self.dim == 0 and vector.size:
+            self.dim = vector.size
+            self.vectors = np.zeros((len(self.ids), self.dim), dtype=np.float32)
+        if self.size == len(self.ids):
+            self._grow(max(1024, 2 * len(self.ids)))
+
+        row = self.size
+        self.size += 1
+        self.ids[row] = case_id
+        self.rows.setdefault(case_id, []).append(row)
+
+        # Same handling as compare_faces: truncate mismatched lengths, score zero-norm as no match
+        norm = np.linalg.norm(vector[:self.dim]) if vector.size else 0.0
+        current = embedding_version is None or embedding_version == self.embedding_version
+        if not current:
+            self.other_versions.add(case_id)
+        self.valid[row] = norm >= 1e-6 and current
+        self.vectors[row] = 0.0
+        if self.valid[row]:
+            self.vectors[row, :min(vector.size, self.dim)] = vector[:self.dim] / norm
+        if self.projection is not None:
+            self.reduced[row], self.residual[row], self.mean_dot[row] = self.projection.project(self.vectors[row])
+        return row
+
+    def _add_row(self, case):
+        row = self._append(case['id'], self._parse(case['id'], case['embedding']), case.get('embedding_version'))
+        self.primary[row] = True
+        status = case['status']
+        if status not in self.status_masks:
+            self.status_masks[status] = np.zeros(len(self.ids), dtype=bool)
+        for value, mask in self.status_masks.items():
+            mask[row] = value == status
+        self.resolved[row] = bool(case.get('is_resolved'))
+        created_at = case.get('created_at')
+        self.created_at[row] = int(created_at.timestamp()) if created_at else 0
+
+    def _add_image_row(self, case_id, embedding, embedding_version=None):
+        """Additional photos inherit the attributes of the case's primary row"""
+        rows = self.rows.get(case_id)
+        if not rows:
+            return
+        primary = rows[0]
+        row = self._append(case_id, self._parse(case_id, embedding), embedding_version)
+        self.primary[row] = False
+        for mask in self.status_masks.values():
+            mask[row] = mask[primary]
+        self.resolved[row] = self.resolved[primary]
+        self.created_at[row] = self.created_at[primary]
+
+    def _grow(self, capacity):
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+
+        self.ids = grow(self.ids)
+        self.vectors = grow(self.vectors)
+        self.valid = grow(self.valid)
+        self.resolved = grow(self.resolved)
+        self.created_at = grow(self.created_at)
+        self.primary = grow(self.primary)
+        self.reduced = grow(self.reduced)
+        self.residual = grow(self.residual)
+        self.mean_dot = grow(self.mean_dot)
+        self.status_masks = {status: grow(mask) for status, mask in self.status_masks.items()}
+
+    # ============ PERSISTENCE ============
+
+    def save(self, folder, base=None, **extra):
+        """Write the index to a new folder: one .npy file per array at full capacity (so a
+        copy-on-write mapping can append in place) plus meta.json. Returns the metadata.
+        With base, a state from read_saved() of a full save that this index adopted and still
+        holds the append-only arrays of, only the rows appended since are written for those
+        (meta['base'] names the base folder). Files are written without the lock, like
+        compact(): a write during the copy discards it"""
+        for attempt in range(SAVE_ATTEMPTS):
+            # The last attempt copies the arrays under the lock: a memory copy, far shorter than the write
+            copy = attempt == SAVE_ATTEMPTS - 1
+            with self.lock:
+                delta = self.is_delta_of(base)
+                arrays = {name: getattr(self, name) for name in SAVED_ARRAYS}
+                if delta:
+                    base_size = base['meta']['size']
+                    for name in APPEND_ONLY_ARRAYS:
+                        arrays[name] = arrays[name][base_size:self.size]
+                masks = dict(self.status_masks)
+                if copy:
+                    arrays = {name: np.array(array) for name, array in arrays.items()}
+                    masks = {status: np.array(mask) for status, mask in masks.items()}
+                projection = self.projection
+                meta = {
+                    'size': self.size,
+                    'tombstones': self.tombstones,
+                    'dim': self.dim,
+                    'cases': len(self.rows),
+                    'synced_through': self.synced_through,
+                    'images_through': self.images_through,
+                    'updated_through': self.updated_through.isoformat() if self.updated_through else None,
+                    'version': self.version,
+                    'statuses': list(masks),
+                    'embedding_version': self.embedding_version,
+                    'other_versions': sorted(self.other_versions),
+                    'saved_at': time.time(),
+                    'base': os.path.basename(base['folder']) if delta else None,
+                    'base_size': base_size if delta else None,
+                    **extra
+                }
+
+            os.makedirs(folder)
+            for name, array in arrays.items():
+                np.save(os.path.join(folder, f"{name}.npy"), array)
+            for status, mask in masks.items():
+                np.save(os.path.join(folder, f"status-{status}.npy"), mask)
+            if delta:
+                meta['projection'] = base['meta']['projection']
+            else:
+                meta['projection'] = os.path.basename(projection.save(folder)) if projection is not None else None
+            with open(os.path.join(folder, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+            with self.lock:
+                unchanged = self.version == meta['version']
+            if unchanged or copy:
+                return meta
+            shutil.rmtree(folder)
+
+    def is_delta_of(self, base):
+        """Whether the index still holds the append-only arrays and projection of a full save it
+        adopted, so that only appended rows differ from it (flags and ids change in place)"""
+        if base is None or base['meta'].get('base') or self.projection is not base['projection']:
+            return False
+        return all(getattr(self, name) is base[name] for name in APPEND_ONLY_ARRAYS) \
+            and self.size >= base['meta']['size']
+
+    @staticmethod
+    def read_saved(folder, mmap_mode='r', with_rows=True):
+        """Map a saved index without taking the lock; pass the result to adopt().
+        Without with_rows, adopt() keeps the current case -> rows map. A delta is applied onto
+        its base mapped copy-on-write, so only the pages of appended rows are private"""
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+
+        def read(name, source=folder, mode=mmap_mode):
+            return np.load(os.path.join(source, f"{name}.npy"), mmap_mode=mode)
+
+        state = {name: read(name) for name in SAVED_ARRAYS}
+        projection_folder = folder
+        if meta.get('base'):
+            base_folder = os.path.join(os.path.dirname(folder), meta['base'])
+            base_size = meta['base_size']
+            for name in APPEND_ONLY_ARRAYS:
+                appended = state[name]
+                state[name] = read(name, base_folder, 'c' if mmap_mode == 'r' else mmap_mode)
+                state[name][base_size:base_size + len(appended)] = appended
+            projection_folder = base_folder
+        state['status_masks'] = {status: read(f"status-{status}") for status in meta['statuses']}
+        state['projection'] = Projection.load(os.path.join(projection_folder, meta['projection'])) if meta['projection'] else None
+        state['meta'] = meta
+        state['folder'] = folder
+        state['rows'] = None
+        if not with_rows:
+            return state
+
+        state['rows'] = EmbeddingIndex.row_map(state['ids'], state['primary'], meta['size'])
+        return state
+
+    @staticmethod
+    def row_map(ids, primary, size):
+        """case_id -> rows, primary rows first so each case's list starts with its primary image"""
+        ids = ids[:size]
+        primary = primary[:size]
+        rows = {}
+        for row in np.flatnonzero(primary).tolist():
+            rows[int(ids[row])] = [row]
+        for row in np.flatnonzero(~primary & (ids != TOMBSTONE)).tolist():
+            rows.setdefault(int(ids[row]), []).append(row)
+        return rows
+
+    def adopt(self, state):
+        """Swap in a state produced by read_saved()"""
+        with self.lock:
+            for name in SAVED_ARRAYS:
+                setattr(self, name, state[name])
+            self.status_masks = state['status_masks']
+            self.projection = state['projection']
+            meta = state['meta']
+            if state['rows'] is not None:
+                self.rows = state['rows']
+                self.other_versions = set(meta.get('other_versions', []))
+            self.size = meta['size']
+            self.tombstones = meta.get('tombstones', 0)
+            self.dim = meta['dim']
+            self.synced_through = meta['synced_through']
+            self.images_through = meta.get('images_through', 0)
+            self.updated_through = datetime.fromisoformat(meta['updated_through']) if meta.get('updated_through') else None
+            self.version += 1
+            self.loaded = True
+            self.stale = False
+            self.last_sync = time.monotonic()
+
+    # ============ SEARCH ============
+
+    def filter_mask(self, status=None, is_resolved=None, created_from=None, created_to=None, exclude_case_id=None,
+                    start=0, end=None):
+        """Rows [start, end) eligible for scoring, combined from the precomputed attribute masks"""
+        end = self.size if end is None else end
+        mask = self.valid[start:end].copy()
+        if status:
+            status_mask = self.status_masks.get(status)
+            if status_mask is None:
+                return np.zeros(end - start, dtype=bool)
+            mask &= status_mask[start:end]
+        if is_resolved is not None:
+            mask &= self.resolved[start:end] == bool(is_resolved)
+        if created_from is not None:
+            mask &= self.created_at[start:end] >= int(created_from.timestamp())
+        if created_to is not None:
+            mask &= self.created_at[start:end] < int(created_to.timestamp())
+        if exclude_case_id is not None and exclude_case_id in self.rows:
+            excluded = np.asarray(self.rows[exclude_case_id])
+            excluded = excluded[(excluded >= start) & (excluded < end)]
+            mask[excluded - start] = False
+        return mask
+
+    def shard_bounds(self):
+        """Row ranges scored in parallel: up to `shards`, none smaller than shard_min_rows"""
+        count = min(self.shards, max(1, self.size // max(1, self.shard_min_rows)))
+        edges = np.linspace(0, self.size, count + 1).astype(np.int64)
+        return [(int(start), int(end)) for start, end in zip(edges[:-1], edges[1:])]
+
+    def search(self, query_embedding, threshold, top_k=None, exact=False, **filters):
+        """Score the query against every row passing the filters and reduce per case.
+        Large scans go through the projection first unless exact is set.
+        Returns ([(case_id, score)] best first above threshold, number of cases scored)"""
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()[:self.dim]
+        norm = np.linalg.norm(query)
+        with self.lock:
+            if self.size == 0 or norm < 1e-6:
+                return [], 0
+            # Shorter queries score against the leading dimensions only, as in compare_faces
+            unit = np.zeros(self.dim, dtype=np.float32)
+            unit[:query.size] = query / norm
+
+            multi_vector = self.size - self.tombstones > len(self.rows)
+            use_projection = self.projection is not None and not exact and self.size >= self.projection_min_rows
+            bounds = self.shard_bounds()
+            # top2_mean is not decomposable: shards then return every row and the merge reduces
+            raw_rows = multi_vector and len(bounds) > 1 and self.reduction != 'max'
+
+            def run(bound):
+                return self._search_shard(bound[0], bound[1], unit, threshold, top_k, use_projection,
+                                          multi_vector, raw_rows, filters)
+
+            if len(bounds) == 1:
+                parts = [run(bounds[0])]
+            else:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.shards, thread_name_prefix='search-shard')
+                # The lock stays held, so writers wait until every shard is done
+                parts = list(self.executor.map(run, bounds))
+
+        ids = np.concatenate([part[0] for part in parts])
+        scores = np.concatenate([part[1] for part in parts])
+        cases_scored = sum(part[2] for part in parts)
+        if len(parts) > 1:
+            if multi_vector and ids.size:
+                # A case's photos can sit in different shards
+                ids, scores = self.reduce_per_case(ids, scores, self.reduction)
+            if raw_rows:
+                keep = scores >= threshold
+                ids, scores = ids[keep], scores[keep]
+            if top_k and ids.size > top_k:
+                best = np.argpartition(-scores, top_k - 1)[:top_k]
+                ids, scores = ids[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(ids[i]), float(scores[i])) for i in order], cases_scored
+
+    def _search_shard(self, start, end, unit, threshold, top_k, use_projection, multi_vector, raw_rows, filters):
+        """Score rows [start, end). Returns (case ids, scores, cases scored): the shard's top-k
+        cases above threshold, or every row's score when raw_rows is set"""
+        rows = np.flatnonzero(self.filter_mask(start=start, end=end, **filters)) + start
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), 0
+        if rows.size == 0:
+            return empty
+        cases_scored = int(np.count_nonzero(self.primary[rows])) if multi_vector else int(rows.size)
+        if use_projection:
+            rows = self._shortlist(rows, start, end, unit, threshold, top_k)
+        if rows.size == end - start:
+            cosine = self.vectors[start:end] @ unit
+        else:
+            cosine = self.vectors[rows] @ unit
+        ids = self.ids[rows]
+        scores = self.score(cosine)
+        if raw_rows:
+            return ids, scores, cases_scored
+
+        if multi_vector:
+            ids, scores = self.reduce_per_case(ids, scores, self.reduction)
+        hits = np.flatnonzero(scores >= threshold)
+        if top_k and hits.size > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        return ids[hits], scores[hits], cases_scored
+
+    def _shortlist(self, rows, start, end, unit, threshold, top_k):
+        """First stage on the projected vectors: keep rows whose cosine can still reach the
+        threshold (an upper bound, so nothing above it is lost), capped for top-k searches"""
+        projection = self.projection
+        reduced_query, query_residual, query_mean_dot = projection.project(unit)
+        if rows.size == end - start:
+            reduced, residual, mean_dot = self.reduced[start:end], self.residual[start:end], self.mean_dot[start:end]
+        else:
+            reduced, residual, mean_dot = self.reduced[rows], self.residual[rows], self.mean_dot[rows]
+
+        approx = reduced @ reduced_query + mean_dot + (query_mean_dot - projection.mean_norm2)
+        # Small slack for float32 rounding of the bound
+        keep = np.flatnonzero(approx + residual * query_residual >= min_cosine(threshold) - 1e-4)
+        if top_k:
+            limit = max(PCA_SHORTLIST, top_k * PCA_SHORTLIST_FACTOR)
+            if keep.size > limit:
+                keep = keep[np.argpartition(-approx[keep], limit - 1)[:limit]]
+        return rows[keep]
+
+    @staticmethod
+    def reduce_per_case(ids, scores, reduction='max'):
+        """Vectorized group-by: one score per case id, the best row or the mean of the best two"""
+        order = np.lexsort((-scores, ids))
+        ids, scores = ids[order], scores[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(ids)) + 1]
+        best = scores[starts]
+        if reduction == 'top2_mean':
+            counts = np.diff(np.r_[starts, ids.size])
+            second = np.where(counts > 1, scores[np.minimum(starts + 1, ids.size - 1)], best)
+            best = (best + second) / 2
+        return ids[starts], best
+
+    @staticmethod
+    def score(cosine):
+        """Vectorized compare_faces for unit vectors: 0.6 * cosine score + 0.4 * euclidean score"""
+        cosine_score = np.maximum(0.0, (cosine + 1.0) / 2.0)
+        euclidean = np.sqrt(np.maximum(0.0, 2.0 - 2.0 * cosine))
+        euclidean_score = np.maximum(0.0, 1.0 - euclidean / SQRT2)
+        return np.clip(0.6 * cosine_score + 0.4 * euclidean_score, 0.0, 1.0)
+
+    def stats(self):
+        with self.lock:
+            primary = [rows[0] for rows in self.rows.values()]
+            return {
+                'loaded': self.loaded,
+                'cases': len(self.rows),
+                'vectors': self.size - self.tombstones,
+                'dim': self.dim,
+                'capacity': len(self.ids),
+                'tombstones': self.tombstones,
+                'tombstone_ratio': round(self.tombstones / self.size, 4) if self.size else 0.0,
+                'compactions': self.compactions,
+                'last_compaction_seconds': self.last_compaction_seconds,
+                'embedding_version': self.embedding_version,
+                'other_version_cases': len(self.other_versions),
+                'reduction': self.reduction,
+                'projection': self.projection.describe() if self.projection is not None else None,
+                'shards': len(self.shard_bounds()),
+                'memory_bytes': int(self.vectors.nbytes + self.reduced.nbytes),
+                'statuses': {status: int(mask[primary].sum()) for status, mask in self.status_masks.items()},
+                'resolved': int(self.resolved[primary].sum())
+            }
+
+
+# Global index of case embeddings
+case_index = EmbeddingIndex()
+
+
+def benchmark_shards(index, queries, shard_counts, top_k=10, threshold=0.0):
+    """Mean search time per shard count, with speedup and parallel efficiency against one shard"""
+    original = index.shards, index.shard_min_rows, index.executor
+    results = []
+    try:
+        index.shard_min_rows = 1
+        for shards in shard_counts:
+            index.shards, index.executor = shards, None
+            index.search(queries[0], threshold, top_k, exact=True)  # warm up the pool
+            started = time.perf_counter()
+            for query in queries:
+                index.search(query, threshold, top_k, exact=True)
+            elapsed_ms = 1000 * (time.perf_counter() - started) / len(queries)
+            if index.executor is not None:
+                index.executor.shutdown()
+            results.append({'shards': shards, 'ms_per_query': round(elapsed_ms, 3)})
+    finally:
+        index.shards, index.shard_min_rows, index.executor = original
+
+    baseline = results[0]
+    for result in results:
+        speedup = baseline['ms_per_query'] / result['ms_per_query']
+        result['speedup'] = round(speedup, 2)
+        result['efficiency'] = round(speedup * baseline['shards'] / result['shards'], 2)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark sharded search from 1 to N threads")
+    parser.add_argument('--shards', default=','.join(str(n) for n in (1, 2, 4, 8, 16, 32) if n <= (os.cpu_count() or 1)),
+                        help="Comma-separated shard counts (default: powers of two up to the core count)")
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help="Benchmark this many random 256-dim vectors instead of the database")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        index = EmbeddingIndex()
+        index.loaded = True
+        index.dim = 256
+        index._reset(args.synthetic, 256)
+        index.vectors[:] = rng.standard_normal((args.synthetic, 256), dtype=np.float32)
+        index.vectors /= np.linalg.norm(index.vectors, axis=1, keepdims=True)
+        index.ids[:] = np.arange(1, args.synthetic + 1)
+        index.valid[:] = True
+        index.primary[:] = True
+        index.rows = {case_id: [row] for row, case_id in enumerate(range(1, args.synthetic + 1))}
+        index.size = args.synthetic
+    else:
+        if not db.connect():
+            raise SystemExit("Could not connect to the database")
+        index = case_index
+        index.load()
+
+    queries = index.vectors[np.random.default_rng(1).integers(0, index.size, args.queries)]
+    shard_counts = sorted({int(n) for n in args.shards.split(',')})
+    print(json.dumps({'vectors': index.size, 'results': benchmark_shards(index, queries, shard_counts, args.top_k)},
+                     indent=2))
@@ -1,9 +1,12 @@
 import cv2
+import hashlib
+import inspect
 import numpy as np
 from pathlib import Path
 import logging
 import os
-from config import SIMILARITY_THRESHOLD, MODEL_NAME
+from config import SIMILARITY_THRESHOLD, MODEL_NAME, EMBEDDING_VERSION
+from perceptual_hash import compute_phash
 from scipy import ndimage
 from scipy.spatial import distance
 import imghdr
@@ -17,13 +20,43 @@ class FaceRecognitionEngine:
         self.face_cascade = cv2.CascadeClassifier(
             cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
         )
+        self.embedding_version = EMBEDDING_VERSION
+        self.fingerprint = self._fingerprint()
+    
+    def _fingerprint(self):
+        """Hash of the extractor code and the OpenCV build it runs on. Stored embeddings with
+        this version but another fingerprint mean the extractor changed without a version bump"""
+        try:
+            source = ''.join(inspect.getsource(method) for method in (self.get_face_embedding, self._get_hog_features))
+        except (OSError, TypeError):
+            return None
+        return hashlib.sha256(f"{cv2.__version__}\n{source}".encode()).hexdigest()[:12]
+    
+    def load_image(self, image):
+        """Return a BGR image array from a file path or an already-decoded array"""
+        if isinstance(image, np.ndarray):
+            return image
+        return cv2.imread(image)
+    
+    def decode_image(self, content):
+        """Decode raw image bytes into a BGR array (None if undecodable)"""
+        buffer = np.frombuffer(content, dtype=np.uint8)
+        if buffer.size == 0:
+            return None
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    
+    def _describe(self, image):
+        """Short label for log messages"""
+        if isinstance(image, np.ndarray):
+            return f"in-memory image {image.shape[1]}x{image.shape[0]}"
+        return image
     
     def detect_faces(self, image_path):
-        """Detect faces in an image using Haar Cascade"""
+        """Detect faces in an image (file path or decoded array) using Haar Cascade"""
         try:
-            img = cv2.imread(image_path)
+            img = self.load_image(image_path)
             if img is None:
-                logger.error(f"Could not read image: {image_path}")
+                logger.error(f"Could not read image: {self._describe(image_path)}")
                 return []
             
             # Convert to grayscale for detection
@@ -34,7 +67,7 @@ class FaceRecognitionEngine:
             detected_faces = [{'x': int(x), 'y': int(y), 'w': int(w), 'h': int(h)} 
                             for x, y, w, h in faces]
             
-            logger.info(f"Detected {len(detected_faces)} face(s) in {image_path}")
+            logger.info(f"Detected {len(detected_faces)} face(s) in {self._describe(image_path)}")
             return detected_faces
         except Exception as e:
             logger.error(f"Face detection error: {e}")
@@ -43,9 +76,9 @@ class FaceRecognitionEngine:
     def get_face_embedding(self, image_path):
         """Generate robust face embedding using multi-scale HOG-like features and color histograms"""
         try:
-            img = cv2.imread(image_path)
+            img = self.load_image(image_path)
             if img is None:
-                logger.error(f"Could not read image: {image_path}")
+                logger.error(f"Could not read image: {self._describe(image_path)}")
                 return [0.0] * 256
             
             # Get faces in image
@@ -53,7 +86,7 @@ class FaceRecognitionEngine:
             faces = self.face_cascade.detectMultiScale(gray, 1.1, 4, minSize=(30, 30))
             
             if len(faces) == 0:
-                logger.warning(f"No faces detected in {image_path}, using full image features")
+                logger.warning(f"No faces detected in {self._describe(image_path)}, using full image features")
                 face_region = gray
                 color_region = img
             else:
@@ -124,7 +157,7 @@ class FaceRecognitionEngine:
             if norm > 1e-6:
                 embedding = (emb_array / norm).tolist()
             
-            logger.info(f"Created robust embedding of length {len(embedding)} for {image_path}")
+            logger.info(f"Created robust embedding of length {len(embedding)} for {self._describe(image_path)}")
             return embedding
             
         except Exception as e:
@@ -280,15 +313,15 @@ class FaceRecognitionEngine:
         return matches
     
     def validate_image(self, image_path):
-        """Validate if image is a valid image file"""
+        """Validate if image is a valid image file (path or decoded array)"""
         try:
-            img = cv2.imread(image_path)
+            img = self.load_image(image_path)
             if img is None:
                 return False, 0
             
             # Try to detect faces
             try:
-                faces = self.detect_faces(image_path)
+                faces = self.detect_faces(img)
                 face_count = len(faces) if faces else 0
                 return True, max(1, face_count)
             except Exception as e:
@@ -301,3 +334,16 @@ class FaceRecognitionEngine:
 # Global face recognition engine
 face_engine = FaceRecognitionEngine()
 
+
+def analyze_image(image):
+    """Validate and embed one image (path or array); module-level so worker processes can run it"""
+    img = face_engine.load_image(image)
+    has_face, face_count = face_engine.validate_image(img)
+    if not has_face:
+        return {'has_face': False, 'face_count': 0, 'embedding': None, 'phash': None}
+    return {
+        'has_face': True,
+        'face_count': face_count,
+        'embedding': face_engine.get_face_embedding(img),
+        'phash': compute_phash(img)
+    }
@@ -0,0 +1,296 @@
+"""
+Asynchronous case ingestion
+Uploads are persisted and acknowledged with a job id straight away; a pool of
+worker processes then runs detection and embedding and the case is inserted.
+Jobs are journaled as JSON files so unfinished work is recovered on restart.
+Uvicorn workers share the journal folder: a worker holds a file lock on each job
+it owns, so a starting worker only recovers jobs whose owner has died.
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: jobs are not claimed, run a single worker
+    fcntl = None
+
+from config import (INGEST_FOLDER, INGEST_WORKERS, INGEST_MAX_QUEUE, INGEST_MAX_ATTEMPTS,
+                    INGEST_RETRY_DELAY, INGEST_JOB_RETENTION_DAYS, PHASH_DUPLICATE_ACTION)
+from cases import insert_case, find_case_by_image, find_duplicates
+from face_recognition_engine import analyze_image
+from storage import image_storage
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = 'queued'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class IngestQueue:
+    def __init__(self, folder=INGEST_FOLDER, workers=INGEST_WORKERS, max_depth=INGEST_MAX_QUEUE):
+        self.folder = folder
+        self.workers = workers
+        self.max_depth = max_depth
+        self.jobs = {}  # job_id -> job dict for queued/processing jobs
+        self.claims = {}  # job_id -> fd of the lock held on it while this process owns the job
+        self.queue = None
+        self.pool = None
+        self.tasks = []
+
+    @property
+    def depth(self):
+        """Number of jobs waiting or in progress"""
+        return len(self.jobs)
+
+    async def start(self):
+        """Start the worker pool and re-queue jobs left unfinished by a previous run"""
+        os.makedirs(self.folder, exist_ok=True)
+        self.queue = asyncio.Queue()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        recovered = self._recover()
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Ingest queue started with {self.workers} workers, {recovered} jobs recovered")
+
+    async def stop(self):
+        """Stop dispatching; unfinished jobs stay journaled for the next start"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        # Lock files stay: removing one another worker may be opening could let two claim a job
+        for job_id in list(self.claims):
+            os.close(self.claims.pop(job_id))
+        logger.info(f"Ingest queue stopped with {self.depth} unfinished jobs")
+
+    def submit(self, name, status, description, contact, upload):
+        """Persist an upload and enqueue it. Returns the job dict"""
+        if self.queue is None:
+            raise RuntimeError("Ingest queue is not running")
+        if self.depth >= self.max_depth:
+            raise QueueFullError(f"Ingest queue is full ({self.max_depth} jobs)")
+
+        image_path, _ = image_storage.store_upload(upload)
+        if not image_path:
+            raise RuntimeError("Failed to save image")
+
+        now = datetime.now().isoformat()
+        job_id = uuid.uuid4().hex
+        self._claim(job_id)  # before the journal exists, so a starting worker never recovers it
+        job = {
+            'job_id': job_id,
+            'state': QUEUED,
+            'attempts': 0,
+            'name': name,
+            'status': status,
+            'description': description,
+            'contact': contact,
+            'image_path': image_path,
+            'case_id': None,
+            'duplicate_of': None,
+            'faces_detected': None,
+            'error': None,
+            'created_at': now,
+            'updated_at': now
+        }
+        self._save(job)
+        self.jobs[job['job_id']] = job
+        self.queue.put_nowait(job['job_id'])
+        logger.info(f"Queued ingest job {job['job_id']} for {image_path} (depth {self.depth})")
+        return job
+
+    def get(self, job_id):
+        """Current state of a job (None if unknown)"""
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        return self._load(self._job_path(job_id))
+
+    async def _worker(self, worker_id):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+
+            job['state'] = PROCESSING
+            job['attempts'] += 1
+            self._save(job)
+
+            pool = self.pool
+            try:
+                # Detection and embedding run in a worker process; the insert stays on
+                # the event loop thread that owns the database connection
+                result = await loop.run_in_executor(
+                    pool, analyze_image, image_storage.absolute_path(job['image_path'])
+                )
+                if not result['has_face']:
+                    self._finish(job, FAILED, error="No face detected in the image")
+                    continue
+
+                job['faces_detected'] = result['face_count']
+                case_id = None
+                if job['attempts'] > 1:
+                    # A previous attempt may have inserted the row before dying
+                    case_id = find_case_by_image(
+                        job['image_path'], job['name'], job['contact'], job['created_at']
+                    )
+                if case_id is None:
+                    duplicates = find_duplicates(result['phash'])
+                    job['duplicate_of'] = duplicates[0][0] if duplicates else None
+                    if duplicates and PHASH_DUPLICATE_ACTION == 'reject':
+                        self._finish(job, FAILED, error=f"Duplicate of case {job['duplicate_of']}")
+                        continue
+                    case_id = insert_case(
+                        job['name'], job['status'], job['description'], job['contact'],
+                        job['image_path'], result['embedding'],
+                        phash=result['phash'], duplicate_of=job['duplicate_of']
+                    )
+                if case_id is None:
+                    raise RuntimeError("Failed to create case in database - no ID returned")
+
+                job['case_id'] = case_id
+                self._finish(job, DONE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool) and pool is self.pool:
+                    # Other workers' jobs fail on the same pool; only the first replaces it
+                    logger.error("Ingest worker pool crashed, restarting it")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._retry(job, e)
+
+    def _retry(self, job, error):
+        if job['attempts'] >= INGEST_MAX_ATTEMPTS:
+            logger.error(f"Ingest job {job['job_id']} failed after {job['attempts']} attempts: {error}")
+            self._finish(job, FAILED, error=str(error))
+            return
+
+        delay = INGEST_RETRY_DELAY * (2 ** (job['attempts'] - 1))
+        logger.warning(f"Ingest job {job['job_id']} attempt {job['attempts']} failed ({error}), retrying in {delay}s")
+        job['state'] = QUEUED
+        job['error'] = str(error)
+        self._save(job)
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, job['job_id'])
+
+    def _finish(self, job, state, error=None):
+        job['state'] = state
+        job['error'] = error
+        self._save(job)
+        self.jobs.pop(job['job_id'], None)
+        self._release(job['job_id'])
+        if state == FAILED:
+            image_storage.release(job['image_path'])
+        logger.info(f"Ingest job {job['job_id']} {state}" + (f": case {job['case_id']}" if job['case_id'] else ''))
+
+    def _recover(self):
+        """Re-queue journaled jobs that never finished and prune old finished ones"""
+        recovered = 0
+        cutoff = time.time() - INGEST_JOB_RETENTION_DAYS * 86400
+
+        for filename in sorted(os.listdir(self.folder)):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.folder, filename)
+            job = self._load(path)
+            if job is None:
+                continue
+
+            if job['state'] in (QUEUED, PROCESSING):
+                job_id = job['job_id']
+                if not self._claim(job_id):
+                    continue  # owned by a running worker
+                # Re-read under the claim: the owner may have finished it since
+                job = self._load(path)
+                if job is None or job['state'] not in (QUEUED, PROCESSING):
+                    self._release(job_id)
+                    continue
+                # A processing job was interrupted mid-flight; its attempt still counts
+                job['state'] = QUEUED
+                self._save(job)
+                self.jobs[job['job_id']] = job
+                self.queue.put_nowait(job['job_id'])
+                recovered += 1
+            elif os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+        return recovered
+
+    def _job_path(self, job_id):
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def _claim(self, job_id):
+        """Take the job's lock without waiting. False if another process holds it"""
+        if fcntl is None:
+            return True
+        fd = os.open(os.path.join(self.folder, f"{job_id}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.claims[job_id] = fd
+        return True
+
+    def _release(self, job_id):
+        """Drop the lock of a finished job"""
+        fd = self.claims.pop(job_id, None)
+        if fd is None:
+            return
+        try:
+            os.remove(os.path.join(self.folder, f"{job_id}.lock"))
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    def _save(self, job):
+        """Atomically rewrite a job's journal file"""
+        job['updated_at'] = datetime.now().isoformat()
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._job_path(job['job_id']))
+
+    def _load(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Unreadable ingest job file {path}: {e}")
+            return None
+
+    def stats(self):
+        """Queue depth and capacity"""
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'workers': self.workers,
+            'running': self.queue is not None and bool(self.tasks)
+        }
+
+
+# Global ingest queue
+ingest_queue = IngestQueue()
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
@@ -7,8 +7,15 @@ import sys
 import logging
 from datetime import datetime
 import json
+import base64
 from pathlib import Path
+from typing import List
 from contextlib import asynccontextmanager
+import asyncio
+import shutil
+import tempfile
+import time
+from email.utils import formatdate, parsedate_to_datetime
 
 # Add backend directory to path to avoid naming conflicts
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -16,7 +23,27 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 # Import custom modules
 import database as db_module
 from face_recognition_engine import face_engine
-from config import UPLOAD_FOLDER, ALLOWED_EXTENSIONS, MAX_FILE_SIZE, SIMILARITY_THRESHOLD, ADMIN_PASSWORD
+from storage import image_storage
+from cases import (insert_case, delete_case as delete_case_row, set_case_resolved, find_duplicates,
+                   add_case_image, list_case_images, notify_cases_replaced, VALID_STATUSES)
+from perceptual_hash import compute_phash, phash_index
+from embedding_index import case_index
+from crossmatch import cross_matcher, list_candidates, review_candidate, REVIEW_DECISIONS
+from shared_index import shared_index
+from change_feed import change_feed
+from search_history import search_history
+from cache import response_cache, search_cache, search_sessions, index_generation, MISSING
+from ingest import ingest_queue, QueueFullError
+from upload_reader import read_upload, MaxBodySizeMiddleware
+import metrics
+from metrics import timed, MetricsMiddleware
+from request_timing import RequestTimingMiddleware, TimedJSONResponse
+from profiler import profiler, ProfilingMiddleware
+from derivatives import derivative_store, derivative_url, DERIVATIVE_KINDS
+from config import (UPLOAD_FOLDER, ALLOWED_EXTENSIONS, SIMILARITY_THRESHOLD, ADMIN_PASSWORD,
+                    DERIVATIVE_SIZES, DERIVATIVE_CACHE_MAX_AGE, BULK_IMPORT_MAX_ARCHIVE_SIZE,
+                    UPLOAD_CHUNK_SIZE, CASES_MAX_PAGE_SIZE, SEARCH_SESSION_TTL, PHASH_DUPLICATE_ACTION,
+                    MAX_IMAGES_PER_CASE, SEARCH_REPLICA, MAX_FILE_SIZE, MULTIPART_OVERHEAD)
 
 db = db_module.db
 
@@ -50,10 +77,25 @@ async def lifespan(app: FastAPI):
     else:
         logger.error("Failed to connect to database")
     
+    await shared_index.start()
+    await change_feed.start()
+    await ingest_queue.start()
+    await search_history.start()
+    # Search replicas leave cross-matching to the primary
+    if not SEARCH_REPLICA:
+        await cross_matcher.start()
+    
     yield
     
     # Shutdown
     logger.info("Shutting down FindThem API...")
+    await cross_matcher.stop()
+    await search_history.stop()
+    await ingest_queue.stop()
+    await change_feed.stop()
+    await shared_index.stop()
+    # An open profiling window is saved rather than lost
+    await asyncio.to_thread(profiler.stop)
     db.disconnect()
 
 
@@ -62,16 +104,34 @@ app = FastAPI(
     title="FindThem - Lost and Found Person Search",
     description="AI-powered face recognition system for finding lost persons",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=TimedJSONResponse
 )
 
-# Add CORS middleware
+# Middleware added later wraps middleware added earlier; the last one added is outermost.
+
+# Marks requests for an open profiling window (a single attribute check otherwise)
+app.add_middleware(ProfilingMiddleware)
+# Reject oversized request bodies while they stream in, before they are buffered
+app.add_middleware(MaxBodySizeMiddleware, path_limits={
+    "/api/admin/import": BULK_IMPORT_MAX_ARCHIVE_SIZE,
+    # A case is created with up to MAX_IMAGES_PER_CASE photos in one form
+    "/api/upload-case": MAX_IMAGES_PER_CASE * MAX_FILE_SIZE + MULTIPART_OVERHEAD
+})
+# Outside the body limit, so rejected bodies and handler errors are counted too
+app.add_middleware(MetricsMiddleware)
+# Request id, Server-Timing header and access log; the id is set before the layers above run
+app.add_middleware(RequestTimingMiddleware)
+
+# CORS outermost: 413s from the body limit and every other response carry the CORS headers,
+# so the browser shows the real error instead of a CORS failure
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Server-Timing"]
 )
 
 # Mount static files
@@ -90,16 +150,174 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def save_uploaded_file(file_content, filename):
-    """Save uploaded file to disk"""
+async def store_face_image(image):
+    """Validate, store and embed an additional case photo. Returns (image path, embedding)"""
+    if not allowed_file(image.filename):
+        raise HTTPException(status_code=400, detail=f"Invalid file format for {image.filename}. Allowed: jpg, jpeg, png, gif, bmp")
+    
+    upload = await read_upload(image)
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        with open(filepath, 'wb') as f:
-            f.write(file_content)
-        return filepath
-    except Exception as e:
-        logger.error(f"Error saving file: {e}")
-        return None
+        with timed('decode'):
+            img = face_engine.decode_image(upload.read())
+        if img is None:
+            raise HTTPException(status_code=400, detail=f"Could not decode image {image.filename}")
+        filename, _ = image_storage.store_upload(upload)
+    finally:
+        upload.close()
+    if not filename:
+        raise HTTPException(status_code=500, detail="Failed to save image")
+    
+    with timed('detect'):
+        has_face, _ = face_engine.validate_image(img)
+    if not has_face:
+        image_storage.release(filename)
+        raise HTTPException(status_code=400, detail=f"No face detected in image {image.filename}")
+    
+    with timed('embed'):
+        embedding = face_engine.get_face_embedding(img)
+    if embedding is None:
+        image_storage.release(filename)
+        raise HTTPException(status_code=500, detail=f"Failed to process face in image {image.filename}")
+    return filename, embedding
+
+
+def encode_cursor(created_at, case_id):
+    """Opaque keyset cursor for the (created_at, id) position of the last row of a page"""
+    raw = json.dumps([created_at.isoformat() if created_at else None, case_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on malformed input"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, case_id = json.loads(raw)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(case_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def resolve_threshold(min_similarity):
+    """Similarity threshold for a search: default, 0-1 fraction or 0-100 percentage, clamped"""
+    if min_similarity is None:
+        threshold_used = SIMILARITY_THRESHOLD
+    else:
+        # Accept either 0-1 fractional value or 0-100 percentage (e.g., 99)
+        try:
+            threshold_used = float(min_similarity)
+        except Exception:
+            threshold_used = SIMILARITY_THRESHOLD
+
+        # If the caller passed a percentage (e.g., 99), normalize to 0-1
+        if threshold_used > 1.0:
+            threshold_used = threshold_used / 100.0
+
+    # Clamp to valid range
+    return max(0.0, min(1.0, threshold_used))
+
+
+def corpus_version():
+    """Cache key part for search results. The index version changes with every row added or
+    dropped, including writes picked up from other workers, replicas' generations and the CLIs"""
+    case_index.ensure_current()
+    return case_index.version
+
+
+def run_face_matching(query_embedding, threshold_used, top_k=None, status=None, is_resolved=None,
+                      created_from=None, created_to=None, exclude_case_id=None):
+    """Score a query embedding against stored cases. Returns (ranked matches, cases searched)"""
+    # Filters are applied with the index's precomputed masks, so excluded cases are never scored
+    case_index.ensure_current()
+    logger.info(f"Starting face matching with threshold {threshold_used} over {len(case_index)} indexed cases")
+    with timed('score'):
+        hits, total_searched = case_index.search(
+            query_embedding, threshold_used, top_k,
+            status=status, is_resolved=is_resolved, created_from=created_from, created_to=created_to,
+            exclude_case_id=exclude_case_id
+        )
+    if not hits:
+        logger.info(f"Face matching completed. No matches above threshold {threshold_used} in {total_searched} cases")
+        return [], total_searched
+    
+    # Only the returned matches are read back from the database
+    case_ids = [case_id for case_id, _ in hits]
+    placeholders = ', '.join(['%s'] * len(case_ids))
+    query = f"SELECT id, name, status, description, contact, image_path FROM cases WHERE id IN ({placeholders})"
+    cases = {case['id']: case for case in db.execute_query(query, tuple(case_ids)) or []}
+    
+    matches = []
+    for case_id, score in hits:
+        case = cases.get(case_id)
+        if case is None:
+            continue  # Deleted since the index was read
+        matches.append({
+            'case_id': case_id,
+            'name': case['name'],
+            'status': case['status'],
+            'description': case['description'],
+            'contact': case['contact'],
+            'image_path': case['image_path'],
+            'similarity_score': score
+        })
+    logger.info(f"Face matching completed. Found {len(matches)} matches above threshold {threshold_used}")
+    return matches, total_searched
+
+
+def build_search_response(matches, total_cases_searched, threshold_used):
+    """Search response body (without search_time) from ranked engine matches"""
+    # Prepare matches output (include both score and percentage)
+    matches_out = []
+    for m in matches:
+        score = float(m.get('similarity_score', 0.0))
+        matches_out.append({
+            'case_id': m.get('case_id'),
+            'name': m.get('name'),
+            'status': m.get('status'),
+            'contact': m.get('contact'),
+            'description': m.get('description', ''),
+            'image_path': m.get('image_path'),
+            'thumbnail_url': derivative_url(m.get('image_path')),
+            'face_url': derivative_url(m.get('image_path'), kind='face'),
+            'similarity_score': round(score, 4),
+            'similarity_percentage': round(score * 100, 2)
+        })
+
+    if matches_out:
+        # Best match is first after sorting in engine
+        best_match = matches_out[0]
+        logger.info(f"Returning best match: {best_match['name']} with {best_match['similarity_percentage']}% confidence")
+        return {
+            "success": True,
+            "message": "Matching faces found",
+            "match": best_match,
+            "matches": matches_out,
+            "total_cases_searched": total_cases_searched,
+            "threshold_used": threshold_used
+        }
+
+    logger.info("No matching face found above threshold")
+    return {
+        "success": True,
+        "message": "No matching face found",
+        "match": None,
+        "matches": [],
+        "total_cases_searched": total_cases_searched,
+        "threshold_used": threshold_used
+    }
+
+
+def log_search(query_hash, response, started, cached=False):
+    """Queue a search_history record for a search response (written in the background)"""
+    best = response.get('match')
+    search_history.record(
+        query_hash,
+        best['case_id'] if best else None,
+        best['similarity_score'] if best else None,
+        response.get('threshold_used'),
+        len(response.get('matches', [])),
+        (time.perf_counter() - started) * 1000,
+        cached
+    )
 
 
 # ============ FRONTEND ROUTES ============
@@ -136,11 +354,38 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "database": "connected" if db.connection else "disconnected"
+    """Health check endpoint: 503 when the database does not answer"""
+    started = time.perf_counter()
+    database_up = db.ping()
+    metrics.DB_UP.set(int(database_up))
+    body = {
+        "status": "healthy" if database_up else "unhealthy",
+        "database": "connected" if database_up else "disconnected",
+        "database_ms": round((time.perf_counter() - started) * 1000, 2)
     }
+    return body if database_up else JSONResponse(status_code=503, content=body)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics in the text exposition format"""
+    # Point-in-time values are read at scrape time instead of on every change
+    metrics.DB_UP.set(int(db.ping()))
+    metrics.QUEUE_DEPTH.set(ingest_queue.depth, 'ingest')
+    metrics.QUEUE_DEPTH.set(cross_matcher.queue.qsize() if cross_matcher.queue else 0, 'crossmatch')
+    metrics.QUEUE_DEPTH.set(len(search_history.queue), 'search_history')
+    for cache in (response_cache, search_cache, search_sessions.cache):
+        lookups = cache.hits + cache.misses
+        metrics.CACHE_HITS.set(cache.hits, cache.name)
+        metrics.CACHE_MISSES.set(cache.misses, cache.name)
+        metrics.CACHE_HIT_RATIO.set(round(cache.hits / lookups, 4) if lookups else 0.0, cache.name)
+        metrics.CACHE_ENTRIES.set(len(cache.entries), cache.name)
+    metrics.INDEX_CASES.set(len(case_index))
+    metrics.INDEX_VECTORS.set(case_index.size - case_index.tombstones)
+    metrics.INDEX_TOMBSTONES.set(case_index.tombstones)
+    metrics.INDEX_GENERATION.set(index_generation.value)
+    metrics.SHARED_INDEX_GENERATION.set(shared_index.generation)
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 @app.post("/api/admin/login")
@@ -180,83 +425,108 @@ async def upload_case(
     status: str = Form(...),  # "missing" or "found"
     description: str = Form(...),
     contact: str = Form(...),
-    image: UploadFile = File(...)
+    image: UploadFile = File(...),
+    additional_images: List[UploadFile] = File(default=None)
 ):
-    """Upload a new case with image"""
+    """Upload a new case with image (and optionally more photos of the same person)"""
     try:
+        additional_images = additional_images or []
         # Validate status field
-        if not status or status not in ['missing', 'found']:
+        if not status or status not in VALID_STATUSES:
             raise HTTPException(status_code=400, detail="Invalid status. Must be 'missing' or 'found'")
+        if len(additional_images) + 1 > MAX_IMAGES_PER_CASE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_IMAGES_PER_CASE} images per case")
         # Validate image file
         if not allowed_file(image.filename):
             raise HTTPException(status_code=400, detail="Invalid file format. Allowed: jpg, jpeg, png, gif, bmp")
         
-        # Read file content
-        file_content = await image.read()
-        
-        if len(file_content) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="File size exceeds maximum limit")
-        
-        # Generate unique filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
-        filename = timestamp + image.filename
-        
-        # Save file
-        filepath = save_uploaded_file(file_content, filename)
-        if not filepath:
+        # Stream the upload in chunks; size and image header are checked as it arrives
+        upload = await read_upload(image)
+        try:
+            # Decode once up front; validation and embedding reuse the array
+            with timed('decode'):
+                img = face_engine.decode_image(upload.read())
+            if img is None:
+                raise HTTPException(status_code=400, detail="Could not decode image")
+            
+            # Near-duplicate check before any detection or embedding work
+            with timed('phash'):
+                phash = compute_phash(img)
+            duplicates = find_duplicates(phash)
+            duplicate_of = duplicates[0][0] if duplicates else None
+            if duplicate_of is not None:
+                logger.info(f"Upload is a near-duplicate of case {duplicate_of} (distance {duplicates[0][1]})")
+                if PHASH_DUPLICATE_ACTION == 'reject':
+                    raise HTTPException(status_code=409, detail=f"Duplicate of existing case {duplicate_of}")
+            
+            # Store by content hash (identical photos share one file)
+            filename, content_hash = image_storage.store_upload(upload)
+        finally:
+            upload.close()
+        if not filename:
             raise HTTPException(status_code=500, detail="Failed to save image")
         
         # Validate face in image
-        has_face, face_count = face_engine.validate_image(filepath)
+        with timed('detect'):
+            has_face, face_count = face_engine.validate_image(img)
         if not has_face:
-            os.remove(filepath)
+            image_storage.release(filename)
             raise HTTPException(status_code=400, detail="No face detected in the image")
         
         # Get face embedding
-        embedding = face_engine.get_face_embedding(filepath)
+        with timed('embed'):
+            embedding = face_engine.get_face_embedding(img)
         if embedding is None:
-            os.remove(filepath)
+            image_storage.release(filename)
             raise HTTPException(status_code=500, detail="Failed to process face")
         
         logger.info(f"Got embedding, type: {type(embedding)}, length: {len(embedding) if isinstance(embedding, list) else 'N/A'}")
         
-        # Insert into database
-        query = """
-        INSERT INTO cases (name, status, description, contact, image_path, embedding, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """
-        
+        # Every additional photo must show a face before anything is written
+        extra_images = []
         try:
-            embedding_json = json.dumps(embedding)
-            logger.info(f"Embedding JSON created, length: {len(embedding_json)}")
-        except Exception as e:
-            logger.error(f"Failed to serialize embedding: {e}")
-            os.remove(filepath)
-            raise HTTPException(status_code=500, detail="Failed to serialize face data")
+            for extra in additional_images:
+                extra_images.append(await store_face_image(extra))
+        except Exception:
+            for path in [filename] + [path for path, _ in extra_images]:
+                image_storage.release(path)
+            raise
         
+        stored_paths = [filename] + [path for path, _ in extra_images]
+        
+        # Insert into database
         try:
-            case_id = db.execute_insert(
-                query,
-                (name, status, description, contact, filename, embedding_json, datetime.now())
-            )
-            logger.info(f"Insert result: case_id={case_id}")
+            case_id = insert_case(name, status, description, contact, filename, embedding,
+                                  phash=phash, duplicate_of=duplicate_of)
         except Exception as e:
             logger.error(f"Database insert failed: {e}")
-            os.remove(filepath)
+            for path in stored_paths:
+                image_storage.release(path)
             raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
         
         if case_id is None:
-            os.remove(filepath)
+            for path in stored_paths:
+                image_storage.release(path)
             raise HTTPException(status_code=500, detail="Failed to create case in database - no ID returned")
         
-        logger.info(f"Case created: {case_id}, detected {face_count} face(s)")
+        for path, extra_embedding in extra_images:
+            if add_case_image(case_id, path, extra_embedding) is None:
+                image_storage.release(path)
+        
+        logger.info(f"Case created: {case_id}, detected {face_count} face(s), {len(extra_images)} additional image(s)")
         
         return {
             "success": True,
             "message": "Case uploaded successfully",
             "case_id": case_id,
             "faces_detected": face_count,
-            "image_path": filename
+            "image_path": filename,
+            "thumbnail_url": derivative_url(filename),
+            "additional_images": len(extra_images),
+            "duplicate_of": duplicate_of,
+            "possible_duplicates": [
+                {"case_id": dup_id, "distance": distance} for dup_id, distance in duplicates[:5]
+            ]
         }
     
     except HTTPException:
@@ -266,158 +536,169 @@ async def upload_case(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/ingest/cases", status_code=202)
+async def ingest_case(
+    name: str = Form(...),
+    status: str = Form(...),  # "missing" or "found"
+    description: str = Form(...),
+    contact: str = Form(...),
+    image: UploadFile = File(...)
+):
+    """Accept a case for background processing and return a job id immediately"""
+    try:
+        if not status or status not in VALID_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status. Must be 'missing' or 'found'")
+        if not allowed_file(image.filename):
+            raise HTTPException(status_code=400, detail="Invalid file format. Allowed: jpg, jpeg, png, gif, bmp")
+        
+        upload = await read_upload(image)
+        try:
+            job = ingest_queue.submit(name, status, description, contact, upload)
+        finally:
+            upload.close()
+        
+        return {
+            "success": True,
+            "message": "Case accepted for processing",
+            "job_id": job['job_id'],
+            "state": job['state'],
+            "status_url": f"/api/ingest/jobs/{job['job_id']}"
+        }
+    except QueueFullError as e:
+        logger.warning(f"Ingest rejected: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Ingest case error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/ingest/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """Status of an ingest job"""
+    job = ingest_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return {
+        "success": True,
+        "job": {
+            'job_id': job['job_id'],
+            'state': job['state'],
+            'attempts': job['attempts'],
+            'case_id': job['case_id'],
+            'faces_detected': job['faces_detected'],
+            'duplicate_of': job.get('duplicate_of'),
+            'error': job['error'],
+            'image_path': job['image_path'],
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at']
+        },
+        "queue": ingest_queue.stats()
+    }
+
+
 @app.post("/api/search-face")
-async def search_face(image: UploadFile = File(...), min_similarity: float = Form(default=None)):
+async def search_face(
+    image: UploadFile = File(...),
+    min_similarity: float = Form(default=None),
+    top_k: int = Form(default=None),
+    status: str = Form(default=None),
+    is_resolved: bool = Form(default=None),
+    created_from: datetime = Form(default=None),
+    created_to: datetime = Form(default=None)
+):
     """Search for similar faces in the database"""
-    temp_filepath = None
+    started = time.perf_counter()
     try:
         # Validate image file
         if not allowed_file(image.filename):
             raise HTTPException(status_code=400, detail="Invalid file format")
+        if status and status not in VALID_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status. Must be 'missing' or 'found'")
         
-        # Read file content
-        file_content = await image.read()
+        threshold_used = resolve_threshold(min_similarity)
+        top_k = max(1, top_k) if top_k else None
+        filters = {
+            'status': status or None,
+            'is_resolved': is_resolved,
+            'created_from': created_from,
+            'created_to': created_to
+        }
         
-        if len(file_content) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="File size exceeds maximum limit")
+        # Stream the upload in chunks; size and image header are checked as it arrives
+        upload = await read_upload(image)
         
-        if len(file_content) == 0:
-            raise HTTPException(status_code=400, detail="File is empty")
+        # Identical searches (same photo, same parameters, unchanged corpus) are answered
+        # from the result cache without decoding, detecting or scanning anything
+        cache_key = ('search', corpus_version(), upload.digest, threshold_used, top_k, tuple(filters.values()))
+        cached = search_cache.get(cache_key)
+        if cached is not MISSING:
+            upload.close()
+            logger.info(f"Search cache hit for {upload.digest[:12]}")
+            log_search(upload.digest, cached['response'], started, cached=True)
+            return {
+                **cached['response'],
+                "cached": True,
+                "search_id": search_sessions.create(cached['embedding']),
+                "search_expires_in": SEARCH_SESSION_TTL,
+                "search_time": datetime.now().isoformat()
+            }
         
-        # Save temporary file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
-        temp_filename = "temp_" + timestamp + image.filename
-        temp_filepath = save_uploaded_file(file_content, temp_filename)
+        try:
+            # Decode straight from the buffer, no temporary file needed
+            with timed('decode'):
+                img = face_engine.decode_image(upload.read())
+        finally:
+            upload.close()
         
-        if not temp_filepath:
-            raise HTTPException(status_code=500, detail="Failed to save image")
+        if img is None:
+            raise HTTPException(status_code=400, detail="Could not decode image")
         
-        logger.info(f"Processing search image: {temp_filename}")
+        logger.info(f"Processing search image: {image.filename}")
         
-        try:
-            # Validate face in image
-            has_face, face_count = face_engine.validate_image(temp_filepath)
-            if not has_face:
-                logger.warning(f"No face detected in uploaded image: {temp_filename}")
-                raise HTTPException(status_code=400, detail="No face detected in the image")
-            
-            logger.info(f"Face detected in image (count: {face_count})")
-            
-            # Get face embedding
-            query_embedding = face_engine.get_face_embedding(temp_filepath)
-            if query_embedding is None or len(query_embedding) == 0:
-                logger.error(f"Failed to generate embedding for image: {temp_filename}")
-                raise HTTPException(status_code=500, detail="Failed to process face")
-            
-            logger.info(f"Generated embedding of length {len(query_embedding)}")
-            
-            # Get all cases from database
-            query = "SELECT id, name, status, description, contact, image_path, embedding, created_at FROM cases"
-            cases = db.execute_query(query)
-            
-            logger.info(f"Retrieved {len(cases) if cases else 0} cases from database")
-            
-            if not cases or len(cases) == 0:
-                logger.warning("No cases found in database")
-                return {
-                    "success": True,
-                    "message": "No cases in database",
-                    "match": None,
-                    "search_time": datetime.now().isoformat()
-                }
-            
-            # Prepare database embeddings
-            database_embeddings = []
-            for case in cases:
-                try:
-                    embedding = json.loads(case['embedding'])
-                    database_embeddings.append({
-                        'person_id': case['id'],
-                        'case_id': case['id'],
-                        'name': case['name'],
-                        'status': case['status'],
-                        'description': case['description'],
-                        'contact': case['contact'],
-                        'image_path': case['image_path'],
-                        'embedding': embedding,
-                        'created_at': case['created_at'].isoformat() if case['created_at'] else None
-                    })
-                except Exception as e:
-                    logger.warning(f"Error processing case {case['id']}: {e}")
-                    continue
-            
-            logger.info(f"Prepared {len(database_embeddings)} case embeddings")
-            
-            # Determine threshold to use (allow override via form field)
-            if min_similarity is None:
-                threshold_used = SIMILARITY_THRESHOLD
-            else:
-                # Accept either 0-1 fractional value or 0-100 percentage (e.g., 99)
-                try:
-                    threshold_used = float(min_similarity)
-                except Exception:
-                    threshold_used = SIMILARITY_THRESHOLD
-
-                # If the caller passed a percentage (e.g., 99), normalize to 0-1
-                if threshold_used > 1.0:
-                    threshold_used = threshold_used / 100.0
-
-            # Clamp to valid range
-            threshold_used = max(0.0, min(1.0, threshold_used))
-            logger.info(f"Starting face matching with threshold {threshold_used}")
-            matches = face_engine.find_similar_faces(
-                query_embedding,
-                database_embeddings,
-                threshold=threshold_used
-            )
-            logger.info(f"Face matching completed. Found {len(matches)} matches above threshold {threshold_used}")
-
-            # Prepare matches output (include both score and percentage)
-            matches_out = []
-            for m in matches:
-                score = float(m.get('similarity_score', 0.0))
-                matches_out.append({
-                    'case_id': m.get('case_id'),
-                    'name': m.get('name'),
-                    'status': m.get('status'),
-                    'contact': m.get('contact'),
-                    'description': m.get('description', ''),
-                    'image_path': m.get('image_path'),
-                    'similarity_score': round(score, 4),
-                    'similarity_percentage': round(score * 100, 2)
-                })
-
-            if matches_out:
-                # Best match is first after sorting in engine
-                best_match = matches_out[0]
-                logger.info(f"Returning best match: {best_match['name']} with {best_match['similarity_percentage']}% confidence")
-                return {
-                    "success": True,
-                    "message": "Matching faces found",
-                    "match": best_match,
-                    "matches": matches_out,
-                    "total_cases_searched": len(cases),
-                    "threshold_used": threshold_used,
-                    "search_time": datetime.now().isoformat()
-                }
-            else:
-                logger.info("No matching face found above threshold")
-                return {
-                    "success": True,
-                    "message": "No matching face found",
-                    "match": None,
-                    "matches": [],
-                    "total_cases_searched": len(cases),
-                    "threshold_used": threshold_used,
-                    "search_time": datetime.now().isoformat()
-                }
+        # Validate face in image
+        with timed('detect'):
+            has_face, face_count = face_engine.validate_image(img)
+        if not has_face:
+            logger.warning(f"No face detected in uploaded image: {image.filename}")
+            raise HTTPException(status_code=400, detail="No face detected in the image")
         
-        finally:
-            # Clean up temporary file
-            if temp_filepath and os.path.exists(temp_filepath):
-                os.remove(temp_filepath)
-                logger.info(f"Cleaned up temporary file: {temp_filepath}")
-    
+        logger.info(f"Face detected in image (count: {face_count})")
+        
+        # Get face embedding
+        with timed('embed'):
+            query_embedding = face_engine.get_face_embedding(img)
+        if query_embedding is None or len(query_embedding) == 0:
+            logger.error(f"Failed to generate embedding for image: {image.filename}")
+            raise HTTPException(status_code=500, detail="Failed to process face")
+        
+        logger.info(f"Generated embedding of length {len(query_embedding)}")
+        
+        matches, total_searched = run_face_matching(query_embedding, threshold_used, top_k, **filters)
+        if len(case_index) == 0:
+            logger.warning("No cases found in database")
+            log_search(upload.digest, {'threshold_used': threshold_used}, started)
+            return {
+                "success": True,
+                "message": "No cases in database",
+                "match": None,
+                "search_time": datetime.now().isoformat()
+            }
+        
+        # Keep the query embedding server-side so the search can be re-run with new parameters
+        search_id = search_sessions.create(query_embedding)
+        
+        response = build_search_response(matches, total_searched, threshold_used)
+        search_cache.set(cache_key, {'response': response, 'embedding': query_embedding})
+        log_search(upload.digest, response, started)
+        return {
+            **response,
+            "search_id": search_id,
+            "search_expires_in": SEARCH_SESSION_TTL,
+            "search_time": datetime.now().isoformat()
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -425,23 +706,103 @@ async def search_face(image: UploadFile = File(...), min_similarity: float = For
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/search-face/{search_id}")
+async def requery_search(search_id: str, min_similarity: float = None, top_k: int = None, status: str = None,
+                         is_resolved: bool = None, created_from: datetime = None, created_to: datetime = None):
+    """Re-run matching for a previous search with new parameters, without any image processing"""
+    try:
+        query_embedding = search_sessions.get(search_id)
+        if query_embedding is None:
+            raise HTTPException(status_code=404, detail="Search expired or not found; upload the photo again")
+        if status and status not in VALID_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status. Must be 'missing' or 'found'")
+        
+        threshold_used = resolve_threshold(min_similarity)
+        top_k = max(1, top_k) if top_k else None
+        
+        matches, total_searched = run_face_matching(
+            query_embedding, threshold_used, top_k, status, is_resolved, created_from, created_to
+        )
+        return {
+            **build_search_response(matches, total_searched, threshold_used),
+            "search_id": search_id,
+            "search_expires_in": SEARCH_SESSION_TTL,
+            "search_time": datetime.now().isoformat()
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Search re-query error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/api/cases")
-async def get_all_cases(status: str = None, limit: int = 50):
-    """Get all cases, optionally filtered by status"""
+async def get_all_cases(
+    status: str = None,
+    limit: int = 50,
+    cursor: str = None,
+    is_resolved: bool = None,
+    created_from: datetime = None,
+    created_to: datetime = None
+):
+    """Get cases newest first, one keyset-paginated page at a time, with optional filters"""
     try:
+        limit = max(1, min(limit, CASES_MAX_PAGE_SIZE))
+        
+        # Served from the response cache until a write invalidates it
+        cache_key = ('cases', status, limit, cursor, is_resolved, created_from, created_to)
+        cached = response_cache.get(cache_key)
+        if cached is not MISSING:
+            return cached
+        
+        # Equality filters and the created_at range use idx_status, idx_is_resolved and idx_created_at
+        conditions = []
+        params = []
         if status:
-            query = "SELECT id, name, status, description, contact, image_path, created_at FROM cases WHERE status = %s ORDER BY created_at DESC LIMIT %s"
-            cases = db.execute_query(query, (status, limit))
-        else:
-            query = "SELECT id, name, status, description, contact, image_path, created_at FROM cases ORDER BY created_at DESC LIMIT %s"
-            cases = db.execute_query(query, (limit,))
+            conditions.append("status = %s")
+            params.append(status)
+        if is_resolved is not None:
+            conditions.append("is_resolved = %s")
+            params.append(is_resolved)
+        if created_from:
+            conditions.append("created_at >= %s")
+            params.append(created_from)
+        if created_to:
+            conditions.append("created_at < %s")
+            params.append(created_to)
+        if cursor:
+            # Seek past the last row of the previous page instead of using OFFSET
+            try:
+                after_created_at, after_id = decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            conditions.append("(created_at < %s OR (created_at = %s AND id < %s))")
+            params.extend([after_created_at, after_created_at, after_id])
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""
+        SELECT id, name, status, description, contact, image_path, is_resolved, created_at
+        FROM cases {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+        """
+        # One extra row tells us whether another page exists
+        cases = db.execute_query(query, tuple(params) + (limit + 1,))
         
-        if not cases:
+        # Query errors come back as None; answer with an empty list but don't cache it
+        query_failed = cases is None
+        if query_failed:
             cases = []
         
-        return {
+        has_more = len(cases) > limit
+        cases = cases[:limit]
+        next_cursor = encode_cursor(cases[-1]['created_at'], cases[-1]['id']) if has_more else None
+        
+        response = {
             "success": True,
             "count": len(cases),
+            "has_more": has_more,
+            "next_cursor": next_cursor,
             "cases": [
                 {
                     'case_id': case['id'],
@@ -450,11 +811,18 @@ async def get_all_cases(status: str = None, limit: int = 50):
                     'description': case['description'],
                     'contact': case['contact'],
                     'image_path': case['image_path'],
+                    'thumbnail_url': derivative_url(case['image_path']),
+                    'is_resolved': bool(case['is_resolved']),
                     'created_at': case['created_at'].isoformat() if case['created_at'] else None
                 }
                 for case in cases
             ]
         }
+        if not query_failed:
+            response_cache.set(cache_key, response)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get cases error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -464,14 +832,22 @@ async def get_all_cases(status: str = None, limit: int = 50):
 async def get_case_detail(case_id: int):
     """Get detailed information about a specific case"""
     try:
-        query = "SELECT id, name, status, description, contact, image_path, created_at FROM cases WHERE id = %s"
+        cache_key = ('case', case_id)
+        cached = response_cache.get(cache_key)
+        if cached is not MISSING:
+            return cached
+        
+        query = """
+        SELECT id, name, status, description, contact, image_path, duplicate_of, created_at
+        FROM cases WHERE id = %s
+        """
         result = db.execute_query(query, (case_id,))
         
         if not result:
             raise HTTPException(status_code=404, detail="Case not found")
         
         case = result[0]
-        return {
+        response = {
             "success": True,
             "case": {
                 'case_id': case['id'],
@@ -480,9 +856,23 @@ async def get_case_detail(case_id: int):
                 'description': case['description'],
                 'contact': case['contact'],
                 'image_path': case['image_path'],
+                'thumbnail_url': derivative_url(case['image_path']),
+                'face_url': derivative_url(case['image_path'], kind='face'),
+                'duplicate_of': case['duplicate_of'],
+                'images': [
+                    {
+                        'image_id': image['id'],
+                        'image_path': image['image_path'],
+                        'thumbnail_url': derivative_url(image['image_path']),
+                        'created_at': image['created_at'].isoformat() if image['created_at'] else None
+                    }
+                    for image in list_case_images(case_id)
+                ],
                 'created_at': case['created_at'].isoformat() if case['created_at'] else None
             }
         }
+        response_cache.set(cache_key, response)
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -490,6 +880,106 @@ async def get_case_detail(case_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/cases/{case_id}/similar")
+async def find_similar_cases(case_id: int, min_similarity: float = None, top_k: int = None, status: str = None,
+                             is_resolved: bool = None, created_from: datetime = None, created_to: datetime = None):
+    """Search with the embedding already stored for a case, excluding the case itself"""
+    try:
+        if status and status not in VALID_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status. Must be 'missing' or 'found'")
+        
+        threshold_used = resolve_threshold(min_similarity)
+        top_k = max(1, top_k) if top_k else None
+        
+        cache_key = ('similar', corpus_version(), case_id, threshold_used, top_k,
+                     status, is_resolved, created_from, created_to)
+        cached = search_cache.get(cache_key)
+        if cached is not MISSING:
+            return {**cached, "cached": True, "search_time": datetime.now().isoformat()}
+        
+        case_index.ensure_current()
+        query_embedding = case_index.get_vector(case_id)
+        if query_embedding is None:
+            result = db.execute_query("SELECT embedding, embedding_version FROM cases WHERE id = %s", (case_id,))
+            if not result:
+                raise HTTPException(status_code=404, detail="Case not found")
+            if result[0]['embedding_version'] != face_engine.embedding_version:
+                # Vectors of different extractor versions are not comparable
+                raise HTTPException(status_code=409, detail="Case photo has not been re-embedded for this version yet")
+            query_embedding = json.loads(result[0]['embedding'])
+        
+        matches, total_searched = run_face_matching(
+            query_embedding, threshold_used, top_k, status, is_resolved, created_from, created_to,
+            exclude_case_id=case_id
+        )
+        response = {**build_search_response(matches, total_searched, threshold_used), "case_id": case_id}
+        search_cache.set(cache_key, response)
+        return {**response, "search_time": datetime.now().isoformat()}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Similar cases error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/cases/{case_id}/images")
+async def add_image_to_case(case_id: int, image: UploadFile = File(...), admin_password: str = Form(default='')):
+    """Attach another photo of the same person to a case (requires admin password)"""
+    try:
+        if admin_password != ADMIN_PASSWORD:
+            logger.warning(f"Unauthorized image upload attempt for case {case_id}")
+            raise HTTPException(status_code=401, detail="Unauthorized - Invalid admin password")
+        
+        if not db.execute_query("SELECT id FROM cases WHERE id = %s", (case_id,)):
+            raise HTTPException(status_code=404, detail="Case not found")
+        if len(list_case_images(case_id)) + 1 >= MAX_IMAGES_PER_CASE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_IMAGES_PER_CASE} images per case")
+        
+        filename, embedding = await store_face_image(image)
+        image_id = add_case_image(case_id, filename, embedding)
+        if image_id is None:
+            image_storage.release(filename)
+            raise HTTPException(status_code=500, detail="Failed to add image to case")
+        
+        return {
+            "success": True,
+            "message": "Image added to case",
+            "case_id": case_id,
+            "image_id": image_id,
+            "image_path": filename,
+            "thumbnail_url": derivative_url(filename)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Add case image error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/cases/{case_id}/resolve")
+async def resolve_case(case_id: int, is_resolved: bool = Form(default=True), admin_password: str = Form(default='')):
+    """Mark a case resolved, or reopen it with is_resolved=false (requires admin password)"""
+    try:
+        if admin_password != ADMIN_PASSWORD:
+            logger.warning(f"Unauthorized resolve attempt for case {case_id}")
+            raise HTTPException(status_code=401, detail="Unauthorized - Invalid admin password")
+        
+        if not set_case_resolved(case_id, is_resolved):
+            raise HTTPException(status_code=404, detail="Case not found")
+        
+        return {
+            "success": True,
+            "message": f"Case {case_id} {'resolved' if is_resolved else 'reopened'}",
+            "case_id": case_id,
+            "is_resolved": is_resolved
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Resolve case error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/cases/{case_id}/delete")
 async def delete_case(case_id: int, admin_password: str = Form(default='')):
     """Delete a case (requires admin password)"""
@@ -502,28 +992,15 @@ async def delete_case(case_id: int, admin_password: str = Form(default='')):
             logger.warning(f"Unauthorized delete attempt for case {case_id} - invalid password")
             raise HTTPException(status_code=401, detail="Unauthorized - invalid admin password")
         
-        # Get image path first
-        query = "SELECT image_path FROM cases WHERE id = %s"
-        result = db.execute_query(query, (case_id,))
-        
-        if not result:
+        # Delete from database (returns the image paths, None if the case does not exist)
+        image_paths = delete_case_row(case_id)
+        if image_paths is None:
             raise HTTPException(status_code=404, detail="Case not found")
         
-        image_path = result[0]['image_path']
-        logger.info(f"Deleting case {case_id} with image: {image_path}")
-        
-        # Delete from database
-        delete_query = "DELETE FROM cases WHERE id = %s"
-        db.execute_query(delete_query, (case_id,), commit=True)
-        logger.info(f"Case {case_id} deleted from database")
-        
-        # Delete image file
-        filepath = os.path.join(UPLOAD_FOLDER, image_path)
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-            except Exception as e:
-                logger.warning(f"Could not delete image file: {e}")
+        # Release the images; a file is removed once no other case shares it
+        for image_path in image_paths:
+            if image_storage.release(image_path):
+                derivative_store.purge(image_path)
         
         return {
             "success": True,
@@ -540,31 +1017,319 @@ async def delete_case(case_id: int, admin_password: str = Form(default='')):
 async def get_statistics():
     """Get database statistics"""
     try:
-        # Total cases
-        total_query = "SELECT COUNT(*) as count FROM cases"
-        total = db.execute_query(total_query)
+        cached = response_cache.get(('stats',))
+        if cached is not MISSING:
+            return cached
         
-        # Missing cases
-        missing_query = "SELECT COUNT(*) as count FROM cases WHERE status = 'missing'"
-        missing = db.execute_query(missing_query)
-        
-        # Found cases
-        found_query = "SELECT COUNT(*) as count FROM cases WHERE status = 'found'"
-        found = db.execute_query(found_query)
+        # One aggregated pass instead of three COUNT(*) queries
+        query = """
+        SELECT COUNT(*) AS total,
+               COALESCE(SUM(status = 'missing'), 0) AS missing,
+               COALESCE(SUM(status = 'found'), 0) AS found
+        FROM cases
+        """
+        result = db.execute_query(query)
+        counts = result[0] if result else {'total': 0, 'missing': 0, 'found': 0}
         
-        return {
+        response = {
             "success": True,
             "statistics": {
-                'total_cases': total[0]['count'] if total else 0,
-                'missing_persons': missing[0]['count'] if missing else 0,
-                'found_persons': found[0]['count'] if found else 0
+                'total_cases': int(counts['total']),
+                'missing_persons': int(counts['missing']),
+                'found_persons': int(counts['found'])
             }
         }
+        if result:
+            response_cache.set(('stats',), response)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get statistics error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/admin/cache-stats")
+async def get_cache_stats(admin_password: str = ""):
+    """Response cache hit rate and occupancy (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized cache stats request - invalid password")
+        raise HTTPException(status_code=401, detail="Invalid admin password")
+    
+    return {
+        "success": True,
+        "caches": [response_cache.stats(), search_cache.stats(), search_sessions.stats()],
+        "index_generation": index_generation.value,
+        "embedding_index": case_index.stats(),
+        "shared_index": shared_index.stats(),
+        "change_feed": change_feed.stats(),
+        "search_history": search_history.stats(),
+        "phash_index": phash_index.stats()
+    }
+
+
+# ============ CROSS-MATCHING ============
+
+@app.get("/api/admin/match-candidates")
+async def get_match_candidates(admin_password: str = "", review_status: str = "pending",
+                               min_score: float = None, limit: int = 50):
+    """Missing <-> found candidate pairs awaiting review, best first (admin only)"""
+    try:
+        if admin_password != ADMIN_PASSWORD:
+            logger.warning("Unauthorized match candidates request - invalid password")
+            raise HTTPException(status_code=401, detail="Invalid admin password")
+        if review_status not in ('pending',) + REVIEW_DECISIONS:
+            raise HTTPException(status_code=400, detail="Invalid review status")
+        
+        rows = list_candidates(review_status, min_score, max(1, min(limit, CASES_MAX_PAGE_SIZE)))
+        if rows is None:
+            raise HTTPException(status_code=500, detail="Failed to load match candidates")
+        
+        candidates = []
+        for row in rows:
+            candidates.append({
+                'candidate_id': row['id'],
+                'score': round(float(row['score']), 4),
+                'similarity_percentage': round(float(row['score']) * 100, 2),
+                'source': row['source'],
+                'review_status': row['review_status'],
+                'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+                'reviewed_at': row['reviewed_at'].isoformat() if row['reviewed_at'] else None,
+                'missing_case': {
+                    'case_id': row['missing_id'],
+                    'name': row['missing_name'],
+                    'contact': row['missing_contact'],
+                    'image_path': row['missing_image'],
+                    'thumbnail_url': derivative_url(row['missing_image'])
+                },
+                'found_case': {
+                    'case_id': row['found_id'],
+                    'name': row['found_name'],
+                    'contact': row['found_contact'],
+                    'image_path': row['found_image'],
+                    'thumbnail_url': derivative_url(row['found_image'])
+                }
+            })
+        return {"success": True, "candidates": candidates, "count": len(candidates)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get match candidates error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/admin/match-candidates/{candidate_id}/review")
+async def review_match_candidate(candidate_id: int, decision: str = Form(...), admin_password: str = Form(default='')):
+    """Confirm or reject a candidate pair (admin only)"""
+    try:
+        if admin_password != ADMIN_PASSWORD:
+            logger.warning(f"Unauthorized review attempt for match candidate {candidate_id}")
+            raise HTTPException(status_code=401, detail="Unauthorized - Invalid admin password")
+        if decision not in REVIEW_DECISIONS:
+            raise HTTPException(status_code=400, detail="Decision must be 'confirmed' or 'rejected'")
+        
+        if not review_candidate(candidate_id, decision):
+            raise HTTPException(status_code=404, detail="Match candidate not found")
+        
+        return {"success": True, "candidate_id": candidate_id, "review_status": decision}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Review match candidate error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/admin/crossmatch/run", status_code=202)
+async def run_crossmatch_sweep(admin_password: str = Form(default='')):
+    """Start a full missing x found sweep in the background (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized cross-matching sweep request - invalid password")
+        raise HTTPException(status_code=401, detail="Unauthorized - Invalid admin password")
+    if not cross_matcher.trigger_sweep():
+        raise HTTPException(status_code=409, detail="A sweep is already running")
+    return {"success": True, "message": "Cross-matching sweep started"}
+
+
+@app.get("/api/admin/crossmatch")
+async def get_crossmatch_status(admin_password: str = ""):
+    """Cross-matcher settings and the report of the last sweep (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized cross-matching status request - invalid password")
+        raise HTTPException(status_code=401, detail="Invalid admin password")
+    
+    return {"success": True, "crossmatch": cross_matcher.stats()}
+
+
+# ============ PROFILING ============
+
+@app.post("/api/admin/profiler/start", status_code=202)
+async def start_profiler(admin_password: str = Form(default=''), seconds: int = Form(default=60),
+                         sample_rate: float = Form(default=None), route: str = Form(default=None),
+                         interval_ms: float = Form(default=None)):
+    """Profile a sample of requests, or every request to one route, for a time window (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized profiler start request - invalid password")
+        raise HTTPException(status_code=401, detail="Unauthorized - Invalid admin password")
+    if route and route not in {getattr(r, 'path', None) for r in app.routes}:
+        raise HTTPException(status_code=400, detail=f"Unknown route {route}; give its path template, e.g. /api/search-face")
+    
+    try:
+        session = profiler.start(seconds, sample_rate, route or None, interval_ms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "profile": session}
+
+
+@app.post("/api/admin/profiler/stop")
+async def stop_profiler(admin_password: str = Form(default='')):
+    """Close the open profiling window early and save it (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized profiler stop request - invalid password")
+        raise HTTPException(status_code=401, detail="Unauthorized - Invalid admin password")
+    
+    summary = await asyncio.to_thread(profiler.stop)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="No profile is running on this worker")
+    return {"success": True, "profile": summary}
+
+
+@app.get("/api/admin/profiler")
+async def get_profiler_status(admin_password: str = ""):
+    """Open profiling window of this worker and the saved profiles (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized profiler status request - invalid password")
+        raise HTTPException(status_code=401, detail="Invalid admin password")
+    
+    return {"success": True, **profiler.stats(), "profiles": profiler.list_profiles()}
+
+
+@app.get("/api/admin/profiler/{profile_id}")
+async def get_profile(profile_id: str, admin_password: str = "", format: str = "summary"):
+    """A saved profile: hottest functions as JSON, or collapsed stacks for a flamegraph (admin only)"""
+    if admin_password != ADMIN_PASSWORD:
+        logger.warning("Unauthorized profile request - invalid password")
+        raise HTTPException(status_code=401, detail="Invalid admin password")
+    if format not in ('summary', 'collapsed'):
+        raise HTTPException(status_code=400, detail="Format must be 'summary' or 'collapsed'")
+    
+    if format == 'collapsed':
+        path = profiler.path(profile_id, '.collapsed')
+        if path is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return FileResponse(path, media_type="text/plain", filename=f"{profile_id}.collapsed")
+    summary = profiler.get_summary(profile_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return {"success": True, "profile": summary}
+
+
+# ============ DERIVATIVE IMAGES ============
+
+@app.get("/api/images/{kind}/{size}/{image_path:path}")
+async def get_derivative_image(kind: str, size: int, image_path: str, request: Request):
+    """Serve a cached thumbnail or face crop of an uploaded image"""
+    try:
+        if kind not in DERIVATIVE_KINDS:
+            raise HTTPException(status_code=404, detail="Unknown image kind")
+        if size not in DERIVATIVE_SIZES:
+            raise HTTPException(status_code=400, detail=f"Size must be one of {list(DERIVATIVE_SIZES)}")
+        if not derivative_store.is_safe_path(image_path):
+            raise HTTPException(status_code=400, detail="Invalid image path")
+        
+        # A cache miss decodes, detects and resizes: keep it off the event loop
+        derivative = await asyncio.to_thread(derivative_store.get, image_path, kind, size)
+        if not derivative:
+            raise HTTPException(status_code=404, detail="Image not found")
+        
+        etag = derivative_store.etag(image_path, kind, size, derivative)
+        mtime = os.path.getmtime(derivative)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(mtime, usegmt=True),
+            # Legacy originals can be replaced under the same name: revalidate those
+            "Cache-Control": (f"public, max-age={DERIVATIVE_CACHE_MAX_AGE}, immutable"
+                              if derivative_store.is_immutable(image_path) else "public, no-cache")
+        }
+        
+        # Conditional requests: If-None-Match wins over If-Modified-Since
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+                return Response(status_code=304, headers=headers)
+        elif request.headers.get("if-modified-since"):
+            try:
+                since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+                if int(mtime) <= since:
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+        
+        return FileResponse(derivative, media_type="image/jpeg", headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Derivative image error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ============ BULK IMPORT ============
+
+@app.post("/api/admin/import")
+async def bulk_import_cases(
+    admin_password: str = Form(default=''),
+    archive: UploadFile = File(default=None),
+    csv_file: UploadFile = File(default=None),
+    source_path: str = Form(default=None)
+):
+    """Import many cases from a zip archive (upload) or a server-side directory (admin only)"""
+    temp_dir = None
+    try:
+        if admin_password != ADMIN_PASSWORD:
+            logger.warning("Unauthorized bulk import attempt - invalid password")
+            raise HTTPException(status_code=401, detail="Invalid admin password")
+        
+        if archive is None and not source_path:
+            raise HTTPException(status_code=400, detail="Provide an archive upload or a source_path")
+        if source_path and not os.path.isdir(source_path):
+            raise HTTPException(status_code=400, detail="source_path must be an existing directory")
+        
+        from bulk_import import import_cases
+        
+        temp_dir = tempfile.mkdtemp(prefix='import_')
+        source = source_path
+        if archive is not None:
+            source = os.path.join(temp_dir, 'archive.zip')
+            with open(source, 'wb') as f:
+                shutil.copyfileobj(archive.file, f, UPLOAD_CHUNK_SIZE)
+        
+        csv_path = None
+        if csv_file is not None:
+            csv_path = os.path.join(temp_dir, 'cases.csv')
+            with open(csv_path, 'wb') as f:
+                shutil.copyfileobj(csv_file.file, f, UPLOAD_CHUNK_SIZE)
+        
+        # Runs on its own DB connection and process pool, off the event loop
+        report = await asyncio.to_thread(import_cases, source, csv_path)
+        
+        return {
+            "success": True,
+            "message": f"Imported {report['imported']} of {report['total_rows']} rows",
+            "report": report
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Bulk import error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
 # ============ BACKUP AND RESTORE ENDPOINTS ============
 
 @app.post("/api/backup")
@@ -645,6 +1410,8 @@ async def restore_from_backup(backup_filename: str = Form(...), admin_password:
             raise HTTPException(status_code=404, detail="Backup file not found")
         
         restore_database(backup_path)
+        notify_cases_replaced()
+        image_storage.rebuild_ref_counts()
         
         return {
             "success": True,
@@ -0,0 +1,217 @@
+"""
+Prometheus metrics
+Counters, gauges and histograms rendered in the Prometheus text format at
+/metrics. Recording one observation costs a dict lookup, a bisect over the bucket
+bounds and a few additions under an uncontended per-metric lock, so it stays out of
+search profiles. Point-in-time values (queue depths, cache and index sizes) are set
+when the endpoint is scraped rather than on every change.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from request_timing import add_timing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'  # Starlette appends the charset
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}  # label values -> value (histograms: [bucket counts, sum, count])
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value, *label_values):
+        """Gauges; for counters, mirror a total kept elsewhere (it must only grow)"""
+        self.values[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_labels(self.label_names, label_values)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.bounds = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        slot = bisect_left(self.bounds, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # One count per bucket, plus one past the last bound for +Inf
+                series = self.values[label_values] = [[0] * (len(self.bounds) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self.values.items())
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip(self.bounds + (float('inf'),), counts):
+                cumulative += bucket
+                le = _labels(self.label_names, label_values, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    """Every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# ============ METRICS ============
+
+HTTP_REQUESTS = Counter('findthem_http_requests_total', 'HTTP requests by route template and status',
+                        ['method', 'route', 'status'])
+HTTP_REQUEST_SECONDS = Histogram('findthem_http_request_duration_seconds',
+                                 'HTTP request latency until the response is sent', ['method', 'route'])
+HTTP_IN_PROGRESS = Gauge('findthem_http_requests_in_progress', 'HTTP requests being handled')
+
+ENGINE_STAGE_SECONDS = Histogram('findthem_engine_stage_seconds',
+                                 'Time spent in each stage of the face pipeline', ['stage'])
+
+DB_QUERY_SECONDS = Histogram('findthem_db_query_seconds', 'Latency of queries on the shared connection',
+                             ['kind'], buckets=DB_BUCKETS)
+DB_ERRORS = Counter('findthem_db_errors_total', 'Queries on the shared connection that failed', ['kind'])
+DB_UP = Gauge('findthem_db_up', 'Whether the database answered the last health check or scrape')
+
+UPLOADS = Counter('findthem_uploads_total', 'Uploads read in full, by detected image type', ['kind'])
+UPLOAD_BYTES = Counter('findthem_upload_bytes_total', 'Bytes of uploads read in full', ['kind'])
+
+QUEUE_DEPTH = Gauge('findthem_queue_depth', 'Work waiting in background queues', ['queue'])
+CACHE_HITS = Counter('findthem_cache_hits_total', 'Cache lookups that found a live entry', ['cache'])
+CACHE_MISSES = Counter('findthem_cache_misses_total', 'Cache lookups that found nothing', ['cache'])
+CACHE_HIT_RATIO = Gauge('findthem_cache_hit_ratio', 'Hits over lookups since startup', ['cache'])
+CACHE_ENTRIES = Gauge('findthem_cache_entries', 'Live entries per cache', ['cache'])
+INDEX_CASES = Gauge('findthem_index_cases', 'Cases in the embedding index')
+INDEX_VECTORS = Gauge('findthem_index_vectors', 'Live vectors in the embedding index')
+INDEX_TOMBSTONES = Gauge('findthem_index_tombstones', 'Deleted rows awaiting compaction')
+INDEX_GENERATION = Gauge('findthem_index_generation', 'Corpus generation; bumped by every case mutation')
+SHARED_INDEX_GENERATION = Gauge('findthem_shared_index_generation',
+                                'Index generation published (writer) or mapped (replica)')
+
+
+class timed:
+    """Context manager observing the duration of a block as an engine stage, for the
+    histogram and for the current request's Server-Timing"""
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        ENGINE_STAGE_SECONDS.observe(elapsed, self.stage)
+        add_timing(self.stage, elapsed)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and timing them by route template (not raw path)"""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = {}  # endpoint -> route template
+
+    def _route(self, scope):
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            # Unknown paths; the raw path would explode the label set
+            return 'unmatched'
+        route = self.routes.get(endpoint)
+        if route is None:
+            for candidate in scope['app'].routes:
+                # Mounts (static files) hand over to their app rather than an endpoint
+                if endpoint is getattr(candidate, 'endpoint', None) or endpoint is getattr(candidate, 'app', None):
+                    route = self.routes[endpoint] = candidate.path
+                    break
+        return route or 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def recording_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, recording_send)
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            route = self._route(scope)
+            HTTP_REQUESTS.inc(scope['method'], route, str(status))
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, scope['method'], route)
@@ -0,0 +1,107 @@
+"""
+Add perceptual hashes to an existing database
+Adds the phash and duplicate_of columns if they are missing, computes the hash of
+every case image that has none, and links each case to the oldest earlier case
+with a near-identical photo.
+
+Usage: python migrate_phash.py [--dry-run] [--relink]
+"""
+import logging
+import os
+import sys
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cv2
+
+from config import PHASH_MAX_DISTANCE
+from database import db
+from perceptual_hash import compute_phash, PerceptualHashIndex
+from storage import image_storage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COLUMNS = {
+    'phash': "ALTER TABLE cases ADD COLUMN phash BIGINT UNSIGNED NULL COMMENT '64-bit perceptual hash of the image'",
+    'duplicate_of': "ALTER TABLE cases ADD COLUMN duplicate_of INT NULL COMMENT 'Earlier case with a near-identical photo', "
+                    "ADD INDEX idx_duplicate_of (duplicate_of), "
+                    "ADD FOREIGN KEY (duplicate_of) REFERENCES cases(id) ON DELETE SET NULL"
+}
+
+
+def add_columns(dry_run=False):
+    existing = db.execute_query(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cases'"
+    ) or []
+    existing = {row['COLUMN_NAME'] for row in existing}
+    for column, statement in COLUMNS.items():
+        if column in existing:
+            continue
+        logger.info(f"Adding column cases.{column}")
+        if not dry_run and db.execute_query(statement, commit=True) is None:
+            raise RuntimeError(f"Could not add column cases.{column}")
+
+
+def migrate_phash(dry_run=False, relink=False):
+    """Backfill perceptual hashes and duplicate links"""
+    if not db.connect():
+        raise RuntimeError("Could not connect to database")
+
+    try:
+        add_columns(dry_run)
+        if dry_run and not db.execute_query(
+            "SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+            "AND TABLE_NAME = 'cases' AND COLUMN_NAME = 'phash'"
+        ):
+            logger.info("Dry run: columns are missing, nothing more to check")
+            return
+
+        cases = db.execute_query("SELECT id, image_path, phash, duplicate_of FROM cases ORDER BY id") or []
+        logger.info(f"Found {len(cases)} cases to check")
+
+        index = PerceptualHashIndex()
+        index.loaded = True
+        hashed = 0
+        linked = 0
+        unreadable = 0
+
+        # Cases are visited oldest first, so each is only linked to cases reported before it
+        for case in cases:
+            phash = int(case['phash']) if case['phash'] is not None else None
+            if phash is None:
+                img = cv2.imread(image_storage.absolute_path(case['image_path']))
+                phash = compute_phash(img)
+                if phash is None:
+                    logger.warning(f"Case {case['id']}: could not read {case['image_path']}")
+                    unreadable += 1
+                    continue
+                hashed += 1
+                if not dry_run:
+                    db.execute_query("UPDATE cases SET phash = %s WHERE id = %s", (phash, case['id']), commit=True)
+
+            if case['duplicate_of'] is None or relink:
+                matches = index.find(phash, PHASH_MAX_DISTANCE)
+                duplicate_of = matches[0][0] if matches else None
+                if duplicate_of != case['duplicate_of']:
+                    linked += duplicate_of is not None
+                    logger.info(f"Case {case['id']}: duplicate of {duplicate_of}")
+                    if not dry_run:
+                        db.execute_query(
+                            "UPDATE cases SET duplicate_of = %s WHERE id = %s",
+                            (duplicate_of, case['id']), commit=True
+                        )
+            index.add(case['id'], phash)
+
+        prefix = "Dry run: would have" if dry_run else "Migration"
+        logger.info(f"{prefix} hashed {hashed} images, linked {linked} duplicates, {unreadable} unreadable")
+    finally:
+        db.disconnect()
+
+
+if __name__ == "__main__":
+    migrate_phash(
+        dry_run='--dry-run' in sys.argv,
+        relink='--relink' in sys.argv
+    )
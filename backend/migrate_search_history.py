@@ -0,0 +1,67 @@
+"""
+Prepare an existing search_history table for write-behind search logging
+Makes query_image_path nullable (search photos are not stored) and adds the
+columns each logged search fills in: photo hash, threshold, result count,
+latency and whether the result came from the cache.
+
+Usage: python migrate_search_history.py [--dry-run]
+"""
+import logging
+import os
+import sys
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database import db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COLUMNS = {
+    'query_hash': "ALTER TABLE search_history ADD COLUMN query_hash CHAR(64) NULL "
+                  "COMMENT 'SHA-256 of the uploaded photo; search photos are not stored' AFTER query_image_path, "
+                  "ADD INDEX idx_query_hash (query_hash)",
+    'threshold_used': "ALTER TABLE search_history ADD COLUMN threshold_used FLOAT NULL AFTER similarity_score",
+    'result_count': "ALTER TABLE search_history ADD COLUMN result_count INT NULL AFTER threshold_used",
+    'latency_ms': "ALTER TABLE search_history ADD COLUMN latency_ms FLOAT NULL AFTER result_count",
+    'cached': "ALTER TABLE search_history ADD COLUMN cached BOOLEAN NOT NULL DEFAULT FALSE AFTER latency_ms"
+}
+
+
+def migrate_search_history(dry_run=False):
+    """Bring the search_history columns in line with database/schema.sql"""
+    if not db.connect():
+        raise RuntimeError("Could not connect to database")
+
+    try:
+        rows = db.execute_query(
+            "SELECT COLUMN_NAME, IS_NULLABLE FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'search_history'"
+        )
+        if not rows:
+            raise RuntimeError("Table search_history not found; create it from database/schema.sql")
+        existing = {row['COLUMN_NAME']: row['IS_NULLABLE'] for row in rows}
+
+        statements = []
+        if existing.get('query_image_path') == 'NO':
+            logger.info("Making search_history.query_image_path nullable")
+            statements.append("ALTER TABLE search_history MODIFY query_image_path VARCHAR(500) NULL")
+        for column, statement in COLUMNS.items():
+            if column not in existing:
+                logger.info(f"Adding column search_history.{column}")
+                statements.append(statement)
+
+        if dry_run:
+            logger.info(f"Dry run: would have run {len(statements)} statement(s)")
+            return
+        for statement in statements:
+            if db.execute_query(statement, commit=True) is None:
+                raise RuntimeError(f"Could not run: {statement}")
+        logger.info(f"Migration ran {len(statements)} statement(s)")
+    finally:
+        db.disconnect()
+
+
+if __name__ == "__main__":
+    migrate_search_history(dry_run='--dry-run' in sys.argv)
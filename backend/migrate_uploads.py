@@ -0,0 +1,115 @@
+"""
+Migrate legacy flat uploads into content-addressed storage
+Moves every case image (primary photos in cases, additional ones in case_images)
+to uploads/ab/cd/<sha256>.<ext>, points the row at the new path and rebuilds blob
+reference counts from both tables. Identical files collapse into one.
+
+Usage: python migrate_uploads.py [--dry-run] [--keep-originals] [--remove-orphans]
+"""
+import logging
+import os
+import sys
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database import db
+from storage import image_storage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def migrate_uploads(dry_run=False, keep_originals=False, remove_orphans=False):
+    """Rewrite legacy case images into sharded, deduplicated storage"""
+    if not db.connect():
+        raise RuntimeError("Could not connect to database")
+
+    try:
+        images = []
+        for table in ('cases', 'case_images'):
+            rows = db.execute_query(f"SELECT id, image_path FROM {table}")
+            if rows is None:
+                raise RuntimeError(f"Could not read {table}")
+            images += [(table, row['id'], row['image_path']) for row in rows]
+        logger.info(f"Found {len(images)} case images to check")
+
+        migrated = 0
+        deduplicated = 0
+        missing = 0
+        legacy_files = set()
+        kept_files = set()  # still referenced by a row that was not migrated
+        new_paths = {}
+
+        for table, row_id, image_path in images:
+            label = f"{table} {row_id}"
+
+            if image_storage.digest_from_path(image_path):
+                continue
+
+            source = image_storage.absolute_path(image_path)
+            if not os.path.exists(source):
+                logger.warning(f"Image not found for {label}: {source}")
+                missing += 1
+                continue
+
+            try:
+                with open(source, 'rb') as f:
+                    content = f.read()
+
+                digest = image_storage.content_hash(content)
+                relative_path = image_storage.relative_path(
+                    digest, image_storage.normalize_extension(image_path)
+                )
+                target = image_storage.absolute_path(relative_path)
+
+                if digest in new_paths or os.path.exists(target):
+                    deduplicated += 1
+                new_paths[digest] = relative_path
+
+                if dry_run:
+                    logger.info(f"[dry-run] {label}: {image_path} -> {relative_path}")
+                    migrated += 1
+                    continue
+
+                if not os.path.exists(target):
+                    image_storage.write_atomic(target, content)
+
+                if db.execute_query(
+                    f"UPDATE {table} SET image_path = %s WHERE id = %s",
+                    (relative_path, row_id), commit=True
+                ) is None:
+                    raise RuntimeError("database update failed")
+                legacy_files.add(image_path)
+                migrated += 1
+                logger.info(f"Migrated {label}: {image_path} -> {relative_path}")
+            except Exception as e:
+                logger.error(f"Error migrating {label}: {e}")
+                kept_files.add(image_path)
+                continue
+
+        if not dry_run:
+            image_storage.rebuild_ref_counts(remove_orphans=remove_orphans)
+
+            if not keep_originals:
+                for image_path in legacy_files - kept_files:
+                    image_storage.remove_file(image_path)
+
+        logger.info(
+            f"Migration complete: {migrated} migrated, {deduplicated} deduplicated, "
+            f"{missing} missing{' (dry run)' if dry_run else ''}"
+        )
+        if migrated and not dry_run:
+            logger.info("Older backups still reference legacy filenames; create a fresh backup now")
+
+        return {'migrated': migrated, 'deduplicated': deduplicated, 'missing': missing}
+    finally:
+        db.disconnect()
+
+
+if __name__ == "__main__":
+    migrate_uploads(
+        dry_run='--dry-run' in sys.argv,
+        keep_originals='--keep-originals' in sys.argv,
+        remove_orphans='--remove-orphans' in sys.argv
+    )
@@ -0,0 +1,196 @@
+"""
+Perceptual hashing and near-duplicate lookup
+A 64-bit DCT hash survives recompression and resizing, so a re-reported photo
+lands within a few bits of the original. Lookups use multi-index hashing: the
+hash is split into chunks with one exact-match table per chunk, and by the
+pigeonhole principle any hash within distance r agrees with the query to
+within r // chunks bits on at least one chunk.
+
+Every worker and CLI writes hashes, so the index is kept in step like the
+embedding index: cases written through this worker are applied at once, and
+rows inserted or updated elsewhere since the watermarks are applied every
+PHASH_SYNC_INTERVAL seconds. Only matches are checked against the table, so a
+case deleted elsewhere is never reported.
+"""
+import logging
+import threading
+import time
+from itertools import combinations
+
+import cv2
+import numpy as np
+
+from config import PHASH_MAX_DISTANCE, PHASH_CHUNKS, PHASH_SYNC_INTERVAL
+from database import db
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+
+def compute_phash(img):
+    """64-bit DCT perceptual hash of a BGR image array (None if the image is empty)"""
+    if img is None or img.size == 0:
+        return None
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].ravel()
+    # Median of the low frequencies without the DC term, which only tracks brightness
+    bits = low > np.median(low[1:])
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+class PerceptualHashIndex:
+    def __init__(self, chunks=PHASH_CHUNKS, sync_interval=PHASH_SYNC_INTERVAL):
+        self.chunks = chunks
+        self.sync_interval = sync_interval
+        self.chunk_bits = HASH_BITS // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.stale = False
+        self.last_sync = 0.0
+        # Watermarks: highest case id seen and the database time of the last sync
+        self.synced_through = 0
+        self.updated_through = None
+        self.hashes = {}  # case_id -> hash
+        self.tables = [{} for _ in range(chunks)]  # per chunk: chunk value -> set of case ids
+        self.probe_masks = {}  # probe radius -> XOR masks
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _split(self, value):
+        return [(value >> (i * self.chunk_bits)) & self.chunk_mask for i in range(self.chunks)]
+
+    def load(self):
+        """(Re)build the index from the cases table"""
+        started = time.perf_counter()
+        watermark = self._database_time()
+        rows = db.execute_query("SELECT id, phash FROM cases WHERE phash IS NOT NULL")
+        top = db.execute_query("SELECT COALESCE(MAX(id), 0) AS id FROM cases")
+        if rows is None or not top:
+            raise RuntimeError("Could not load perceptual hashes from database")
+        with self.lock:
+            self.hashes = {}
+            self.tables = [{} for _ in range(self.chunks)]
+            for row in rows:
+                self._add(row['id'], int(row['phash']))
+            self.synced_through = top[0]['id']
+            self.updated_through = watermark
+            self.loaded = True
+            self.stale = False
+            self.last_sync = time.monotonic()
+        logger.info(f"Perceptual hash index loaded: {len(rows)} cases in {time.perf_counter() - started:.2f}s")
+
+    def ensure_current(self):
+        """Load on first use, then periodically apply hashes written by other processes"""
+        if not self.loaded:
+            self.load()
+        elif self.stale or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def mark_stale(self):
+        """Cases were inserted without passing through add(); catch up before the next lookup"""
+        self.stale = True
+
+    @staticmethod
+    def _database_time():
+        result = db.execute_query("SELECT NOW() AS now")
+        if not result:
+            raise RuntimeError("Could not read database time")
+        return result[0]['now']
+
+    def sync(self):
+        """Apply cases inserted or updated since the watermarks. Returns the number applied"""
+        watermark = self._database_time()
+        rows = db.execute_query(
+            "SELECT id, phash FROM cases WHERE id > %s OR updated_at >= %s",
+            (self.synced_through, self.updated_through)
+        )
+        if rows is None:
+            raise RuntimeError("Could not read perceptual hash changes from database")
+        with self.lock:
+            for row in rows:
+                self._remove(row['id'])
+                if row['phash'] is not None:
+                    self._add(row['id'], int(row['phash']))
+            self.synced_through = max([self.synced_through] + [row['id'] for row in rows])
+            self.updated_through = watermark
+            self.stale = False
+            self.last_sync = time.monotonic()
+        return len(rows)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+            self.hashes = {}
+            self.tables = [{} for _ in range(self.chunks)]
+
+    def add(self, case_id, value):
+        if value is None or not self.loaded:
+            return  # picked up by the first load
+        with self.lock:
+            self._remove(case_id)
+            self._add(case_id, value)
+
+    def remove(self, case_id):
+        with self.lock:
+            self._remove(case_id)
+
+    def _add(self, case_id, value):
+        self.hashes[case_id] = value
+        for table, chunk in zip(self.tables, self._split(value)):
+            table.setdefault(chunk, set()).add(case_id)
+
+    def _remove(self, case_id):
+        value = self.hashes.pop(case_id, None)
+        if value is None:
+            return
+        for table, chunk in zip(self.tables, self._split(value)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(case_id)
+                if not bucket:
+                    del table[chunk]
+
+    def _probe_masks(self, radius):
+        """XOR masks reaching every chunk value within `radius` bits"""
+        if radius not in self.probe_masks:
+            masks = [0]
+            for flips in range(1, radius + 1):
+                for positions in combinations(range(self.chunk_bits), flips):
+                    masks.append(sum(1 << position for position in positions))
+            self.probe_masks[radius] = masks
+        return self.probe_masks[radius]
+
+    def find(self, value, max_distance=PHASH_MAX_DISTANCE):
+        """Cases whose hash is within max_distance bits, as [(case_id, distance)] closest first
+        (oldest case first on ties)"""
+        masks = self._probe_masks(max_distance // self.chunks)
+        candidates = set()
+        with self.lock:
+            for table, chunk in zip(self.tables, self._split(value)):
+                for mask in masks:
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+            hashes = self.hashes
+            matches = [(case_id, (value ^ hashes[case_id]).bit_count()) for case_id in candidates]
+        return sorted(
+            ((case_id, distance) for case_id, distance in matches if distance <= max_distance),
+            key=lambda match: (match[1], match[0])
+        )
+
+    def stats(self):
+        with self.lock:
+            return {
+                'loaded': self.loaded,
+                'cases': len(self.hashes),
+                'chunks': self.chunks,
+                'buckets': sum(len(table) for table in self.tables)
+            }
+
+
+# Global perceptual hash index
+phash_index = PerceptualHashIndex()
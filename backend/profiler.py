@@ -0,0 +1,261 @@
+"""
+On-demand sampling profiler for production requests
+An admin opens a profiling window on one worker. Requests arriving during the window
+are marked: a random sample of them, or every request to one route. A background
+thread reads the event loop thread's stack every PROFILE_INTERVAL_MS and keeps the
+sample when a marked request is the one running at that moment, cut at the request's
+own frame. Samples are aggregated as collapsed stacks, the input format of
+flamegraph.pl and speedscope, and saved with a summary of the hottest functions.
+
+Unlike cProfile, sampling adds nothing to the profiled code and attributes time
+correctly while requests interleave on the event loop. With no window open there
+is no thread, and the middleware only checks one attribute. Work a request hands to
+another thread (asyncio.to_thread, sharded scoring) shows up as the frame that waits
+for it.
+"""
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from starlette.routing import Match
+
+from config import PROFILE_FOLDER, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS, PROFILE_KEEP
+
+logger = logging.getLogger(__name__)
+
+TOP_FUNCTIONS = 25
+PROFILE_ID_PATTERN = re.compile(r'^\d{8}-\d{6}-\d+-[0-9a-f]{6}$')
+
+
+def route_template(scope):
+    """Path template of the route a request will be dispatched to ('unmatched' if none)"""
+    for route in scope['app'].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class ProfileSession:
+    def __init__(self, seconds, sample_rate, route, interval_ms):
+        self.profile_id = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.seconds = seconds
+        self.sample_rate = sample_rate
+        self.route = route
+        self.interval_ms = interval_ms
+        self.started_at = datetime.now()
+        self.ends_at = time.monotonic() + seconds
+        self.stopped = threading.Event()
+        self.frames = {}  # outermost frame of a marked request in flight -> its route
+        self.stacks = Counter()  # collapsed stack -> samples
+        self.samples = 0
+        self.requests_seen = 0
+        self.requests_profiled = 0
+
+    def wants(self, route):
+        """Whether to profile a request to this route"""
+        if self.route is not None and route != self.route:
+            return False
+        self.requests_seen += 1
+        return random.random() < self.sample_rate
+
+    def describe(self):
+        return {
+            'profile_id': self.profile_id,
+            'pid': os.getpid(),
+            'route': self.route,
+            'sample_rate': self.sample_rate,
+            'interval_ms': self.interval_ms,
+            'started_at': self.started_at.isoformat(),
+            'seconds': self.seconds,
+            'remaining_seconds': max(0, round(self.ends_at - time.monotonic(), 1)) if not self.stopped.is_set() else 0,
+            'requests_seen': self.requests_seen,
+            'requests_profiled': self.requests_profiled,
+            'samples': self.samples,
+            'sampled_seconds': round(self.samples * self.interval_ms / 1000, 3)
+        }
+
+
+class SamplingProfiler:
+    def __init__(self, folder=PROFILE_FOLDER, interval_ms=PROFILE_INTERVAL_MS, max_seconds=PROFILE_MAX_SECONDS,
+                 keep=PROFILE_KEEP):
+        self.folder = folder
+        self.interval_ms = interval_ms
+        self.max_seconds = max_seconds
+        self.keep = keep
+        self.session = None  # open window, None when idle
+        self.thread = None
+        self.loop_thread = None  # ident of the thread running the event loop
+        self.lock = threading.Lock()
+        self.last = None  # summary of the most recently saved profile
+
+    def start(self, seconds, sample_rate=None, route=None, interval_ms=None):
+        """Open a profiling window; call from the event loop. Returns the session description"""
+        if sample_rate is None:
+            sample_rate = 1.0 if route else 0.1
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1]")
+        if seconds <= 0:
+            raise ValueError("seconds must be positive")
+        interval_ms = max(1.0, float(interval_ms or self.interval_ms))
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError(f"Profile {self.session.profile_id} is already running")
+            session = ProfileSession(min(seconds, self.max_seconds), sample_rate, route, interval_ms)
+            self.loop_thread = threading.get_ident()
+            self.session = session
+        self.thread = threading.Thread(target=self._sample, args=(session,), name='profiler', daemon=True)
+        self.thread.start()
+        logger.info(f"Profiling {'every request to ' + route if route else 'a sample of requests'} "
+                    f"(rate {sample_rate}) for {session.seconds}s as {session.profile_id}")
+        return session.describe()
+
+    def stop(self):
+        """Close the open window now and save it. Returns its summary (None if none was open)"""
+        session, thread = self.session, self.thread
+        if session is None:
+            return None
+        session.stopped.set()
+        thread.join()
+        return self.last
+
+    def _sample(self, session):
+        interval = session.interval_ms / 1000
+        try:
+            while not session.stopped.wait(interval) and time.monotonic() < session.ends_at:
+                if not session.frames:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                path = []
+                while frame is not None:
+                    route = session.frames.get(frame)
+                    if route is not None:
+                        # Cut at the request's own frame: everything above it is the event loop
+                        path.append(route)
+                        session.stacks[';'.join(reversed(path))] += 1
+                        session.samples += 1
+                        break
+                    path.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+        except Exception as e:
+            logger.error(f"Profiler sampling failed: {e}", exc_info=True)
+        finally:
+            session.stopped.set()
+            with self.lock:
+                if self.session is session:
+                    self.session = None
+            try:
+                self.last = self._save(session)
+            except Exception as e:
+                logger.error(f"Could not save profile {session.profile_id}: {e}")
+
+    def _save(self, session):
+        """Write the collapsed stacks and a summary of the hottest functions"""
+        os.makedirs(self.folder, exist_ok=True)
+        own, total = Counter(), Counter()
+        for stack, count in session.stacks.items():
+            functions = stack.split(';')[1:]
+            if functions:
+                own[functions[-1]] += count
+            for function in set(functions):  # recursion counts once per sample
+                total[function] += count
+
+        def top(counter):
+            return [{'function': function, 'samples': count,
+                     'percent': round(100 * count / session.samples, 2)}
+                    for function, count in counter.most_common(TOP_FUNCTIONS)]
+
+        summary = {**session.describe(), 'top_self': top(own), 'top_total': top(total)}
+        base = os.path.join(self.folder, session.profile_id)
+        with open(base + '.collapsed', 'w') as f:
+            for stack, count in session.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(base + '.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Profile {session.profile_id} saved: {session.samples} samples from "
+                    f"{session.requests_profiled} requests")
+
+        for stale in self.list_profiles()[self.keep:]:
+            for extension in ('.collapsed', '.json'):
+                try:
+                    os.remove(os.path.join(self.folder, stale['profile_id'] + extension))
+                except FileNotFoundError:
+                    pass
+        return summary
+
+    # ============ SAVED PROFILES ============
+
+    def list_profiles(self):
+        """Summaries of saved profiles (without the function tables), newest first"""
+        if not os.path.isdir(self.folder):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.folder), reverse=True):
+            if name.endswith('.json') and PROFILE_ID_PATTERN.match(name[:-5]):
+                summary = self.get_summary(name[:-5])
+                if summary is not None:
+                    profiles.append({k: v for k, v in summary.items() if not k.startswith('top_')})
+        return profiles
+
+    def get_summary(self, profile_id):
+        path = self.path(profile_id, '.json')
+        if path is None:
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def path(self, profile_id, extension):
+        """File of a saved profile, or None for an unknown (or unsafe) id"""
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        path = os.path.join(self.folder, profile_id + extension)
+        return path if os.path.exists(path) else None
+
+    def stats(self):
+        return {
+            'running': self.session.describe() if self.session is not None else None,
+            'last': {k: v for k, v in self.last.items() if not k.startswith('top_')} if self.last else None
+        }
+
+
+# Global profiler of this worker
+profiler = SamplingProfiler()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware marking the requests an open profiling window should sample"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        session = profiler.session
+        if session is None or scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope)
+        if not session.wants(route):
+            await self.app(scope, receive, send)
+            return
+
+        # This coroutine's frame sits at the top of the request's stack while it runs
+        frame = sys._getframe()
+        session.frames[frame] = route
+        session.requests_profiled += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session.frames.pop(frame, None)
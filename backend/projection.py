@@ -0,0 +1,205 @@
+"""
+PCA projection of case embeddings for a fast first-stage scan
+The hand-crafted embedding has many correlated and near-constant dimensions, so a
+few dozen principal components carry almost all of its variance. Searches score
+the projected vectors first and re-rank only the shortlist with the full score.
+For unit vectors v and q with corpus mean m and projection P:
+
+    v.q = P(v-m).P(q-m) + r_v.r_q + m.v + m.q - m.m
+
+where r are the residuals outside the kept components, so |r_v| * |r_q| bounds
+the error of the first stage and threshold searches lose no matches.
+
+Usage: python projection.py fit [--dims 48] [--report]
+       python projection.py report [--queries 200] [--top-k 10] [--noise 0.05]
+"""
+import glob
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+# Add backend to path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config import PCA_PROJECTION, PCA_FOLDER, PCA_DIMS
+
+logger = logging.getLogger(__name__)
+
+
+class Projection:
+    def __init__(self, mean, components, explained_variance_ratio, version, fitted_on):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)  # dims x input_dim
+        self.explained_variance_ratio = np.asarray(explained_variance_ratio, dtype=np.float64)
+        self.version = version
+        self.fitted_on = int(fitted_on)
+        self.mean_norm2 = float(self.mean @ self.mean)
+
+    @property
+    def dims(self):
+        return self.components.shape[0]
+
+    @property
+    def input_dim(self):
+        return self.components.shape[1]
+
+    def project(self, vectors):
+        """Reduced coordinates, per-vector residual norms and dot products with the mean"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        centered = vectors - self.mean
+        reduced = centered @ self.components.T
+        residual2 = np.einsum('...i,...i->...', centered, centered) - np.einsum('...i,...i->...', reduced, reduced)
+        residual = np.sqrt(np.maximum(residual2, 0.0))
+        return reduced, residual, vectors @ self.mean
+
+    def save(self, folder=PCA_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"pca-{self.version}.npz")
+        np.savez(
+            path, mean=self.mean, components=self.components,
+            explained_variance_ratio=self.explained_variance_ratio,
+            version=self.version, fitted_on=self.fitted_on
+        )
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'], data['explained_variance_ratio'],
+                       str(data['version']), int(data['fitted_on']))
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'dims': self.dims,
+            'input_dim': self.input_dim,
+            'fitted_on': self.fitted_on,
+            'explained_variance': round(float(self.explained_variance_ratio.sum()), 4)
+        }
+
+
+def fit_projection(vectors, dims=PCA_DIMS):
+    """Fit a PCA projection on unit vectors (rows). The covariance is accumulated in
+    chunks, so the corpus is never copied as float64"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) < 2:
+        raise ValueError("Need at least two vectors to fit a projection")
+    dims = min(dims, vectors.shape[1])
+
+    mean = vectors.mean(axis=0, dtype=np.float64)
+    covariance = np.zeros((vectors.shape[1], vectors.shape[1]), dtype=np.float64)
+    for start in range(0, len(vectors), 65536):
+        chunk = vectors[start:start + 65536].astype(np.float64) - mean
+        covariance += chunk.T @ chunk
+    covariance /= len(vectors) - 1
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues = np.maximum(eigenvalues[order], 0.0)
+    total = eigenvalues.sum()
+    ratio = eigenvalues[:dims] / total if total > 0 else np.zeros(dims)
+    components = eigenvectors[:, order[:dims]].T
+
+    version = time.strftime('%Y%m%d%H%M%S')
+    return Projection(mean, components, ratio, version, len(vectors))
+
+
+def latest_artifact(folder=PCA_FOLDER):
+    paths = sorted(glob.glob(os.path.join(folder, 'pca-*.npz')))
+    return paths[-1] if paths else None
+
+
+def load_projection(setting=PCA_PROJECTION):
+    """Projection selected by PCA_PROJECTION: '' disables, 'latest' is the newest artifact,
+    anything else is a path. None when disabled or nothing has been fitted yet"""
+    if not setting:
+        return None
+    path = latest_artifact() if setting == 'latest' else setting
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return Projection.load(path)
+    except Exception as e:
+        logger.error(f"Could not load projection {path}: {e}")
+        return None
+
+
+def evaluate(index, queries, top_k=10, threshold=0.0):
+    """Time exact and two-stage searches of the same queries and compare their rankings"""
+    exact_times, fast_times, recalls, top1 = [], [], [], []
+    for query in queries:
+        started = time.perf_counter()
+        exact, _ = index.search(query, threshold, top_k, exact=True)
+        exact_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        fast, _ = index.search(query, threshold, top_k)
+        fast_times.append(time.perf_counter() - started)
+
+        expected = {case_id for case_id, _ in exact}
+        if expected:
+            recalls.append(len(expected & {case_id for case_id, _ in fast}) / len(expected))
+            top1.append(bool(fast) and fast[0][0] == exact[0][0])
+
+    exact_ms = 1000 * float(np.mean(exact_times))
+    fast_ms = 1000 * float(np.mean(fast_times))
+    return {
+        'projection': index.projection.describe() if index.projection else None,
+        'vectors': index.size - index.tombstones,
+        'queries': len(queries),
+        'top_k': top_k,
+        'exact_ms': round(exact_ms, 3),
+        'two_stage_ms': round(fast_ms, 3),
+        'speedup': round(exact_ms / fast_ms, 2) if fast_ms else None,
+        'recall_at_k': round(float(np.mean(recalls)), 4) if recalls else None,
+        'top1_agreement': round(float(np.mean(top1)), 4) if top1 else None
+    }
+
+
+def sample_queries(index, count, noise, seed=0):
+    """Corpus vectors with Gaussian noise, standing in for new photos of indexed people"""
+    rng = np.random.default_rng(seed)
+    rows = np.flatnonzero(index.valid[:index.size])
+    picked = index.vectors[rng.choice(rows, size=min(count, rows.size), replace=False)]
+    return picked + rng.normal(0.0, noise, picked.shape).astype(np.float32)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from database import db
+    from embedding_index import case_index
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Fit and evaluate the PCA first-stage projection")
+    parser.add_argument('command', choices=['fit', 'report'])
+    parser.add_argument('--dims', type=int, default=PCA_DIMS)
+    parser.add_argument('--report', action='store_true', help="Evaluate the new projection after fitting")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--noise', type=float, default=0.05)
+    args = parser.parse_args()
+
+    if not db.connect():
+        sys.exit("Could not connect to the database")
+    case_index.load()
+
+    if args.command == 'fit':
+        vectors = case_index.vectors[:case_index.size][case_index.valid[:case_index.size]]
+        projection = fit_projection(vectors, args.dims)
+        path = projection.save()
+        print(json.dumps({**projection.describe(), 'path': path}, indent=2))
+        if not args.report:
+            sys.exit(0)
+        case_index.set_projection(projection)
+
+    if case_index.projection is None:
+        sys.exit("No projection fitted yet; run: python projection.py fit")
+    # Always take the two-stage path, whatever the corpus size
+    case_index.projection_min_rows = 0
+    queries = sample_queries(case_index, args.queries, args.noise)
+    print(json.dumps(evaluate(case_index, queries, args.top_k), indent=2))
@@ -1,64 +1,273 @@
-import mysql.connector
-from config import DB_CONFIG
+"""
+Re-embed the cases whose stored embeddings come from another extractor version
+Rows whose embedding_version differs from EMBEDDING_VERSION are embedded again and
+staged in case_embeddings, one committed batch at a time, so an interrupted run
+resumes where it stopped. The API keeps serving the stored embeddings meanwhile, and
+processes already running the new version search the staged ones. Once every server
+runs the new version, cutover copies the staged embeddings into cases and case_images.
+
+Usage: python regenerate_embeddings.py run [--batch 200] [--workers N]
+       python regenerate_embeddings.py status
+       python regenerate_embeddings.py cutover
+"""
 import json
 import logging
-import sys
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 # Add backend to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+import mysql.connector
+
+from config import DB_CONFIG, EMBEDDING_VERSION, REEMBED_BATCH, REEMBED_WORKERS
+from change_feed import record_change, CASE_REEMBEDDED, EMBEDDINGS_CUTOVER
 from face_recognition_engine import face_engine
+from storage import image_storage
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def regenerate_embeddings():
-    """Regenerate embeddings for all cases"""
+# Databases created before embeddings were versioned; existing rows get version 1
+COLUMNS = {
+    'cases': [
+        ('embedding_version', "ALTER TABLE cases ADD COLUMN embedding_version SMALLINT NOT NULL DEFAULT 1 AFTER embedding"),
+        ('embedding_fingerprint', "ALTER TABLE cases ADD COLUMN embedding_fingerprint CHAR(12) NULL AFTER embedding_version")
+    ],
+    'case_images': [
+        ('embedding_version', "ALTER TABLE case_images ADD COLUMN embedding_version SMALLINT NOT NULL DEFAULT 1 AFTER embedding"),
+        ('embedding_fingerprint', "ALTER TABLE case_images ADD COLUMN embedding_fingerprint CHAR(12) NULL AFTER embedding_version")
+    ]
+}
+STAGING_TABLE = """
+CREATE TABLE IF NOT EXISTS case_embeddings (
+    case_id INT NOT NULL,
+    image_id INT NOT NULL DEFAULT 0,
+    embedding_version SMALLINT NOT NULL,
+    embedding_fingerprint CHAR(12) NULL,
+    embedding LONGTEXT NOT NULL,
+    staged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (case_id, image_id, embedding_version),
+    FOREIGN KEY (case_id) REFERENCES cases(id) ON DELETE CASCADE,
+    INDEX idx_version_staged (embedding_version, staged_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+
+def ensure_schema(connection):
+    """Add the version columns and the staging table if they are missing"""
+    cursor = connection.cursor()
     try:
-        # Connect to database
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        # Get all cases
-        cursor.execute("SELECT id, image_path FROM cases")
-        cases = cursor.fetchall()
-        
-        logger.info(f"Found {len(cases)} cases to regenerate embeddings for")
-        
-        for case in cases:
-            try:
-                case_id = case['id']
-                image_path = case['image_path']
-                
-                # Full path to image
-                full_path = os.path.join('uploads', image_path)
-                
-                if not os.path.exists(full_path):
-                    logger.warning(f"Image not found for case {case_id}: {full_path}")
-                    continue
-                
-                # Generate new embedding
-                embedding = face_engine.get_face_embedding(full_path)
-                embedding_json = json.dumps(embedding)
-                
-                # Update database
-                update_query = "UPDATE cases SET embedding = %s WHERE id = %s"
-                cursor.execute(update_query, (embedding_json, case_id))
-                conn.commit()
-                
-                logger.info(f"Updated embedding for case {case_id}")
-            except Exception as e:
-                logger.error(f"Error processing case {case['id']}: {e}")
-                continue
-        
-        logger.info("Embedding regeneration complete!")
+        for table, columns in COLUMNS.items():
+            cursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                (table,)
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            for column, statement in columns:
+                if column not in existing:
+                    logger.info(f"Adding column {table}.{column}")
+                    cursor.execute(statement)
+        cursor.execute(STAGING_TABLE)
+        connection.commit()
+    finally:
         cursor.close()
-        conn.close()
-        
-    except Exception as e:
-        logger.error(f"Error: {e}")
+
+
+def pending_query(source, select):
+    """Rows of a source ('case' or 'image') embedded by another version and not staged yet, as `c`"""
+    if source == 'case':
+        return f"""
+        SELECT {select} FROM cases c
+        LEFT JOIN case_embeddings s ON s.case_id = c.id AND s.image_id = 0 AND s.embedding_version = %s
+        WHERE c.embedding_version <> %s AND s.case_id IS NULL
+        """
+    return f"""
+    SELECT {select} FROM case_images c
+    LEFT JOIN case_embeddings s ON s.case_id = c.case_id AND s.image_id = c.id AND s.embedding_version = %s
+    WHERE c.embedding_version <> %s AND s.case_id IS NULL
+    """
+
+
+SELECT_PENDING = {
+    'case': "c.id, c.id AS case_id, 0 AS image_id, c.image_path",
+    'image': "c.id, c.case_id, c.id AS image_id, c.image_path"
+}
+
+
+def embed_image(image_path):
+    """Embedding of one stored image with this extractor (None if unreadable); runs in a worker process"""
+    img = face_engine.load_image(image_storage.absolute_path(image_path))
+    if img is None:
+        return None
+    return face_engine.get_face_embedding(img)
+
+
+def fetch(connection, query, params):
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def stage(connection, staged):
+    """Store one batch of (case_id, image_id, embedding) and commit it: the checkpoint"""
+    if not staged:
+        return
+    cursor = connection.cursor()
+    try:
+        # INSERT ... SELECT skips cases deleted since the batch was read
+        cursor.executemany(
+            """
+            INSERT INTO case_embeddings (case_id, image_id, embedding_version, embedding_fingerprint, embedding)
+            SELECT id, %s, %s, %s, %s FROM cases WHERE id = %s
+            ON DUPLICATE KEY UPDATE embedding = VALUES(embedding), embedding_fingerprint = VALUES(embedding_fingerprint)
+            """,
+            [(image_id, EMBEDDING_VERSION, face_engine.fingerprint, json.dumps(embedding), case_id)
+             for case_id, image_id, embedding in staged]
+        )
+        # Search replicas refresh these cases; those on the new version pick the staged rows up
+        record_change(CASE_REEMBEDDED, sorted({case_id for case_id, _, _ in staged}), cursor=cursor,
+                      embedding_version=EMBEDDING_VERSION)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def reembed(batch_size=REEMBED_BATCH, workers=REEMBED_WORKERS):
+    """Stage new embeddings for every row of another version. Returns a report"""
+    started = time.perf_counter()
+    report = {'embedding_version': EMBEDDING_VERSION, 'fingerprint': face_engine.fingerprint,
+              'staged': 0, 'unreadable': []}
+    connection = mysql.connector.connect(**DB_CONFIG)
+    try:
+        ensure_schema(connection)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for source, select in SELECT_PENDING.items():
+                query = pending_query(source, select) + " AND c.id > %s ORDER BY c.id LIMIT %s"
+                after = 0
+                while True:
+                    rows = fetch(connection, query, (EMBEDDING_VERSION, EMBEDDING_VERSION, after, batch_size))
+                    if not rows:
+                        break
+                    after = rows[-1]['id']
+                    embeddings = list(pool.map(embed_image, [row['image_path'] for row in rows]))
+                    staged = []
+                    for row, embedding in zip(rows, embeddings):
+                        if embedding is None:
+                            logger.warning(f"Case {row['case_id']}: could not read {row['image_path']}")
+                            report['unreadable'].append(row['image_path'])
+                        else:
+                            staged.append((row['case_id'], row['image_id'], embedding))
+                    stage(connection, staged)
+                    report['staged'] += len(staged)
+                    logger.info(f"Re-embedded {report['staged']} rows so far ({source} id {after})")
+    finally:
+        connection.close()
+    report['elapsed_seconds'] = round(time.perf_counter() - started, 2)
+    logger.info(f"Re-embedding done: {report['staged']} staged, {len(report['unreadable'])} unreadable")
+    return report
+
+
+def status():
+    """Rows per stored version and fingerprint, staged rows, and rows still to re-embed"""
+    connection = mysql.connector.connect(**DB_CONFIG)
+    try:
+        ensure_schema(connection)
+        report = {'embedding_version': EMBEDDING_VERSION, 'fingerprint': face_engine.fingerprint}
+        for table in ('cases', 'case_images'):
+            report[table] = fetch(connection, f"""
+                SELECT embedding_version, embedding_fingerprint, COUNT(*) AS count FROM {table}
+                GROUP BY embedding_version, embedding_fingerprint ORDER BY embedding_version
+            """, ())
+        report['staged'] = fetch(connection, """
+            SELECT embedding_version, COUNT(*) AS count, MAX(staged_at) AS last_staged_at FROM case_embeddings
+            GROUP BY embedding_version ORDER BY embedding_version
+        """, ())
+        report['pending'] = {
+            source: fetch(connection, pending_query(source, "COUNT(*) AS count"),
+                          (EMBEDDING_VERSION, EMBEDDING_VERSION))[0]['count']
+            for source in SELECT_PENDING
+        }
+        drifted = sum(
+            row['count'] for table in ('cases', 'case_images') for row in report[table]
+            if row['embedding_version'] == EMBEDDING_VERSION
+            and row['embedding_fingerprint'] not in (None, face_engine.fingerprint)
+        )
+        if drifted:
+            report['warning'] = (f"{drifted} rows have version {EMBEDDING_VERSION} but another extractor "
+                                 f"fingerprint: bump EMBEDDING_VERSION if get_face_embedding changed")
+        return report
+    finally:
+        connection.close()
+
+
+def cutover(batch_size=REEMBED_BATCH, workers=REEMBED_WORKERS):
+    """Catch up on rows added since the last run, then copy every staged embedding into
+    cases and case_images in one transaction. Returns a report"""
+    report = {'catch_up': reembed(batch_size, workers)}
+    connection = mysql.connector.connect(**DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        # updated_at is left alone: the vectors are the ones new-version servers already use
+        cursor.execute(
+            """
+            UPDATE cases c
+            JOIN case_embeddings s ON s.case_id = c.id AND s.image_id = 0 AND s.embedding_version = %s
+            SET c.embedding = s.embedding, c.embedding_version = s.embedding_version,
+                c.embedding_fingerprint = s.embedding_fingerprint, c.updated_at = c.updated_at
+            """,
+            (EMBEDDING_VERSION,)
+        )
+        report['cases'] = cursor.rowcount
+        cursor.execute(
+            """
+            UPDATE case_images c
+            JOIN case_embeddings s ON s.case_id = c.case_id AND s.image_id = c.id AND s.embedding_version = %s
+            SET c.embedding = s.embedding, c.embedding_version = s.embedding_version,
+                c.embedding_fingerprint = s.embedding_fingerprint
+            """,
+            (EMBEDDING_VERSION,)
+        )
+        report['case_images'] = cursor.rowcount
+        cursor.execute("DELETE FROM case_embeddings WHERE embedding_version = %s", (EMBEDDING_VERSION,))
+        record_change(EMBEDDINGS_CUTOVER, cursor=cursor, embedding_version=EMBEDDING_VERSION,
+                      cases=report['cases'], case_images=report['case_images'])
+        connection.commit()
+    except Exception:
+        connection.rollback()
         raise
+    finally:
+        cursor.close()
+        connection.close()
+
+    # Rows inserted by old-version servers during the cutover; another run stages them
+    report['still_pending'] = status()['pending']
+    logger.info(f"Cutover to embedding version {EMBEDDING_VERSION}: {report['cases']} cases, "
+                f"{report['case_images']} extra images")
+    return report
+
 
 if __name__ == "__main__":
-    regenerate_embeddings()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Re-embed cases stored with another extractor version")
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'status', 'cutover'])
+    parser.add_argument('--batch', type=int, default=REEMBED_BATCH)
+    parser.add_argument('--workers', type=int, default=REEMBED_WORKERS)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        result = reembed(args.batch, args.workers)
+    elif args.command == 'status':
+        result = status()
+    else:
+        result = cutover(args.batch, args.workers)
+    print(json.dumps(result, indent=2, default=str))
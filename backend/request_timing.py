@@ -0,0 +1,135 @@
+"""
+Per-request stage timings
+The middleware gives every request an id and a timing record held in a context
+variable. Timed pipeline stages, database queries and JSON rendering add their
+durations to the record of the request they run for, including from worker
+threads, which inherit the context. The totals are returned in a Server-Timing
+header (shown by browser devtools) and written as one JSON access log line,
+with the id in X-Request-ID, so one slow request can be traced to a stage.
+"""
+import contextvars
+import json
+import logging
+import re
+import time
+import uuid
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+
+from config import SERVER_TIMING, ACCESS_LOG, ACCESS_LOG_SLOW_MS
+
+access_logger = logging.getLogger('access')
+
+# A caller-supplied id (e.g. from a proxy) is kept if it is short and harmless in a log line
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class RequestRecord:
+    __slots__ = ('request_id', 'stages')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.stages = {}  # stage -> [seconds, count], in first-seen order
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def add_timing(stage, seconds):
+    """Add a duration to the current request's stage (no-op outside a request)"""
+    record = current_request.get()
+    if record is None:
+        return
+    entry = record.stages.get(stage)
+    if entry is None:
+        record.stages[stage] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+def request_id():
+    """Id of the request being handled (None outside a request)"""
+    record = current_request.get()
+    return record.request_id if record is not None else None
+
+
+def server_timing_header(stages, total):
+    """Server-Timing value: one metric per stage in milliseconds, repeated stages summed"""
+    parts = []
+    for stage, (seconds, count) in stages.items():
+        description = f';desc="{count}x"' if count > 1 else ''
+        parts.append(f"{stage}{description};dur={seconds * 1000:.1f}")
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(parts)
+
+
+class TimedJSONResponse(JSONResponse):
+    """Default response class: rendering the body counts as the 'serialize' stage"""
+
+    def render(self, content):
+        started = time.perf_counter()
+        try:
+            return super().render(content)
+        finally:
+            add_timing('serialize', time.perf_counter() - started)
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware adding X-Request-ID and Server-Timing headers and writing the access log"""
+
+    def __init__(self, app, server_timing=SERVER_TIMING, access_log=ACCESS_LOG, slow_ms=ACCESS_LOG_SLOW_MS):
+        self.app = app
+        self.server_timing = server_timing
+        self.access_log = access_log
+        self.slow_ms = slow_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get('headers', [])).get(b'x-request-id', b'').decode('latin-1')
+        record = RequestRecord(incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex)
+        token = current_request.set(record)
+        started = time.perf_counter()
+        status = 500  # unless a response starts: unhandled errors are answered further out
+        first_byte = None
+        sent_bytes = 0
+
+        async def timing_send(message):
+            nonlocal status, first_byte, sent_bytes
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                first_byte = time.perf_counter() - started
+                headers = MutableHeaders(scope=message)
+                headers.append('X-Request-ID', record.request_id)
+                if self.server_timing:
+                    headers.append('Server-Timing', server_timing_header(record.stages, first_byte))
+            elif message['type'] == 'http.response.body':
+                sent_bytes += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timing_send)
+        finally:
+            current_request.reset(token)
+            if self.access_log:
+                self._log(scope, record, status, time.perf_counter() - started, first_byte, sent_bytes)
+
+    def _log(self, scope, record, status, duration, first_byte, sent_bytes):
+        duration_ms = round(duration * 1000, 1)
+        entry = {
+            'request_id': record.request_id,
+            'method': scope['method'],
+            'path': scope['path'],  # without the query string, which can carry the admin password
+            'status': status,
+            'duration_ms': duration_ms,
+            'first_byte_ms': round(first_byte * 1000, 1) if first_byte is not None else None,
+            'bytes': sent_bytes,
+            'stages': {stage: round(seconds * 1000, 1) for stage, (seconds, _) in record.stages.items()},
+            'client': scope['client'][0] if scope.get('client') else None
+        }
+        level = logging.WARNING if duration_ms >= self.slow_ms else logging.INFO
+        access_logger.log(level, json.dumps(entry))
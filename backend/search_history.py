@@ -0,0 +1,171 @@
+"""
+Write-behind logging of face searches to search_history
+A search only appends a record to an in-memory queue. A background task writes
+the queue in multi-row inserts when a batch has filled up, or every
+SEARCH_HISTORY_INTERVAL seconds otherwise, on a connection of its own and off the
+event loop. When the queue is full (the database is slow or down) new records
+are dropped and counted rather than slowing searches down. Databases created
+before searches were logged need `python migrate_search_history.py` first.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+
+import mysql.connector
+
+from config import (DB_CONFIG, SEARCH_HISTORY_ENABLED, SEARCH_HISTORY_MAX_QUEUE, SEARCH_HISTORY_BATCH,
+                    SEARCH_HISTORY_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+INSERT_ROWS = """
+INSERT INTO search_history
+    (search_timestamp, query_hash, matched_case_id, similarity_score, threshold_used, result_count, latency_ms, cached)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+class SearchHistoryLogger:
+    def __init__(self, enabled=SEARCH_HISTORY_ENABLED, max_queue=SEARCH_HISTORY_MAX_QUEUE,
+                 batch=SEARCH_HISTORY_BATCH, interval=SEARCH_HISTORY_INTERVAL):
+        self.enabled = enabled
+        self.max_queue = max_queue
+        self.batch = batch
+        self.interval = interval
+        self.queue = deque()
+        self.batch_ready = None
+        self.task = None
+        self.stopping = False
+        self.connection = None  # used only by the flushing thread
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_seconds = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        self.batch_ready = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self._loop())
+        logger.info(f"Search history: writing batches of up to {self.batch} every {self.interval}s")
+
+    async def stop(self):
+        """Stop the flusher and write what is still queued"""
+        if self.task is None:
+            return
+        # Not cancelled: a batch being written must not be queued again
+        self.stopping = True
+        self.batch_ready.set()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Search history: {len(self.queue)} records lost at shutdown: {e}")
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def record(self, query_hash, matched_case_id, similarity_score, threshold_used, result_count, latency_ms,
+               cached=False):
+        """Queue one search. Never blocks; returns False if the record was dropped"""
+        if self.task is None or self.stopping:
+            return False
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return False
+        self.queue.append((datetime.now(), query_hash, matched_case_id, similarity_score, threshold_used,
+                           result_count, round(latency_ms, 2), bool(cached)))
+        self.recorded += 1
+        if len(self.queue) >= self.batch:
+            self.batch_ready.set()
+        return True
+
+    async def _loop(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+            if self.stopping:
+                return
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Search history flush failed, {len(self.queue)} records queued: {e}")
+
+    async def flush(self):
+        """Write the queue in batches. Returns the number of rows written"""
+        written = 0
+        while self.queue:
+            rows = [self.queue.popleft() for _ in range(min(self.batch, len(self.queue)))]
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception:
+                self.failed_flushes += 1
+                # Put the batch back in front of newer records, as far as the queue has room
+                room = max(0, self.max_queue - len(self.queue))
+                self.queue.extendleft(reversed(rows[:room]))
+                self.dropped += len(rows) - min(room, len(rows))
+                raise
+            self.flushes += 1
+            self.written += len(rows)
+            self.last_flush_seconds = round(time.perf_counter() - started, 4)
+            written += len(rows)
+        return written
+
+    def _connect(self):
+        if self.connection is None or not self.connection.is_connected():
+            self.connection = mysql.connector.connect(**DB_CONFIG)
+        return self.connection
+
+    def _write(self, rows):
+        """One multi-row insert (executemany batches the VALUES) and commit; runs in a thread"""
+        connection = self._connect()
+        cursor = connection.cursor()
+        try:
+            try:
+                cursor.executemany(INSERT_ROWS, rows)
+            except mysql.connector.IntegrityError:
+                # A matched case was deleted since the search: keep the search, drop the link
+                connection.rollback()
+                matched = {row[2] for row in rows if row[2] is not None}
+                if not matched:
+                    raise  # not a deleted case: the table does not match the schema
+                cursor.execute(
+                    f"SELECT id FROM cases WHERE id IN ({', '.join(['%s'] * len(matched))})", tuple(matched)
+                )
+                existing = {row[0] for row in cursor.fetchall()}
+                rows = [row[:2] + (row[2] if row[2] in existing else None,) + row[3:] for row in rows]
+                cursor.executemany(INSERT_ROWS, rows)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'running': self.task is not None,
+            'queued': len(self.queue),
+            'max_queue': self.max_queue,
+            'recorded': self.recorded,
+            'written': self.written,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_seconds': self.last_flush_seconds
+        }
+
+
+# Global search history logger
+search_history = SearchHistoryLogger()
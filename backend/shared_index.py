@@ -0,0 +1,372 @@
+"""
+Embedding index shared by the uvicorn workers of one node
+One worker holds an exclusive file lock and is the writer: it owns the index,
+applies changes and publishes each new state as a generation folder of .npy
+files, then points the GENERATION file at it. The other workers (replicas) map
+the published arrays read-only, so the page cache holds one copy of the matrix
+whatever the worker count. Replicas never modify their mapping; they append the
+ids of cases they changed to a change log, which the writer replays from the
+database. When the writer exits its lock is released and a replica takes over.
+
+A generation is written in full only after compaction, growth or a new projection
+replaced the arrays, or once appended rows pass INDEX_DELTA_RATIO of the last full
+one; otherwise it is a delta holding the appended rows and the per-row flags, which
+readers apply onto the full generation it names.
+
+Generations double as snapshots for warm starts: a starting writer (or, when the
+index is not shared, every worker) maps the latest one copy-on-write and applies
+only the rows changed since its watermarks instead of reading every embedding.
+Without INDEX_SHARED the lock holder just refreshes the snapshot periodically.
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the shared index is unavailable
+    fcntl = None
+
+from cache import index_generation
+from config import (INDEX_SHARED, INDEX_SNAPSHOTS, INDEX_FOLDER, INDEX_PUBLISH_INTERVAL, INDEX_SNAPSHOT_INTERVAL,
+                    INDEX_DELTA_RATIO)
+from crossmatch import cross_matcher
+from embedding_index import case_index, EmbeddingIndex
+
+logger = logging.getLogger(__name__)
+
+GENERATION_FILE = 'GENERATION'
+CHANGE_LOG = 'changes.log'
+LOCK_FILE = 'writer.lock'
+KEEP_GENERATIONS = 2  # older generations are deleted; replicas still mapping one keep it alive until they remap
+
+
+class SharedIndex:
+    def __init__(self, index, folder=INDEX_FOLDER, interval=INDEX_PUBLISH_INTERVAL, shared=INDEX_SHARED,
+                 snapshots=INDEX_SNAPSHOTS, snapshot_interval=INDEX_SNAPSHOT_INTERVAL, delta_ratio=INDEX_DELTA_RATIO,
+                 on_cases_added=None):
+        self.index = index
+        self.folder = folder
+        self.interval = interval
+        self.shared = shared
+        self.snapshots = snapshots
+        self.snapshot_interval = snapshot_interval  # between publishes when the index is not shared
+        self.delta_ratio = delta_ratio
+        self.on_cases_added = on_cases_added  # called by the writer for cases first seen in the change log
+        self.role = None  # 'writer', 'replica' (shared) or 'private' (not shared) once started
+        self.lock_fd = None
+        self.generation = 0  # generation last published (writer) or mapped (replica)
+        self.published_version = None
+        self.published_at = 0.0
+        self.base = None  # read_saved() state of the last full generation, which deltas are written against
+        self.task = None
+        self.publishes = 0
+        self.delta_publishes = 0
+        self.last_publish_seconds = None
+        self.replayed_changes = 0
+
+    def _path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    async def start(self):
+        """Elect the writer and start publishing or following generations"""
+        if not (self.shared or self.snapshots):
+            return
+        if fcntl is None:
+            logger.error("Index sharing and snapshots need POSIX file locks; each worker loads its own index")
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        if self._try_lock():
+            try:
+                self._become_writer()
+            except Exception as e:
+                logger.error(f"Index writer could not publish yet: {e}", exc_info=True)
+        elif self.shared:
+            await self._become_replica()
+        else:
+            self._become_private()
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.role == 'writer':
+            if self.index.loaded and self.index.version != self.published_version:
+                await asyncio.to_thread(self.publish)
+            os.close(self.lock_fd)
+            self.lock_fd = None
+        self.index.change_sink = None
+        self.role = None
+
+    def _try_lock(self):
+        fd = os.open(self._path(LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+    # ============ GENERATIONS ============
+
+    def _read_generation(self):
+        try:
+            with open(self._path(GENERATION_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_generation(self, generation):
+        tmp = self._path(GENERATION_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write(str(generation))
+        os.replace(tmp, self._path(GENERATION_FILE))
+
+    def _generation_folder(self, generation):
+        return self._path(f"gen-{generation:08d}")
+
+    def publish(self):
+        """Write the index as the next generation and point GENERATION at it. While the writer
+        still holds the append-only arrays of the last full generation (no compaction, growth
+        or new projection since) and few rows were appended, the generation is a delta: the
+        appended rows plus the per-row flags. Otherwise it is written in full and the writer
+        remaps its own arrays copy-on-write onto the published files"""
+        started = time.perf_counter()
+        generation = max(self._read_generation(), self.generation) + 1
+        folder = self._generation_folder(generation)
+        shutil.rmtree(folder + '.tmp', ignore_errors=True)
+        base = self.base if self._delta_due() else None
+        meta = self.index.save(folder + '.tmp', base=base, generation=generation)
+        os.replace(folder + '.tmp', folder)
+        self._write_generation(generation)
+        self.generation = generation
+        self.published_version = meta['version']
+        self.published_at = time.monotonic()
+
+        if meta['base']:
+            self.delta_publishes += 1
+        else:
+            self.base = None
+            state = EmbeddingIndex.read_saved(folder, mmap_mode='c', with_rows=False)
+            with self.index.lock:
+                if self.index.version == meta['version']:
+                    self.index.adopt(state)
+                    self.published_version = self.index.version
+                    self.base = state
+        self._remove_old_generations(generation)
+
+        self.publishes += 1
+        self.last_publish_seconds = round(time.perf_counter() - started, 3)
+        logger.info(
+            f"Shared index generation {generation} published{' as a delta' if meta['base'] else ''}: "
+            f"{meta['cases']} cases, {meta['size'] - meta['tombstones']} vectors in {self.last_publish_seconds}s"
+        )
+
+    def _delta_due(self):
+        """A delta keeps the next publish small until appended rows pass INDEX_DELTA_RATIO of the base"""
+        if self.base is None or not self.index.is_delta_of(self.base):
+            return False
+        base_size = self.base['meta']['size']
+        return self.index.size - base_size <= self.delta_ratio * max(base_size, 1)
+
+    def _remove_old_generations(self, generation):
+        """Delete generations past KEEP_GENERATIONS, except the bases the kept deltas are applied to"""
+        names = [name for name in os.listdir(self.folder) if name.startswith('gen-') and not name.endswith('.tmp')]
+        kept = {name for name in names if int(name[4:]) > generation - KEEP_GENERATIONS}
+        for name in list(kept):
+            try:
+                with open(self._path(name, 'meta.json')) as f:
+                    base = json.load(f).get('base')
+            except (OSError, ValueError):
+                continue
+            if base:
+                kept.add(base)
+        for name in names:
+            if name not in kept:
+                shutil.rmtree(self._path(name), ignore_errors=True)
+
+    # ============ WRITER ============
+
+    def _become_writer(self):
+        was_replica = self.index.change_sink is not None
+        self.role = 'writer'
+        self.index.change_sink = None
+        # A private index is already current; a replica's mapping is read-only
+        if not self.index.loaded or was_replica:
+            self._warm_start()
+        self._apply_changes(self._drain_changes())
+        if self.index.loaded and self.index.version != self.published_version:
+            self.publish()
+        logger.info(f"Index: this worker (pid {os.getpid()}) is the writer of generation {self.generation}")
+
+    def _warm_start(self):
+        """Start from the latest generation if there is one (the first search loads otherwise)"""
+        generation = self._read_generation()
+        if not generation:
+            return
+        try:
+            changed = self.index.warm_start(self._generation_folder(generation))
+            self.generation = generation
+            if not changed:
+                # Identical to what is on disk; nothing to publish
+                self.published_version = self.index.version
+        except Exception as e:
+            logger.warning(f"Could not warm start from generation {generation}, loading from the database: {e}")
+            self.index.invalidate()
+
+    def _drain_changes(self):
+        """Take the change log over and return its lines"""
+        path = self._path(CHANGE_LOG)
+        taken = path + '.replay'
+        try:
+            os.replace(path, taken)
+        except FileNotFoundError:
+            return []
+        fd = os.open(taken, os.O_RDONLY)
+        try:
+            # Wait for replicas that opened the log before it was renamed
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            chunks = []
+            while True:
+                chunk = os.read(fd, 1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        os.remove(taken)
+        return b''.join(chunks).decode().splitlines()
+
+    def _apply_changes(self, lines):
+        """Replay change log lines, then bring the index up to date with the database"""
+        self.replayed_changes += len(lines)
+        if 'reload' in lines:
+            self.index.load()
+            return
+        if 'stale' in lines:
+            self.index.mark_stale()
+        case_ids = [int(line.split()[1]) for line in lines if line.startswith('case ')]
+        if case_ids and self.index.loaded:
+            added = self.index.refresh(case_ids)
+            if self.on_cases_added is not None:
+                for case_id in added:
+                    self.on_cases_added(case_id)
+        self.index.ensure_current()
+
+    async def _writer_tick(self):
+        lines = self._drain_changes()
+        try:
+            self._apply_changes(lines)
+        except Exception:
+            # Keep the changes for the next attempt
+            for line in lines:
+                self._append_change(line)
+            raise
+        due = self.shared or time.monotonic() - self.published_at >= self.snapshot_interval
+        if due and self.index.loaded and self.index.version != self.published_version:
+            await asyncio.to_thread(self.publish)
+
+    # ============ REPLICA ============
+
+    def record_change(self, kind, case_id=None):
+        """Change sink of a replica: append one line to the change log"""
+        self._append_change(f"{kind} {case_id}" if case_id is not None else kind)
+
+    def _append_change(self, line):
+        line = f"{line}\n".encode()
+        path = self._path(CHANGE_LOG)
+        while True:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # The writer may have taken the log over between open and lock
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    os.write(fd, line)
+                    return
+            except FileNotFoundError:
+                pass
+            finally:
+                os.close(fd)
+
+    async def _become_replica(self):
+        self.role = 'replica'
+        self.index.change_sink = self.record_change
+        # Until a generation is published, the first search loads a private copy
+        await self._follow()
+        logger.info(f"Shared index: this worker (pid {os.getpid()}) is a replica of generation {self.generation}")
+
+    async def _follow(self):
+        """Map the latest published generation if it is newer than ours"""
+        generation = self._read_generation()
+        if generation <= self.generation:
+            return
+        state = await asyncio.to_thread(EmbeddingIndex.read_saved, self._generation_folder(generation), 'r')
+        if state['meta'].get('embedding_version') != self.index.embedding_version:
+            # A writer still on another extractor version (rolling deploy): keep what we have
+            logger.warning(f"Shared index generation {generation} holds embeddings of another version; not following it")
+            self.generation = generation
+            return
+        self.index.adopt(state)
+        self.generation = generation
+        # Cached search results were computed against the previous generation
+        index_generation.bump()
+
+    def _become_private(self):
+        """Not shared and not the snapshot writer: a copy-on-write index of our own"""
+        self.role = 'private'
+        self._warm_start()
+        logger.info(f"Index: this worker (pid {os.getpid()}) keeps a private index from generation {self.generation}")
+
+    async def _private_tick(self):
+        if self._try_lock():
+            logger.info("Index snapshot writer went away; taking over")
+            self._become_writer()
+
+    async def _replica_tick(self):
+        if self._try_lock():
+            logger.info("Shared index writer went away; taking over")
+            self._become_writer()
+            return
+        await self._follow()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self.role == 'writer':
+                    await self._writer_tick()
+                elif self.role == 'replica':
+                    await self._replica_tick()
+                else:
+                    await self._private_tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Shared index {self.role} update failed: {e}", exc_info=True)
+
+    def stats(self):
+        return {
+            'shared': self.shared,
+            'snapshots': self.snapshots,
+            'role': self.role,
+            'pid': os.getpid(),
+            'generation': self.generation,
+            'publishes': self.publishes,
+            'delta_publishes': self.delta_publishes,
+            'base_generation': int(self.base['meta']['generation']) if self.base is not None else None,
+            'last_publish_seconds': self.last_publish_seconds,
+            'replayed_changes': self.replayed_changes,
+            'memory_mapped': isinstance(self.index.vectors, np.memmap)
+        }
+
+
+# Global coordinator for case_index
+shared_index = SharedIndex(case_index, on_cases_added=cross_matcher.enqueue)
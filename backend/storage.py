@@ -0,0 +1,206 @@
+"""
+Content-addressed image storage
+Uploads are named by their SHA-256 digest, sharded into nested directories
+and reference counted so identical photos are stored only once
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from config import UPLOAD_FOLDER, STORAGE_SHARD_DEPTH, STORAGE_SHARD_WIDTH
+from database import db
+
+logger = logging.getLogger(__name__)
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+EXTENSION_ALIASES = {'jpeg': 'jpg'}
+
+
+class ImageStorage:
+    def __init__(self, root=UPLOAD_FOLDER, depth=STORAGE_SHARD_DEPTH, width=STORAGE_SHARD_WIDTH):
+        self.root = root
+        self.depth = depth
+        self.width = width
+
+    @staticmethod
+    def content_hash(content):
+        """SHA-256 hex digest of file content"""
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def normalize_extension(filename):
+        """Lower-case extension of an uploaded filename, with aliases folded"""
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'bin'
+        return EXTENSION_ALIASES.get(ext, ext)
+
+    def relative_path(self, digest, ext):
+        """Sharded path of a blob relative to the upload folder, e.g. ab/cd/<hash>.jpg"""
+        shards = [digest[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return '/'.join(shards + [f"{digest}.{ext}"])
+
+    def absolute_path(self, relative_path):
+        """Filesystem path of a stored image"""
+        return os.path.join(self.root, *relative_path.split('/'))
+
+    @staticmethod
+    def digest_from_path(relative_path):
+        """Extract the content hash from a content-addressed path (None for legacy files)"""
+        name = os.path.basename(relative_path or '').split('.', 1)[0]
+        return name if HASH_PATTERN.match(name) else None
+
+    def store(self, content, filename):
+        """Store raw bytes, taking one reference on their blob. Returns (relative_path, digest)"""
+        digest = self.content_hash(content)
+        return self._store(digest, self.normalize_extension(filename), len(content), content, filename)
+
+    def store_upload(self, upload):
+        """Store a streamed upload that was hashed while it was read"""
+        return self._store(upload.digest, upload.kind, upload.size, upload, upload.filename)
+
+    def _store(self, digest, ext, size, content, filename):
+        relative_path = self.relative_path(digest, ext)
+        filepath = self.absolute_path(relative_path)
+
+        # The upsert locks the blob row until commit, and release() locks it with FOR UPDATE
+        # before unlinking, so in every worker the file exists whenever the row has references.
+        # A file lost to a crash between unlink and commit is written again here
+        connection = db.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                """
+                INSERT INTO image_blobs (content_hash, path, size_bytes, ref_count)
+                VALUES (%s, %s, %s, 1)
+                ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+                """,
+                (digest, relative_path, size)
+            )
+            if os.path.exists(filepath):
+                logger.info(f"Deduplicated upload {filename} -> {relative_path}")
+            else:
+                self.write_atomic(filepath, content)
+            connection.commit()
+        except Exception as e:
+            logger.error(f"Error saving file: {e}")
+            connection.rollback()
+            return None, digest
+        finally:
+            cursor.close()
+
+        return relative_path, digest
+
+    def release(self, relative_path):
+        """Drop one reference to an image and delete the file once nothing refers to it"""
+        digest = self.digest_from_path(relative_path)
+
+        if digest is None:
+            # Legacy flat upload: only remove it when no case points at it any more
+            remaining = db.execute_query(
+                """
+                SELECT (SELECT COUNT(*) FROM cases WHERE image_path = %s)
+                     + (SELECT COUNT(*) FROM case_images WHERE image_path = %s) AS count
+                """,
+                (relative_path, relative_path)
+            )
+            if remaining and remaining[0]['count'] == 0:
+                return self.remove_file(relative_path)
+            return False
+
+        # Decrement, delete and unlink under the row lock: a concurrent _store of the same
+        # blob waits for the commit and then finds (or rewrites) the file
+        connection = db.connection
+        cursor = connection.cursor()
+        removed = False
+        try:
+            cursor.execute("SELECT ref_count FROM image_blobs WHERE content_hash = %s FOR UPDATE", (digest,))
+            row = cursor.fetchone()
+            if row is not None and row[0] <= 1:
+                cursor.execute("DELETE FROM image_blobs WHERE content_hash = %s", (digest,))
+                removed = self.remove_file(relative_path)
+            elif row is not None:
+                cursor.execute("UPDATE image_blobs SET ref_count = ref_count - 1 WHERE content_hash = %s", (digest,))
+            connection.commit()
+        except Exception as e:
+            logger.error(f"Error releasing {relative_path}: {e}")
+            connection.rollback()
+            return False
+        finally:
+            cursor.close()
+        return removed
+
+    def rebuild_ref_counts(self, remove_orphans=False):
+        """Recompute blob reference counts from the cases and case_images tables (after restore or migration)"""
+        db.execute_query("UPDATE image_blobs SET ref_count = 0", commit=True)
+        rows = db.execute_query(
+            """
+            SELECT image_path, COUNT(*) AS refs FROM (
+                SELECT image_path FROM cases UNION ALL SELECT image_path FROM case_images
+            ) AS paths GROUP BY image_path
+            """
+        ) or []
+
+        managed = 0
+        for row in rows:
+            digest = self.digest_from_path(row['image_path'])
+            if digest is None:
+                continue
+            filepath = self.absolute_path(row['image_path'])
+            size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+            db.execute_query(
+                """
+                INSERT INTO image_blobs (content_hash, path, size_bytes, ref_count)
+                VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE ref_count = VALUES(ref_count)
+                """,
+                (digest, row['image_path'], size, row['refs']), commit=True
+            )
+            managed += 1
+
+        # Unreferenced blobs are kept by default so restoring a newer backup still finds its images
+        orphans = db.execute_query("SELECT path FROM image_blobs WHERE ref_count <= 0") or []
+        if remove_orphans:
+            db.execute_query("DELETE FROM image_blobs WHERE ref_count <= 0", commit=True)
+            for orphan in orphans:
+                self.remove_file(orphan['path'])
+
+        logger.info(
+            f"Rebuilt reference counts for {managed} blobs, "
+            f"{len(orphans)} unreferenced{' (removed)' if remove_orphans else ''}"
+        )
+        return managed
+
+    def write_atomic(self, filepath, content):
+        """Write bytes or a buffered upload to a temp file and rename it into place"""
+        directory = os.path.dirname(filepath)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(content, bytes):
+                    f.write(content)
+                else:
+                    content.copy_to(f)
+            os.replace(tmp_path, filepath)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def remove_file(self, relative_path):
+        """Remove a stored file, ignoring files that are already gone"""
+        filepath = self.absolute_path(relative_path)
+        if not os.path.exists(filepath):
+            return False
+        try:
+            os.remove(filepath)
+            logger.info(f"Removed image file: {relative_path}")
+            return True
+        except Exception as e:
+            logger.warning(f"Could not delete image file: {e}")
+            return False
+
+
+# Global image storage
+image_storage = ImageStorage()
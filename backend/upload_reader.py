@@ -0,0 +1,192 @@
+"""
+Streaming upload handling
+Reads uploads in chunks into a hash and a spooled buffer, validating the size and
+the image header on the way. Starlette parses the whole multipart body into its
+own spooled files before the handler runs, so these checks only save hashing and
+copying a bad file; the body size limit (MaxBodySizeMiddleware) is what stops an
+oversized request while it streams in.
+"""
+import hashlib
+import logging
+import shutil
+import tempfile
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from config import MAX_FILE_SIZE, UPLOAD_CHUNK_SIZE, UPLOAD_SPOOL_MEMORY, MULTIPART_OVERHEAD
+from metrics import UPLOADS, UPLOAD_BYTES, timed
+
+logger = logging.getLogger(__name__)
+
+# Magic numbers of the formats in ALLOWED_EXTENSIONS
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+]
+SNIFF_BYTES = 16
+
+
+def sniff_image_type(header):
+    """Identify an image format from its first bytes (None if not a supported image)"""
+    for signature, kind in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return kind
+    return None
+
+
+class BufferedUpload:
+    """An upload that has been fully read, hashed and spooled"""
+
+    def __init__(self, filename, spool, size, digest, kind):
+        self.filename = filename
+        self.spool = spool
+        self.size = size
+        self.digest = digest
+        self.kind = kind
+
+    def read(self):
+        """Return the full content (only call once the size has been bounded)"""
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def copy_to(self, fileobj):
+        """Stream the content into another file object"""
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, fileobj, UPLOAD_CHUNK_SIZE)
+
+    def close(self):
+        self.spool.close()
+
+
+class UploadChecker:
+    """Hashes and spools an upload chunk by chunk, checking its size and image header on the way"""
+
+    def __init__(self, filename, max_size):
+        self.filename = filename
+        self.max_size = max_size
+        self.spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.kind = None
+        self.header = b''
+
+    def add(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            logger.warning(f"Rejected upload {self.filename}: exceeds {self.max_size} bytes")
+            raise HTTPException(status_code=413, detail="File size exceeds maximum limit")
+
+        # Sniff the header from the first chunk, before hashing and copying the rest
+        if self.kind is None:
+            self.header += chunk[:SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= SNIFF_BYTES:
+                self.kind = sniff_image_type(self.header)
+                if self.kind is None:
+                    raise HTTPException(status_code=400, detail="File is not a valid image")
+
+        self.hasher.update(chunk)
+        self.spool.write(chunk)
+
+    def finish(self):
+        """The checked upload, once every chunk has been added"""
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail="File is empty")
+
+        if self.kind is None:
+            # Tiny files never filled the sniff window
+            self.kind = sniff_image_type(self.header)
+            if self.kind is None:
+                raise HTTPException(status_code=400, detail="File is not a valid image")
+        return BufferedUpload(self.filename, self.spool, self.size, self.hasher.hexdigest(), self.kind)
+
+
+async def read_upload(upload, max_size=MAX_FILE_SIZE):
+    """Read an UploadFile chunk by chunk, validating size and image header on the way"""
+    with timed('upload'):
+        return await _read_upload(upload, max_size)
+
+
+async def _read_upload(upload, max_size):
+    checker = UploadChecker(upload.filename, max_size)
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            checker.add(chunk)
+        buffered = checker.finish()
+    except Exception:
+        checker.spool.close()
+        raise
+
+    UPLOADS.inc(buffered.kind)
+    UPLOAD_BYTES.inc(buffered.kind, amount=buffered.size)
+    return buffered
+
+
+def read_image_file(fileobj, filename, max_size=MAX_FILE_SIZE):
+    """Blocking counterpart of read_upload for open files (e.g. zip archive entries)"""
+    checker = UploadChecker(filename, max_size)
+    try:
+        for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b''):
+            checker.add(chunk)
+        return checker.finish()
+    except Exception:
+        checker.spool.close()
+        raise
+
+
+class MaxBodySizeMiddleware:
+    """ASGI middleware that aborts request bodies larger than a limit while they stream in"""
+
+    def __init__(self, app, max_body_size=MAX_FILE_SIZE + MULTIPART_OVERHEAD, path_limits=None):
+        self.app = app
+        self.max_body_size = max_body_size
+        self.path_limits = path_limits or {}  # Larger limits for specific routes (e.g. archives)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in ('POST', 'PUT'):
+            await self.app(scope, receive, send)
+            return
+
+        max_body_size = self.path_limits.get(scope.get('path'), self.max_body_size)
+
+        # Declared length: reject before reading a single byte
+        for name, value in scope.get('headers', []):
+            if name == b'content-length' and value.isdigit() and int(value) > max_body_size:
+                await self._reject(send)
+                return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > max_body_size:
+                    # Surfaces as a 413 through FastAPI's own HTTPException handling
+                    raise HTTPException(status_code=413, detail="Request body exceeds maximum limit")
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message['type'] == 'http.response.start':
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except HTTPException as e:
+            if e.status_code != 413 or response_started:
+                raise
+            await self._reject(send)
+
+    async def _reject(self, send):
+        response = JSONResponse(status_code=413, content={"detail": "Request body exceeds maximum limit"})
+        await response({'type': 'http'}, None, send)
@@ -13,25 +13,65 @@ CREATE TABLE IF NOT EXISTS cases (
     contact VARCHAR(255) NOT NULL,
     image_path VARCHAR(500) NOT NULL,
     embedding LONGTEXT NOT NULL COMMENT 'JSON array of face embedding vector',
+    embedding_version SMALLINT NOT NULL DEFAULT 1 COMMENT 'EMBEDDING_VERSION of the extractor that produced the embedding',
+    embedding_fingerprint CHAR(12) NULL COMMENT 'Hash of the extractor code and OpenCV build',
     is_resolved BOOLEAN DEFAULT FALSE,
     resolved_at TIMESTAMP NULL,
     notes TEXT,
+    phash BIGINT UNSIGNED NULL COMMENT '64-bit perceptual hash of the image',
+    duplicate_of INT NULL COMMENT 'Earlier case with a near-identical photo',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     INDEX idx_status (status),
     INDEX idx_created_at (created_at),
-    INDEX idx_is_resolved (is_resolved)
+    INDEX idx_is_resolved (is_resolved),
+    INDEX idx_duplicate_of (duplicate_of),
+    INDEX idx_updated_at (updated_at),
+    FOREIGN KEY (duplicate_of) REFERENCES cases(id) ON DELETE SET NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Additional photos of a case (the primary photo stays on the cases row)
+CREATE TABLE IF NOT EXISTS case_images (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    case_id INT NOT NULL,
+    image_path VARCHAR(500) NOT NULL,
+    embedding LONGTEXT NOT NULL COMMENT 'JSON array of face embedding vector',
+    embedding_version SMALLINT NOT NULL DEFAULT 1,
+    embedding_fingerprint CHAR(12) NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (case_id) REFERENCES cases(id) ON DELETE CASCADE,
+    INDEX idx_case_id (case_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Embeddings re-computed by a newer extractor, staged until the cutover copies them into
+-- cases and case_images (image_id 0 is the primary photo on the cases row)
+CREATE TABLE IF NOT EXISTS case_embeddings (
+    case_id INT NOT NULL,
+    image_id INT NOT NULL DEFAULT 0,
+    embedding_version SMALLINT NOT NULL,
+    embedding_fingerprint CHAR(12) NULL,
+    embedding LONGTEXT NOT NULL,
+    staged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (case_id, image_id, embedding_version),
+    FOREIGN KEY (case_id) REFERENCES cases(id) ON DELETE CASCADE,
+    INDEX idx_version_staged (embedding_version, staged_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- Search history table
 CREATE TABLE IF NOT EXISTS search_history (
     id INT AUTO_INCREMENT PRIMARY KEY,
-    query_image_path VARCHAR(500) NOT NULL,
+    query_image_path VARCHAR(500) NULL,
+    query_hash CHAR(64) NULL COMMENT 'SHA-256 of the uploaded photo; search photos are not stored',
     matched_case_id INT,
     similarity_score FLOAT,
+    threshold_used FLOAT NULL,
+    result_count INT NULL,
+    latency_ms FLOAT NULL,
+    cached BOOLEAN NOT NULL DEFAULT FALSE,
     search_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (matched_case_id) REFERENCES cases(id) ON DELETE SET NULL,
-    INDEX idx_search_timestamp (search_timestamp)
+    INDEX idx_search_timestamp (search_timestamp),
+    INDEX idx_query_hash (query_hash)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- Admin users table
@@ -56,3 +96,28 @@ CREATE TABLE IF NOT EXISTS activity_log (
     INDEX idx_action (action),
     INDEX idx_created_at (created_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Content-addressed image blobs (reference counted, shared by identical uploads)
+CREATE TABLE IF NOT EXISTS image_blobs (
+    content_hash CHAR(64) PRIMARY KEY,
+    path VARCHAR(500) NOT NULL,
+    size_bytes INT NOT NULL DEFAULT 0,
+    ref_count INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Candidate missing <-> found pairs produced by cross-matching, awaiting admin review
+CREATE TABLE IF NOT EXISTS match_candidates (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    missing_case_id INT NOT NULL,
+    found_case_id INT NOT NULL,
+    score FLOAT NOT NULL,
+    source ENUM('incremental', 'sweep') NOT NULL,
+    review_status ENUM('pending', 'confirmed', 'rejected') NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    reviewed_at TIMESTAMP NULL,
+    UNIQUE KEY uq_pair (missing_case_id, found_case_id),
+    FOREIGN KEY (missing_case_id) REFERENCES cases(id) ON DELETE CASCADE,
+    FOREIGN KEY (found_case_id) REFERENCES cases(id) ON DELETE CASCADE,
+    INDEX idx_review_status_score (review_status, score)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
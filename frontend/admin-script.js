@@ -3,6 +3,8 @@ const API_BASE_URL = 'http://localhost:8000/api';
 const CASES_ENDPOINT = `${API_BASE_URL}/cases`;
 const STATS_ENDPOINT = `${API_BASE_URL}/stats`;
 const LOGIN_ENDPOINT = `${API_BASE_URL}/admin/login`;
+const MATCHES_ENDPOINT = `${API_BASE_URL}/admin/match-candidates`;
+const CROSSMATCH_ENDPOINT = `${API_BASE_URL}/admin/crossmatch`;
 let isAuthenticated = false;
 let sessionToken = sessionStorage.getItem('adminToken') || '';
 
@@ -47,6 +49,8 @@ function refreshCurrentPage() {
         loadDashboard();
     } else if (activePage === 'cases-page') {
         loadCases();
+    } else if (activePage === 'matches-page') {
+        loadMatchCandidates();
     } else if (activePage === 'search-page') {
         loadSearchHistory();
     } else if (activePage === 'users-page') {
@@ -182,6 +186,7 @@ function switchPage(pageName) {
     const titles = {
         'dashboard': 'Dashboard',
         'cases': 'Manage Cases',
+        'matches': 'Match Review',
         'search': 'Search History',
         'users': 'Admin Users',
         'settings': 'Settings'
@@ -193,6 +198,9 @@ function switchPage(pageName) {
         case 'cases':
             loadCases();
             break;
+        case 'matches':
+            loadMatchCandidates();
+            break;
         case 'search':
             loadSearchHistory();
             break;
@@ -251,10 +259,11 @@ function displayCasesTable(cases) {
 
     let html = '';
     cases.forEach((caseItem, index) => {
-        // Normalize and URL-encode the filename to handle backslashes and special characters
-        const filename = (caseItem.image_path || '').replace(/\\/g, '/').split('/').pop();
-        const encodedFilename = encodeURIComponent(filename || '');
-        const imagePath = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedFilename}`;
+        // Normalize backslashes and URL-encode each path segment (uploads are sharded as ab/cd/<hash>.jpg)
+        const encodedPath = (caseItem.image_path || '').replace(/\\/g, '/').split('/').map(encodeURIComponent).join('/');
+        const imagePath = caseItem.thumbnail_url
+            ? `${API_BASE_URL.replace('/api', '')}${caseItem.thumbnail_url}`
+            : `${API_BASE_URL.replace('/api', '')}/uploads/${encodedPath}`;
         const statusClass = caseItem.status === 'missing' ? 'danger' : 'success';
         const statusText = caseItem.status === 'missing' ? 'MISSING' : 'FOUND';
         const date = new Date(caseItem.created_at).toLocaleDateString();
@@ -331,6 +340,106 @@ async function deleteCase(caseId) {
     );
 }
 
+// ============ MATCH REVIEW ============
+async function loadMatchCandidates() {
+    const tbody = document.getElementById('matchesTableBody');
+    if (!tbody) return;
+
+    try {
+        const adminPassword = sessionStorage.getItem('adminPassword') || '';
+        const response = await fetch(`${MATCHES_ENDPOINT}?admin_password=${encodeURIComponent(adminPassword)}&t=${Date.now()}`);
+        const data = await response.json();
+
+        if (response.status === 401) {
+            showAlert('Session expired. Please login again.', 'error');
+            logout();
+            return;
+        }
+        if (!data.success || !data.candidates || data.candidates.length === 0) {
+            tbody.innerHTML = '<tr><td colspan="5" style="text-align: center; padding: 40px;">No pending matches</td></tr>';
+            return;
+        }
+
+        const baseUrl = API_BASE_URL.replace('/api', '');
+        let html = '';
+        data.candidates.forEach(candidate => {
+            const missing = candidate.missing_case;
+            const found = candidate.found_case;
+            html += `
+                <tr>
+                    <td>
+                        <img src="${baseUrl}${missing.thumbnail_url}" alt="${escapeHtml(missing.name)}" class="table-image" onerror="this.src='https://via.placeholder.com/40'">
+                        <strong>#${missing.case_id} ${escapeHtml(missing.name)}</strong>
+                    </td>
+                    <td>
+                        <img src="${baseUrl}${found.thumbnail_url}" alt="${escapeHtml(found.name)}" class="table-image" onerror="this.src='https://via.placeholder.com/40'">
+                        <strong>#${found.case_id} ${escapeHtml(found.name)}</strong>
+                    </td>
+                    <td>${candidate.similarity_percentage}%</td>
+                    <td>${escapeHtml(candidate.source)}</td>
+                    <td>
+                        <button class="btn btn-sm btn-primary" onclick="reviewMatch(${candidate.candidate_id}, 'confirmed')">
+                            <i class="fas fa-check"></i> Confirm
+                        </button>
+                        <button class="btn btn-sm btn-danger" onclick="reviewMatch(${candidate.candidate_id}, 'rejected')">
+                            <i class="fas fa-times"></i> Reject
+                        </button>
+                    </td>
+                </tr>
+            `;
+        });
+        tbody.innerHTML = html;
+    } catch (error) {
+        console.error('Load match candidates error:', error);
+    }
+}
+
+async function reviewMatch(candidateId, decision) {
+    try {
+        const formData = new FormData();
+        formData.append('admin_password', sessionStorage.getItem('adminPassword') || '');
+        formData.append('decision', decision);
+
+        const response = await fetch(`${MATCHES_ENDPOINT}/${candidateId}/review`, {
+            method: 'POST',
+            body: formData
+        });
+        const data = await response.json();
+
+        if (response.ok && data.success) {
+            showAlert(`Match ${decision}`, 'success');
+            loadMatchCandidates();
+        } else {
+            showAlert('Failed to review match: ' + (data.detail || 'Unknown error'), 'error');
+        }
+    } catch (error) {
+        console.error('Review match error:', error);
+        showAlert('Error reviewing match: ' + (error.message || String(error)));
+    }
+}
+
+async function runCrossmatchSweep() {
+    try {
+        const formData = new FormData();
+        formData.append('admin_password', sessionStorage.getItem('adminPassword') || '');
+
+        const response = await fetch(`${CROSSMATCH_ENDPOINT}/run`, {
+            method: 'POST',
+            body: formData
+        });
+        const data = await response.json();
+
+        if (response.ok && data.success) {
+            showAlert('Full sweep started; new matches will appear here when it finishes', 'success');
+        } else {
+            showAlert('Could not start sweep: ' + (data.detail || 'Unknown error'), 'error');
+        }
+    } catch (error) {
+        console.error('Crossmatch sweep error:', error);
+        showAlert('Error starting sweep: ' + (error.message || String(error)));
+    }
+}
+
 // ============ SEARCH HISTORY ============
 async function loadSearchHistory() {
     const tbody = document.getElementById('searchTableBody');
@@ -446,9 +446,10 @@ async function findSimilarFromCase(imagePath) {
         }
 
         // Normalize and build absolute URL
-        const filename = imagePath.replace(/\\/g, '/').split('/').pop();
-        const encodedFilename = encodeURIComponent(filename || '');
-        const url = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedFilename}`;
+        const normalizedPath = imagePath.replace(/\\/g, '/');
+        const filename = normalizedPath.split('/').pop();
+        const encodedPath = normalizedPath.split('/').map(encodeURIComponent).join('/');
+        const url = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedPath}`;
 
         console.log('📥 Fetching case image from:', url);
 
@@ -542,12 +543,14 @@ function displaySearchResults(data) {
     filteredMatches.forEach((match, index) => {
         // Properly construct image path with URL encoding and normalization
         let imagePath = match.image_path || '';
-        if (!imagePath.startsWith('http')) {
-            // Normalize backslashes to forward slashes and extract filename
-            const filename = imagePath.replace(/\\/g, '/').split('/').pop();
-            const encodedFilename = encodeURIComponent(filename || '');
+        if (match.thumbnail_url) {
+            // Resized, cacheable derivative instead of the full-size original
+            imagePath = `${API_BASE_URL.replace('/api', '')}${match.thumbnail_url}`;
+        } else if (!imagePath.startsWith('http')) {
+            // Normalize backslashes and encode each segment (uploads are sharded as ab/cd/<hash>.jpg)
+            const encodedPath = imagePath.replace(/\\/g, '/').split('/').map(encodeURIComponent).join('/');
             // Use absolute uploads path so it works regardless of current page path
-            imagePath = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedFilename}`;
+            imagePath = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedPath}`;
         }
 
         const statusClass = match.status === 'missing' ? 'status-missing' : 'status-found';
@@ -715,10 +718,11 @@ function displayCases(cases) {
     cases.forEach(caseItem => {
         // Properly construct image path with URL encoding and normalization
         let imagePath = caseItem.image_path || '';
-        if (!imagePath.startsWith('http')) {
-            const filename = imagePath.replace(/\\/g, '/').split('/').pop();
-            const encodedFilename = encodeURIComponent(filename || '');
-            imagePath = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedFilename}`;
+        if (caseItem.thumbnail_url) {
+            imagePath = `${API_BASE_URL.replace('/api', '')}${caseItem.thumbnail_url}`;
+        } else if (!imagePath.startsWith('http')) {
+            const encodedPath = imagePath.replace(/\\/g, '/').split('/').map(encodeURIComponent).join('/');
+            imagePath = `${API_BASE_URL.replace('/api', '')}/uploads/${encodedPath}`;
         }
         const badgeClass = caseItem.status === 'missing' ? 'missing' : 'found';
         const badgeText = caseItem.status === 'missing' ? '🔴 MISSING PERSON' : '🟢 FOUND PERSON';
@@ -104,60 +104,18 @@ This will take a few minutes for all cases.
     print_info("This may take 1-5 minutes depending on number of cases...")
     
     try:
-        from face_recognition_engine import face_engine
-        import mysql.connector
-        from config import DB_CONFIG
-        import json
+        # Only rows stored by another EMBEDDING_VERSION are re-embedded; an interrupted run resumes
+        from regenerate_embeddings import cutover
         
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("SELECT id, image_path, name FROM cases")
-        cases = cursor.fetchall()
-        
-        processed = 0
-        failed = 0
-        
-        for i, case in enumerate(cases, 1):
-            try:
-                case_id = case['id']
-                name = case['name']
-                image_path = case['image_path']
-                
-                full_path = os.path.join('backend', 'uploads', image_path)
-                
-                if not os.path.exists(full_path):
-                    print_warning(f"  [{i}/{len(cases)}] Skipped: {name} - image not found")
-                    failed += 1
-                    continue
-                
-                # Generate new embedding
-                embedding = face_engine.get_face_embedding(full_path)
-                embedding_json = json.dumps(embedding)
-                
-                # Update database
-                cursor.execute(
-                    "UPDATE cases SET embedding = %s WHERE id = %s",
-                    (embedding_json, case_id)
-                )
-                conn.commit()
-                
-                print_success(f"  [{i}/{len(cases)}] Updated: {name}")
-                processed += 1
-                
-            except Exception as e:
-                print_error(f"  [{i}/{len(cases)}] Error processing {case.get('name')}: {e}")
-                failed += 1
-                continue
-        
-        cursor.close()
-        conn.close()
+        report = cutover()
+        catch_up = report['catch_up']
         
         print(f"\n{'='*70}")
         print(f"Embedding Regeneration Complete!")
-        print(f"  ✅ Successfully updated: {processed}")
-        print(f"  ❌ Failed: {failed}")
-        print(f"  📊 Total: {len(cases)}")
+        print(f"  ✅ Re-embedded: {catch_up['staged']}")
+        print(f"  ❌ Unreadable images: {len(catch_up['unreadable'])}")
+        print(f"  📊 Now at version {catch_up['embedding_version']}: {report['cases']} cases, "
+              f"{report['case_images']} extra photos")
         print(f"{'='*70}")
         
     except Exception as e:
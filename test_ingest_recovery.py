@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Test that ingest jobs are recovered only when their owning worker has gone"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from ingest import IngestQueue, QUEUED, PROCESSING, DONE
+
+
+def make_queue(folder):
+    """A queue that journals to folder, without the worker pool"""
+    queue = IngestQueue(folder=folder, workers=1)
+    queue.queue = asyncio.Queue()
+    return queue
+
+
+def journal(queue, job_id, state, attempts=1):
+    queue._save({'job_id': job_id, 'state': state, 'attempts': attempts, 'image_path': f"{job_id}.jpg",
+                 'case_id': None, 'error': None})
+
+
+def test_recovery(folder):
+    """A live owner keeps its job; a dead owner's job is re-queued once, by one worker"""
+    owner = make_queue(folder)
+    owner._claim('a' * 32)
+    journal(owner, 'a' * 32, PROCESSING)  # its owner is running
+    journal(owner, 'b' * 32, PROCESSING, attempts=2)  # its owner died mid-flight
+    journal(owner, 'c' * 32, DONE)
+
+    starting = make_queue(folder)
+    recovered = starting._recover()
+    job = starting.jobs.get('b' * 32)
+    if recovered != 1 or job is None or job['state'] != QUEUED or job['attempts'] != 2:
+        print(f"❌ First recovery: {recovered} jobs, {sorted(starting.jobs)}")
+        return False
+    print("✅ Only the orphaned job is recovered, as queued with its attempts kept")
+
+    another = make_queue(folder)
+    if another._recover() != 0:
+        print(f"❌ A second starting worker took claimed jobs: {sorted(another.jobs)}")
+        return False
+    print("✅ A second starting worker leaves claimed jobs alone")
+
+    # The owner exits: its lock goes with the process
+    os.close(owner.claims.pop('a' * 32))
+    if another._recover() != 1 or 'a' * 32 not in another.jobs:
+        print(f"❌ Job of an exited owner not recovered: {sorted(another.jobs)}")
+        return False
+    print("✅ The job of an exited owner is recovered")
+
+    for queue in (starting, another):
+        for job_id in list(queue.claims):
+            os.close(queue.claims.pop(job_id))
+    return True
+
+
+def main():
+    print("🧪 Testing ingest job recovery\n")
+
+    with tempfile.TemporaryDirectory() as folder:
+        passed = test_recovery(folder)
+
+    if passed:
+        print("\n✅ All tests passed!")
+    else:
+        print("\n⚠️  Recovery test failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Test that sharded searches return the same results as a single-shard scan"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from embedding_index import EmbeddingIndex
+
+CASES = 3000
+DIM = 64
+
+
+def build_index(shards, reduction, seed=0):
+    """A synthetic index with several photos per case, tombstones and mixed attributes"""
+    rng = np.random.default_rng(seed)
+    index = EmbeddingIndex(shards=shards, shard_min_rows=200, reduction=reduction, compact_ratio=1.0)
+    index.loaded = True
+    start = datetime(2024, 1, 1)
+    for case_id in range(1, CASES + 1):
+        status = 'missing' if case_id % 2 else 'found'
+        index.add(case_id, rng.standard_normal(DIM), status, case_id % 5 == 0, start + timedelta(hours=case_id))
+    # Extra photos land in later shards than their case's primary row
+    for case_id in rng.choice(np.arange(1, CASES + 1), 500, replace=False).tolist():
+        index.add_image(case_id, rng.standard_normal(DIM))
+    for case_id in range(7, CASES + 1, 97):
+        index.remove(case_id)
+    return index
+
+
+def same_results(a, b):
+    (ids_a, scored_a), (ids_b, scored_b) = a, b
+    return scored_a == scored_b and [case for case, _ in ids_a] == [case for case, _ in ids_b] \
+        and np.allclose([score for _, score in ids_a], [score for _, score in ids_b], atol=1e-5)
+
+
+def test_sharded_equals_unsharded(reduction):
+    single = build_index(1, reduction)
+    sharded = build_index(8, reduction)
+    if len(sharded.shard_bounds()) < 2:
+        print(f"❌ Index was not split into shards: {sharded.shard_bounds()}")
+        return False
+
+    filters = [
+        {},
+        {'status': 'missing'},
+        {'status': 'found', 'is_resolved': False},
+        {'created_from': datetime(2024, 1, 20), 'created_to': datetime(2024, 3, 1)},
+        {'exclude_case_id': 10},
+    ]
+    queries = np.random.default_rng(1).standard_normal((20, DIM))
+    for query in queries:
+        for kwargs in filters:
+            for threshold, top_k in ((0.0, 10), (0.3, None), (0.0, 1)):
+                expected = single.search(query, threshold, top_k, exact=True, **kwargs)
+                actual = sharded.search(query, threshold, top_k, exact=True, **kwargs)
+                if not same_results(expected, actual):
+                    print(f"❌ {reduction}: results differ for {kwargs}, threshold {threshold}, top_k {top_k}")
+                    print(f"   single:  {expected[0][:3]} ({expected[1]} scored)")
+                    print(f"   sharded: {actual[0][:3]} ({actual[1]} scored)")
+                    return False
+    sharded.executor.shutdown()
+    print(f"✅ {reduction}: {len(sharded.shard_bounds())} shards match a single scan "
+          f"over {len(queries) * len(filters) * 3} searches")
+    return True
+
+
+def main():
+    print("🧪 Testing sharded search\n")
+
+    results = [test_sharded_equals_unsharded(reduction) for reduction in ('max', 'top2_mean')]
+    if all(results):
+        print("\n✅ All tests passed!")
+    else:
+        print("\n⚠️  Sharded search differs from a single scan")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Test reference-counted image storage against the configured MySQL database"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from database import db
+from storage import ImageStorage
+
+
+def ref_count(digest):
+    rows = db.execute_query("SELECT ref_count FROM image_blobs WHERE content_hash = %s", (digest,))
+    return rows[0]['ref_count'] if rows else None
+
+
+def test_ref_count_release(storage):
+    """Two stores of the same bytes share one file, which goes with the last reference"""
+    content = os.urandom(4096)
+    first, digest = storage.store(content, 'photo.JPEG')
+    second, _ = storage.store(content, 'copy.jpg')
+    filepath = storage.absolute_path(first)
+
+    if first != second or not os.path.exists(filepath) or ref_count(digest) != 2:
+        print(f"❌ Duplicate store: paths {first} / {second}, ref_count {ref_count(digest)}")
+        return False
+    print(f"✅ Duplicate store shares {first} with ref_count 2")
+
+    if storage.release(first) or not os.path.exists(filepath) or ref_count(digest) != 1:
+        print(f"❌ First release: file exists {os.path.exists(filepath)}, ref_count {ref_count(digest)}")
+        return False
+    print("✅ First release keeps the file with ref_count 1")
+
+    if not storage.release(first) or os.path.exists(filepath) or ref_count(digest) is not None:
+        print(f"❌ Last release: file exists {os.path.exists(filepath)}, ref_count {ref_count(digest)}")
+        return False
+    print("✅ Last release removes the file and the blob row")
+    return True
+
+
+def test_missing_file_rewritten(storage):
+    """A blob row whose file was lost is healed by the next store of the same bytes"""
+    content = os.urandom(4096)
+    path, digest = storage.store(content, 'photo.png')
+    os.remove(storage.absolute_path(path))
+    storage.store(content, 'photo.png')
+    restored = os.path.exists(storage.absolute_path(path))
+    storage.release(path)
+    storage.release(path)
+
+    if not restored:
+        print("❌ Store of a blob with a missing file did not rewrite it")
+        return False
+    print("✅ Store rewrites a missing file for an existing blob row")
+    return True
+
+
+def main():
+    print("🧪 Testing image storage reference counts\n")
+
+    if not db.connect():
+        print("❌ Cannot proceed - database is not reachable")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = ImageStorage(root=root)
+        results = [test_ref_count_release(storage), test_missing_file_rewritten(storage)]
+    db.disconnect()
+
+    if all(results):
+        print("\n✅ All tests passed!")
+    else:
+        print("\n⚠️  Some storage tests failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()